@@ -0,0 +1,104 @@
+import time
+
+# Seconds of traffic a limited bucket may save up and send in one burst
+DEFAULT_BURST_SECONDS = 1.0
+
+
+class TokenBucket:
+    """
+    Rate limit for one direction at one level of the hierarchy.
+
+    A bucket holds up to `burst` tokens (bytes) and refills at `rate` bytes
+    per second; `rate` None means unlimited. Consuming takes tokens from the
+    bucket and from every limited ancestor at once, so a peer never exceeds
+    its torrent's or the global limit. A bucket may go into debt by one
+    block, which keeps blocks larger than the burst from stalling forever.
+    """
+    __slots__ = ('parent', 'rate', 'burst', '_tokens', '_updated')
+
+    def __init__(self, rate=None, parent=None, burst=None):
+        self.parent = parent
+        self.rate = None
+        self._tokens = 0.0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """
+        Changes the limit; takes effect for the next consume. Tokens saved up
+        under the old rate are kept, up to the new burst.
+        """
+        now = time.monotonic()
+        if self.rate is not None:
+            self._refill(now)
+        was_limited = self.rate is not None
+        self.rate = rate or None
+        self.burst = burst or (self.rate or 0) * DEFAULT_BURST_SECONDS
+        self._tokens = min(self._tokens, self.burst) if was_limited else self.burst
+        self._updated = now
+
+    def try_consume(self, amount) -> bool:
+        """
+        Takes `amount` tokens from this bucket and its limited ancestors, or
+        nothing if any of them is empty.
+        """
+        bucket = self
+        while bucket is not None and bucket.rate is None:
+            bucket = bucket.parent
+        if bucket is None:
+            return True  # Unlimited all the way up
+        now = time.monotonic()
+        chain = []
+        while bucket is not None:
+            if bucket.rate is not None:
+                bucket._refill(now)
+                if bucket._tokens <= 0:
+                    return False
+                chain.append(bucket)
+            bucket = bucket.parent
+        for bucket in chain:
+            bucket._tokens -= amount
+        return True
+
+    def delay(self) -> float:
+        """
+        Seconds until try_consume can succeed again.
+        """
+        now = time.monotonic()
+        delay = 0.0
+        bucket = self
+        while bucket is not None:
+            if bucket.rate is not None:
+                bucket._refill(now)
+                if bucket._tokens <= 0:
+                    delay = max(delay, -bucket._tokens / bucket.rate)
+            bucket = bucket.parent
+        return delay
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class Bandwidth:
+    """
+    Download and upload limits for one level: global, torrent or peer.
+
+    Levels form a tree through `child`, e.g. a Session's global Bandwidth,
+    one child per torrent and one grandchild per peer. Limits are bytes per
+    second, None for unlimited, and can be changed at any time with
+    `set_limits`. When nothing is limited a consume is a walk up three
+    parent pointers.
+    """
+    __slots__ = ('download', 'upload')
+
+    def __init__(self, download=None, upload=None, parent=None):
+        self.download = TokenBucket(download, parent and parent.download)
+        self.upload = TokenBucket(upload, parent and parent.upload)
+
+    def child(self, download=None, upload=None):
+        return Bandwidth(download, upload, self)
+
+    def set_limits(self, download=None, upload=None):
+        self.download.set_rate(download)
+        self.upload.set_rate(upload)
@@ -1,6 +1,3 @@
-from collections import OrderedDict
-
-
 # Indicates start of integers
 TOKEN_INTEGER = b'i'
 
@@ -17,15 +14,37 @@ TOKEN_END = b'e'
 TOKEN_STRING_SEPARATOR = b':'
 
 
+# Marks a dict frame that is waiting for its next key
+_NO_KEY = object()
+
+# Returned by Decoder._parse when the buffer ends inside a value
+_INCOMPLETE = object()
+
+
 class Decoder:
     """
     Decodes a bencoded sequence of bytes.
+
+    The decoder is iterative, so nesting depth is not limited by the Python
+    recursion limit, and it reads bytes, bytearray or memoryview input in
+    place: only the decoded strings themselves are copied.
+
+    Pass `span_keys` to record where the values of those dict keys start and
+    end in the input. `spans[key]` holds the (start, end) offsets of the
+    shallowest occurrence, e.g. to hash the raw `info` dictionary of a
+    torrent without re-encoding it.
     """
-    def __init__(self, data: bytes):
-        if not isinstance(data, bytes):
-            raise TypeError('Argument "data" must be of type bytes')
+    def __init__(self, data, span_keys=()):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError('Argument "data" must be a bytes-like object')
         self._data = data
         self._index = 0
+        # Absolute stream offset of self._data[0] (non-zero when streaming)
+        self._offset = 0
+        self._stack = []
+        self._span_keys = frozenset(span_keys)
+        self._span_depth = {}
+        self.spans = {}
 
     def decode(self):
         """
@@ -33,89 +52,161 @@ class Decoder:
 
         :return A python object representing the bencoded data
         """
-        c = self._peek()
-        if c is None:
+        value = self._parse(self._data)
+        if value is _INCOMPLETE:
             raise EOFError('Unexpected end-of-file')
-        elif c == TOKEN_INTEGER:
-            self._consume()  # The token
-            return self._decode_int()
-        elif c == TOKEN_LIST:
-            self._consume()  # The token
-            return self._decode_list()
-        elif c == TOKEN_DICT:
-            self._consume()  # The token
-            return self._decode_dict()
-        elif c == TOKEN_END:
-            return None
-        elif c in b'01234567899':
-            return self._decode_string()
-        else:
-            raise RuntimeError('Invalid token read at {0}'.format(
-                str(self._index)))
+        return value
 
-    def _peek(self):
+    def _parse(self, data):
         """
-        Return the next character from the bencoded data or None
+        Decodes the next complete value starting at `self._index`.
+
+        Containers being built are kept on `self._stack`, so when `data` runs
+        out in the middle of a value the parse can resume once more data has
+        been appended; `_INCOMPLETE` is returned in that case.
         """
-        if self._index + 1 >= len(self._data):
-            return None
-        return self._data[self._index:self._index + 1]
+        stack = self._stack
+        with memoryview(data) as view:
+            if view.format != 'B':
+                view = view.cast('B')
+            n = len(view)
+            i = self._index
+            while True:
+                if i >= n:
+                    self._index = i
+                    return _INCOMPLETE
+                c = view[i]
+                start = i
+                if c == 0x64:  # TOKEN_DICT
+                    stack.append([{}, _NO_KEY, self._offset + i])
+                    i += 1
+                    continue
+                elif c == 0x6c:  # TOKEN_LIST
+                    stack.append([[], None, self._offset + i])
+                    i += 1
+                    continue
+                elif c == 0x65:  # TOKEN_END
+                    if not stack:
+                        raise RuntimeError('Unexpected end token at {0}'.format(
+                            str(self._offset + i)))
+                    frame = stack[-1]
+                    if frame[1] is not None and frame[1] is not _NO_KEY:
+                        raise RuntimeError('Missing value for key {0}'.format(
+                            str(frame[1])))
+                    stack.pop()
+                    value = frame[0]
+                    i += 1
+                    start = frame[2] - self._offset
+                elif c == 0x69:  # TOKEN_INTEGER
+                    value, i = self._parse_number(view, i + 1, n, 0x65, True)
+                    if i < 0:
+                        self._index = start
+                        return _INCOMPLETE
+                elif 0x30 <= c <= 0x39:
+                    length, i = self._parse_number(view, i, n, 0x3a, False)
+                    if i < 0 or i + length > n:
+                        self._index = start
+                        return _INCOMPLETE
+                    value = bytes(view[i:i + length])
+                    i += length
+                else:
+                    raise RuntimeError('Invalid token read at {0}'.format(
+                        str(self._offset + i)))
 
-    def _consume(self) -> bytes:
+                # Hand the finished value to the enclosing container
+                if not stack:
+                    self._index = i
+                    return value
+                frame = stack[-1]
+                container = frame[0]
+                if frame[1] is None:
+                    container.append(value)
+                elif frame[1] is _NO_KEY:
+                    if type(value) is not bytes:
+                        raise RuntimeError('Dict key must be a string at {0}'.format(
+                            str(self._offset + start)))
+                    frame[1] = value
+                else:
+                    key = frame[1]
+                    container[key] = value
+                    frame[1] = _NO_KEY
+                    if key in self._span_keys:
+                        self._record_span(key, start, i, len(stack))
+
+    def _parse_number(self, view, i, n, terminator, signed):
         """
-        Read (and therefore consume) the next character from the data
+        Reads decimal digits up to `terminator` and returns the number and
+        the index after the terminator, or an index of -1 if data ran out.
         """
-        self._index += 1
+        negative = False
+        if signed and i < n and view[i] == 0x2d:  # '-'
+            negative = True
+            i += 1
+        first = i
+        value = 0
+        while i < n:
+            c = view[i]
+            if c == terminator:
+                if i == first:
+                    raise RuntimeError('Missing digits at {0}'.format(
+                        str(self._offset + i)))
+                return (-value if negative else value), i + 1
+            if not 0x30 <= c <= 0x39:
+                raise RuntimeError('Invalid digit read at {0}'.format(
+                    str(self._offset + i)))
+            value = value * 10 + c - 0x30
+            i += 1
+        return 0, -1
+
+    def _record_span(self, key, start, end, depth):
+        if depth < self._span_depth.get(key, depth + 1):
+            self._span_depth[key] = depth
+            self.spans[key] = (self._offset + start, self._offset + end)
+
+
+class StreamDecoder(Decoder):
+    """
+    Decodes bencoded values from data that arrives in chunks, e.g. a large
+    tracker response read from a socket or a .torrent file read in blocks.
+
+    Nested containers are kept between calls, so every byte is parsed once;
+    only the tail of an unfinished string or integer is re-read. Span offsets
+    are relative to the start of the stream.
+    """
+    def __init__(self, span_keys=()):
+        super().__init__(bytearray(), span_keys)
 
-    def _read(self, length: int) -> bytes:
+    def feed(self, chunk):
         """
-        Read the `length` number of bytes from data and return the result
+        Appends `chunk` and returns the list of values it completed.
         """
-        if self._index + length > len(self._data):
-            raise IndexError('Cannot read {0} bytes from current position {1}'
-                             .format(str(length), str(self._index)))
-        res = self._data[self._index:self._index+length]
-        self._index += length
-        return res
-
-    def _read_until(self, token: bytes) -> bytes:
+        self._data += chunk
+        values = []
+        while self._index < len(self._data):
+            value = self._parse(self._data)
+            if value is _INCOMPLETE:
+                break
+            values.append(value)
+        # Drop consumed bytes so the buffer only holds the unfinished token
+        if self._index:
+            del self._data[:self._index]
+            self._offset += self._index
+            self._index = 0
+        return values
+
+    def close(self):
         """
-        Read from the bencoded data until the given token is found and return
-        the characters read.
+        Signals the end of the stream; raises EOFError on a truncated value.
         """
-        try:
-            occurrence = self._data.index(token, self._index)
-            result = self._data[self._index:occurrence]
-            self._index = occurrence + 1
-            return result
-        except ValueError:
-            raise RuntimeError('Unable to find token {0}'.format(
-                str(token)))
-
-    def _decode_int(self):
-        return int(self._read_until(TOKEN_END))
-
-    def _decode_list(self):
-        res = []
-        # Recursive decode the content of the list
-        while self._data[self._index: self._index + 1] != TOKEN_END:
-            res.append(self.decode())
-        self._consume()  # The END token
-        return res
-
-    def _decode_dict(self):
-        res = OrderedDict()
-        while self._data[self._index: self._index + 1] != TOKEN_END:
-            key = self.decode()
-            obj = self.decode()
-            res[key] = obj
-        self._consume()  # The END token
-        return res
-
-    def _decode_string(self):
-        bytes_to_read = int(self._read_until(TOKEN_STRING_SEPARATOR))
-        data = self._read(bytes_to_read)
-        return data
+        if self._stack or self._data:
+            raise EOFError('Unexpected end-of-file')
+
+
+def decode(data, span_keys=()):
+    """
+    Decodes a complete bencoded value from a bytes-like object.
+    """
+    return Decoder(data, span_keys).decode()
 
 
 class Encoder:
@@ -123,13 +214,15 @@ class Encoder:
     Encodes a python object to a bencoded sequence of bytes.
 
     Supported python types is:
-        - str
+        - str (encoded as UTF-8)
         - int
-        - list
-        - dict
-        - bytes
+        - list / tuple
+        - dict (keys are written sorted as raw bytes, as bencode requires;
+          keys equal as bytes, like 'a' and b'a', raise ValueError)
+        - bytes / bytearray / memoryview
 
-    Any other type will simply be ignored.
+    Output goes to a single growing buffer, or straight to a file object with
+    `encode_to`, so no intermediate copy is built per node.
     """
     def __init__(self, data):
         self._data = data
@@ -140,51 +233,69 @@ class Encoder:
 
         :return The bencoded binary data
         """
-        return self.encode_next(self._data)
-
-    def encode_next(self, data):
-        if type(data) == str:
-            return self._encode_string(data)
-        elif type(data) == int:
-            return self._encode_int(data)
-        elif type(data) == list:
-            return self._encode_list(data)
-        elif type(data) == dict or type(data) == OrderedDict:
-            return self._encode_dict(data)
-        elif type(data) == bytes:
-            return self._encode_bytes(data)
+        result = bytearray()
+        self._encode(self._data, result.extend)
+        return bytes(result)
+
+    def encode_to(self, fileobj):
+        """
+        Writes the bencoded data to `fileobj` (anything with a write method).
+        Large strings are passed through without being copied.
+        """
+        self._encode(self._data, fileobj.write)
+
+    def _encode(self, data, write):
+        if isinstance(data, (bytes, bytearray)):
+            write(b'%d:' % len(data))
+            write(data)
+        elif isinstance(data, str):
+            data = data.encode('utf-8')
+            write(b'%d:' % len(data))
+            write(data)
+        elif isinstance(data, int):
+            write(b'i%de' % data)
+        elif isinstance(data, dict):
+            write(TOKEN_DICT)
+            previous = None
+            for key, value in sorted(
+                    ((_key_bytes(k), v) for k, v in data.items()),
+                    key=_item_key):
+                if key == previous:
+                    # e.g. 'a' and b'a'; bencode dicts have unique keys
+                    raise ValueError('Duplicate dict key {0!r}'.format(key))
+                previous = key
+                write(b'%d:' % len(key))
+                write(key)
+                self._encode(value, write)
+            write(TOKEN_END)
+        elif isinstance(data, (list, tuple)):
+            write(TOKEN_LIST)
+            for item in data:
+                self._encode(item, write)
+            write(TOKEN_END)
+        elif isinstance(data, memoryview):
+            write(b'%d:' % data.nbytes)
+            write(data)
         else:
-            return None
+            raise TypeError('Cannot bencode value of type {0}'.format(
+                type(data).__name__))
 
-    def _encode_int(self, value):
-        return str.encode('i' + str(value) + 'e')
 
-    def _encode_string(self, value: str):
-        res = str(len(value)) + ':' + value
-        return str.encode(res)
+def _key_bytes(key):
+    if isinstance(key, str):
+        return key.encode('utf-8')
+    if isinstance(key, (bytes, bytearray, memoryview)):
+        return bytes(key)
+    raise TypeError('Dict keys must be strings, not {0}'.format(
+        type(key).__name__))
 
-    def _encode_bytes(self, value: str):
-        result = bytearray()
-        result += str.encode(str(len(value)))
-        result += b':'
-        result += value
-        return result
-
-    def _encode_list(self, data):
-        result = bytearray('l', 'utf-8')
-        result += b''.join([self.encode_next(item) for item in data])
-        result += b'e'
-        return result
-
-    def _encode_dict(self, data: dict) -> bytes:
-        result = bytearray('d', 'utf-8')
-        for k, v in data.items():
-            key = self.encode_next(k)
-            value = self.encode_next(v)
-            if key and value:
-                result += key
-                result += value
-            else:
-                raise RuntimeError('Bad dict')
-        result += b'e'
-        return result
+
+def _item_key(item):
+    return item[0]
+
+
+def encode(data) -> bytes:
+    """
+    Encodes a python object to bencoded bytes.
+    """
+    return Encoder(data).encode()
@@ -0,0 +1,133 @@
+from operator import add
+
+# _BIT_LANES[b][v] is bit b (0 = most significant) of byte value v
+_BIT_LANES = [bytes((value >> (7 - bit)) & 1 for value in range(256))
+              for bit in range(8)]
+
+# _SET_BITS[v] lists the set bit offsets of byte value v
+_SET_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit))
+             for value in range(256)]
+
+# Peers summed per pass in `availability`; one byte lane holds at most 255
+_LANE_LIMIT = 255
+
+
+class Bitfield:
+    """
+    Fixed-length set of piece indexes in BitTorrent wire order (piece 0 is the
+    most significant bit of the first byte).
+
+    Single bits are read and written in the backing bytearray; whole-set
+    operations (popcount, AND, AND-NOT) go through Python ints, so they run in
+    C over the entire field instead of bit by bit.
+    """
+    __slots__ = ('length', '_bytes')
+
+    def __init__(self, length, data=None):
+        self.length = length
+        size = (length + 7) // 8
+        if data is None:
+            self._bytes = bytearray(size)
+        else:
+            self._bytes = bytearray(data[:size])
+            self._bytes.extend(bytes(size - len(self._bytes)))
+            spare = size * 8 - length
+            if spare:
+                # Spare bits after the last piece must not count as pieces
+                self._bytes[-1] &= (0xff << spare) & 0xff
+
+    @classmethod
+    def full(cls, length):
+        return cls(length, b'\xff' * ((length + 7) // 8))
+
+    @classmethod
+    def from_int(cls, length, value):
+        size = (length + 7) // 8
+        return cls(length, value.to_bytes(size, 'big'))
+
+    def to_int(self) -> int:
+        return int.from_bytes(self._bytes, 'big')
+
+    def tobytes(self) -> bytes:
+        # Payload of a BITFIELD message
+        return bytes(self._bytes)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError('bitfield index out of range')
+        return bool(self._bytes[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self.length:
+            raise IndexError('bitfield index out of range')
+        if value:
+            self._bytes[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self._bytes[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitfield):
+            return NotImplemented
+        return self.length == other.length and self._bytes == other._bytes
+
+    def __and__(self, other):
+        return Bitfield.from_int(self.length, self.to_int() & other.to_int())
+
+    def __or__(self, other):
+        return Bitfield.from_int(self.length, self.to_int() | other.to_int())
+
+    def andnot(self, other):
+        """
+        Returns the pieces set here but not in `other`, e.g. the pieces a peer
+        has that we still need: peer.bitfield.andnot(have).
+        """
+        return Bitfield.from_int(self.length, self.to_int() & ~other.to_int())
+
+    def count(self) -> int:
+        return self.to_int().bit_count()
+
+    def any(self) -> bool:
+        return any(self._bytes)
+
+    def all(self) -> bool:
+        return self.count() == self.length
+
+    def indices(self):
+        """
+        Returns the set piece indexes in ascending order, skipping empty bytes.
+        """
+        result = []
+        for position, byte in enumerate(self._bytes):
+            if byte:
+                base = position * 8
+                result.extend(base + bit for bit in _SET_BITS[byte])
+        return result
+
+    def __repr__(self):
+        return f"Bitfield({self.length}, {self.count()} set)"
+
+
+def availability(bitfields, length):
+    """
+    Returns, for every piece, how many of `bitfields` have it.
+
+    Each bitfield is split into 8 byte-per-piece lanes with bytes.translate
+    and the lanes of up to 255 peers are added as one big integer (SWAR), so
+    the per-piece Python work is one addition per 255 peers.
+    """
+    counts = [0] * length
+    size = (length + 7) // 8
+    for start in range(0, len(bitfields), _LANE_LIMIT):
+        chunk = bitfields[start:start + _LANE_LIMIT]
+        for bit in range(8):
+            table = _BIT_LANES[bit]
+            total = 0
+            for bitfield in chunk:
+                total += int.from_bytes(bitfield._bytes.translate(table), 'big')
+            lanes = total.to_bytes(size, 'big')
+            pieces = counts[bit::8]
+            counts[bit::8] = map(add, pieces, lanes[:len(pieces)])
+    return counts
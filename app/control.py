@@ -0,0 +1,70 @@
+import os
+
+# CLI commands a running daemon answers in place of the CLI
+FORWARDED_COMMANDS = ('info', 'peers', 'handshake', 'download_piece', 'download')
+
+# Longest request or response line accepted on the control socket
+MAX_LINE_LENGTH = 16 * 2**20  # 16 MB
+
+
+def socket_path():
+    """
+    Path of the daemon's control socket: $BITTORRENT_SOCKET, or a per-user
+    socket in $XDG_RUNTIME_DIR (or $TMPDIR, /tmp).
+    """
+    path = os.environ.get('BITTORRENT_SOCKET')
+    if path:
+        return path
+    directory = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR', '/tmp')
+    return os.path.join(directory, f'bittorrent-{os.getuid()}.sock')
+
+
+def encode_message(message) -> bytes:
+    import json
+
+    # One JSON object per line
+    return json.dumps(message).encode('utf-8') + b'\n'
+
+
+def decode_message(line):
+    import json
+
+    return json.loads(line)
+
+
+def request(command, args, path=None):
+    """
+    Sends one command to the daemon and returns its response, a dict with
+    `status`, `output` and `error`. Returns None when no daemon is listening,
+    so the caller runs the command itself.
+
+    Only the standard library is used here, and only once a socket exists,
+    so checking for a daemon costs a stat and forwarding little more than
+    interpreter startup.
+    """
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    # The C module directly: socket.py imports enum and selectors, which
+    # would take longer than the whole request
+    import _socket
+
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except OSError:
+            return None  # A stale socket left behind by a daemon that died
+        sock.sendall(encode_message({'command': command, 'args': list(args),
+                                     'cwd': os.getcwd()}))
+        response = bytearray()
+        while not response.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("Daemon closed the control connection mid-response")
+            response += chunk
+            if len(response) > MAX_LINE_LENGTH:
+                raise ValueError("Daemon response exceeds MAX_LINE_LENGTH")
+        return decode_message(response)
+    finally:
+        sock.close()
@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .bencoding import Encoder
+from .torrent import HASH_LENGTH, is_safe_component
+
+logger = logging.getLogger(__name__)
+
+# Automatic piece lengths aim for about this many pieces: enough to spread a
+# download over many peers, few enough to keep .torrent files small
+TARGET_PIECES = 1500
+
+# Bounds of the automatic piece length, both powers of two
+MIN_PIECE_LENGTH = 2**15  # 32 KB
+MAX_PIECE_LENGTH = 2**24  # 16 MB
+
+# Piece buffers read ahead of the hashers are limited to this many bytes,
+# and to a few per worker, so memory use is flat however large the data
+MAX_BUFFER_BYTES = 256 * 2**20  # 256 MB
+BUFFERS_PER_WORKER = 4
+
+# Seconds between progress log lines
+PROGRESS_INTERVAL = 2.0
+
+# Written to the 'created by' field
+CREATED_BY = 'BitTorrent-client'
+
+
+def piece_length_for(total_length):
+    """
+    Returns the smallest power of two that splits `total_length` bytes into
+    at most TARGET_PIECES pieces, within MIN_ and MAX_PIECE_LENGTH.
+    """
+    length = MIN_PIECE_LENGTH
+    while length < MAX_PIECE_LENGTH and length * TARGET_PIECES < total_length:
+        length *= 2
+    return length
+
+
+def find_files(path):
+    """
+    Returns (path, length, components) for the regular files to include
+    from `path`, a file or a directory walked in sorted order, where
+    `components` is the file's path below the directory.
+    """
+    if not os.path.isdir(path):
+        return [(path, os.path.getsize(path), [os.path.basename(path)])]
+    files = []
+    for directory, subdirectories, names in os.walk(path):
+        subdirectories.sort()
+        for name in sorted(names):
+            file_path = os.path.join(directory, name)
+            if not os.path.isfile(file_path):
+                continue  # Sockets, FIFOs and broken links
+            relative = os.path.relpath(file_path, path)
+            files.append((file_path, os.path.getsize(file_path), relative.split(os.sep)))
+    return files
+
+
+def hash_pieces(files, piece_length, workers=None, progress=None) -> bytes:
+    """
+    Returns the concatenated SHA-1 hashes of the pieces of `files`, a list
+    of (path, length) read back to back as one stream.
+
+    This thread reads the files sequentially, which suits any disk, into
+    buffers from a fixed pool; pieces spanning files are filled from both.
+    Full buffers are hashed on `workers` (default one per core) threads,
+    which hashlib lets run in parallel, and go back to the pool. `progress`
+    is called with the bytes hashed so far.
+    """
+    workers = workers or os.cpu_count() or 1
+    total = sum(length for _, length in files)
+    num_pieces = (total + piece_length - 1) // piece_length
+    digests = bytearray(num_pieces * HASH_LENGTH)
+    buffers = max(2, min(workers * BUFFERS_PER_WORKER, MAX_BUFFER_BYTES // piece_length))
+    free = queue.Queue()
+    for _ in range(buffers):
+        free.put(bytearray(piece_length))
+    lock = threading.Lock()
+    hashed = [0]
+    errors = []
+
+    def hash_piece(index, buffer, length):
+        try:
+            digest = hashlib.sha1(memoryview(buffer)[:length]).digest()
+            digests[index * HASH_LENGTH:(index + 1) * HASH_LENGTH] = digest
+            with lock:
+                hashed[0] += length
+        except Exception as e:
+            errors.append(e)
+        finally:
+            free.put(buffer)
+
+    started = reported = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='creator') as executor:
+        for index, buffer, length in _read_pieces(files, piece_length, free):
+            executor.submit(hash_piece, index, buffer, length)
+            if progress:
+                progress(hashed[0])
+            now = time.perf_counter()
+            if now - reported >= PROGRESS_INTERVAL:
+                reported = now
+                logger.info("Hashed %.1f of %.1f GB (%.0f%%) at %.2f GB/s",
+                            hashed[0] / 2**30, total / 2**30, 100 * hashed[0] / total,
+                            hashed[0] / (now - started) / 2**30)
+    if errors:
+        raise errors[0]
+    if progress:
+        progress(hashed[0])
+    return bytes(digests)
+
+
+def create_torrent(path, announce=None, piece_length=None, comment=None,
+                   private=False, workers=None, progress=None):
+    """
+    Returns the metainfo dict of a torrent of `path`, a file or directory.
+
+    `announce` is a tracker URL or a list of tiers, each a list of URLs
+    (BEP 12); the first URL also becomes `announce`, and `announce-list`
+    is written when there is more than one. `piece_length` defaults to
+    piece_length_for the total size. See hash_pieces for `workers` and
+    `progress`.
+    """
+    # '.' and 'dir/' name the directory itself; '/' has no name to use
+    name = os.path.basename(os.path.abspath(path))
+    if not is_safe_component(name):
+        raise ValueError(f"Cannot name a torrent after {path!r}")
+    files = find_files(path)
+    total = sum(length for _, length, _ in files)
+    if not total:
+        raise ValueError(f"Nothing to share in {path}")
+    piece_length = piece_length or piece_length_for(total)
+    if piece_length <= 0 or piece_length & (piece_length - 1):
+        raise ValueError("Piece length must be a power of two")
+
+    started = time.perf_counter()
+    pieces = hash_pieces([(file_path, length) for file_path, length, _ in files],
+                         piece_length, workers, progress)
+    elapsed = time.perf_counter() - started
+    logger.info("Hashed %d pieces of %d bytes in %.2f s (%.2f GB/s)",
+                len(pieces) // HASH_LENGTH, piece_length, elapsed,
+                total / max(elapsed, 1e-9) / 2**30)
+
+    info = {b'name': name, b'piece length': piece_length, b'pieces': pieces}
+    if os.path.isdir(path):
+        info[b'files'] = [{b'length': length, b'path': components}
+                          for _, length, components in files]
+    else:
+        info[b'length'] = total
+    if private:
+        info[b'private'] = 1
+
+    metainfo = {b'info': info, b'created by': CREATED_BY,
+                b'creation date': int(time.time())}
+    if isinstance(announce, str):
+        announce = [[announce]]
+    tiers = [list(tier) for tier in announce or () if tier]
+    if tiers:
+        metainfo[b'announce'] = tiers[0][0]
+        if sum(len(tier) for tier in tiers) > 1:
+            metainfo[b'announce-list'] = tiers
+    if comment:
+        metainfo[b'comment'] = comment
+    return metainfo
+
+
+def write_torrent(metainfo, output_path):
+    """
+    Writes `metainfo` as a .torrent file, streaming the piece hashes to
+    disk without another copy.
+    """
+    with open(output_path, 'wb') as f:
+        Encoder(metainfo).encode_to(f)
+
+
+def _read_pieces(files, piece_length, free):
+    # Yields (index, buffer, length) for every piece, filling buffers from
+    # the pool; blocks while all of them are being hashed
+    index = 0
+    buffer = free.get()
+    filled = 0
+    for path, length in files:
+        remaining = length
+        with open(path, 'rb', buffering=0) as f:
+            while remaining:
+                view = memoryview(buffer)[filled:filled + min(remaining, piece_length - filled)]
+                read = f.readinto(view)
+                view.release()
+                if not read:
+                    raise ValueError(f"{path} shrank while it was being hashed")
+                filled += read
+                remaining -= read
+                if filled == piece_length:
+                    yield index, buffer, filled
+                    index += 1
+                    buffer = free.get()
+                    filled = 0
+    if filled:
+        yield index, buffer, filled
+    else:
+        free.put(buffer)
@@ -0,0 +1,290 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from .control import (
+    FORWARDED_COMMANDS, MAX_LINE_LENGTH, decode_message, encode_message, socket_path)
+from .protocol_new import PeerConnection
+from .session import Session, plan_downloads
+from .torrent import Torrent
+from .tracker import Tracker
+
+logger = logging.getLogger(__name__)
+
+# Idle peer connections are closed after this many seconds; peers drop
+# silent connections after about two minutes anyway
+IDLE_PEER_TIMEOUT = 90
+
+# Idle connections kept per torrent for download_piece and handshake
+MAX_IDLE_PEERS = 8
+
+
+class Daemon:
+    """
+    Long-running process that answers CLI commands over a Unix socket.
+
+    It keeps parsed torrents (until the file changes), tracker responses
+    (for the tracker's interval) and connected, unchoked peers warm between
+    commands, so a repeated `info`, `peers` or `download_piece` costs a
+    round trip on the socket instead of interpreter startup, imports, an
+    announce and a handshake. Downloads run in one long-lived Session.
+
+    The protocol is one JSON object per line each way: the request carries
+    `command`, `args` as on the command line and the client's `cwd`; the
+    response `status` (the exit code), `output` (stdout) and `error`.
+    `download_limit` and `upload_limit` (bytes per second) apply to the
+    session's downloads.
+    """
+    def __init__(self, path=None, download_limit=None, upload_limit=None):
+        self.path = path or socket_path()
+        self.session = Session(download_limit=download_limit, upload_limit=upload_limit)
+        # Absolute path -> ((mtime, size), Torrent)
+        self._torrents = {}
+        # Info hash -> Tracker, and -> (expiry, TrackerResponse)
+        self._trackers = {}
+        self._peer_lists = {}
+        # Info hash -> {(ip, port): (PeerConnection, last used)}
+        self._idle_peers = {}
+        self._server = None
+        self._stopped = None
+        self.started = None
+        self.commands = 0
+
+    async def run(self):
+        """
+        Serves the control socket until a `stop` command or cancellation.
+        """
+        self._stopped = asyncio.Event()
+        await self.start()
+        try:
+            await self._stopped.wait()
+        finally:
+            await self.close()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            if await self._socket_alive():
+                raise RuntimeError(f"A daemon is already listening on {self.path}")
+            os.unlink(self.path)  # Left behind by a daemon that died
+        await self.session.start()
+        # Created owner-only: a socket chmodded after bind would let other
+        # users connect in between, e.g. in /tmp, and run commands as us.
+        # The umask is process-wide, so it is restored right away
+        umask = os.umask(0o077)
+        try:
+            self._server = await asyncio.start_unix_server(
+                self._handle, self.path, limit=MAX_LINE_LENGTH)
+        finally:
+            os.umask(umask)
+        self.started = time.monotonic()
+        logger.info("Daemon listening on %s", self.path)
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        for peers in self._idle_peers.values():
+            for peer, _ in peers.values():
+                peer.close()
+        self._idle_peers.clear()
+        for tracker in self._trackers.values():
+            await tracker.close()
+        await self.session.close()
+
+    async def _socket_alive(self):
+        try:
+            _, writer = await asyncio.open_unix_connection(self.path)
+        except OSError:
+            return False
+        writer.close()
+        return True
+
+    async def _handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            request = decode_message(line)
+            response = await self.execute(request['command'], request.get('args', []),
+                                          request.get('cwd') or os.getcwd())
+            writer.write(encode_message(response))
+            await writer.drain()
+        except (ConnectionError, ValueError, KeyError) as e:
+            logger.warning("Bad control request: %s", e)
+        finally:
+            writer.close()
+
+    async def execute(self, command, args, cwd):
+        """
+        Runs one command and returns its response dict.
+        """
+        self.commands += 1
+        if command not in FORWARDED_COMMANDS + ('status', 'stop'):
+            return _response(2, error=f"Unknown command {command}")
+        handler = getattr(self, f'_command_{command}')
+        try:
+            return await handler(args, cwd)
+        except Exception as e:
+            logger.info("Command %s %s failed: %s", command, args, e)
+            return _response(1, error=f"{type(e).__name__}: {e}")
+
+    async def _command_info(self, args, cwd):
+        torrent = self._torrent(os.path.join(cwd, args[0]))
+        return _response(output=f"{torrent}\n")
+
+    async def _command_peers(self, args, cwd):
+        torrent = self._torrent(os.path.join(cwd, args[0]))
+        response = await self._peers(torrent)
+        return _response(output=f"{response}\n")
+
+    async def _command_handshake(self, args, cwd):
+        torrent = self._torrent(os.path.join(cwd, args[0]))
+        ip, port = args[1].split(':')
+        address = (ip, int(port))
+        idle = self._idle_peers.get(torrent.info_hash, {})
+        if address in idle and _usable(idle[address][0]):
+            peer = idle[address][0]
+        else:
+            peer = PeerConnection(torrent, *address)
+            try:
+                await peer.connect(handshake_only=True)
+            finally:
+                peer.close()
+        return _response(output=f"Peer ID: {peer.peer_id.hex()}\n")
+
+    async def _command_download_piece(self, args, cwd):
+        output_path, torrent_path, piece_index = args[1], args[2], int(args[3])
+        torrent = self._torrent(os.path.join(cwd, torrent_path))
+        peer = await self._acquire_peer(torrent)
+        try:
+            piece_data = await peer.download_piece(piece_index)
+        except Exception as e:
+            peer.close()
+            return _response(output=f"An error occurred: {e}\n")
+        self._release_peer(torrent, peer)
+        with open(os.path.join(cwd, output_path), 'wb') as f:
+            f.write(piece_data)
+        return _response(output=f"Piece {piece_index} downloaded to {output_path}\n")
+
+    async def _command_download(self, args, cwd):
+        output_path = os.path.join(cwd, args[1])
+        plan, single = plan_downloads([os.path.join(cwd, path) for path in args[2:]],
+                                      output_path)
+        entries = []
+        try:
+            for _, torrent, target in plan:
+                entries.append(self.session.add_torrent(torrent, target))
+            await self.session.run(entries)
+        finally:
+            for entry in entries:
+                await self.session.remove_torrent(entry)
+
+        lines, errors = [], []
+        for (torrent_path, _, _), entry in zip(plan, entries):
+            # A single download echoes the paths as given, like the CLI
+            if single:
+                torrent_path, target = args[2], args[1]
+            else:
+                torrent_path, target = (_display(torrent_path, cwd),
+                                        _display(entry.output_path, cwd))
+            if entry.error:
+                errors.append(f"{torrent_path}: {type(entry.error).__name__}: {entry.error}")
+            elif entry.complete:
+                lines.append(f"Downloaded {torrent_path} to {target}.\n")
+            else:
+                errors.append(f"{torrent_path}: download is incomplete")
+        return _response(1 if errors else 0, output=''.join(lines),
+                         error='\n'.join(errors))
+
+    async def _command_status(self, args, cwd):
+        status = {
+            'socket': self.path,
+            'uptime': time.monotonic() - self.started,
+            'commands': self.commands,
+            'torrents_cached': len(self._torrents),
+            'peer_lists_cached': len(self._peer_lists),
+            'idle_peers': sum(len(peers) for peers in self._idle_peers.values()),
+            'downloading': [entry.torrent.name for entry in self.session.torrents.values()],
+        }
+        return _response(output=json.dumps(status, indent=2) + "\n")
+
+    async def _command_stop(self, args, cwd):
+        self._stopped.set()
+        return _response(output="Daemon stopping.\n")
+
+    def _torrent(self, path):
+        # Parsed metadata, re-read only when the file changed
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._torrents.get(path)
+        if cached is None or cached[0] != key:
+            cached = self._torrents[path] = (key, Torrent(path))
+        return cached[1]
+
+    async def _peers(self, torrent):
+        # The tracker's answer, reused until it asks us to announce again
+        cached = self._peer_lists.get(torrent.info_hash)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        tracker = self._trackers.get(torrent.info_hash)
+        if tracker is None:
+            tracker = self._trackers[torrent.info_hash] = Tracker(
+                torrent, http_client=self.session.http_client,
+                port=self.session.server.port, udp_client=self.session.udp_client)
+        response = await tracker.connect()
+        self._peer_lists[torrent.info_hash] = (time.monotonic() + tracker.interval, response)
+        return response
+
+    async def _acquire_peer(self, torrent):
+        """
+        Returns a connected, interested peer for `torrent`: an idle one when
+        possible, else a new connection to the first tracker peer that
+        accepts.
+        """
+        idle = self._idle_peers.setdefault(torrent.info_hash, {})
+        now = time.monotonic()
+        for address, (peer, last_used) in list(idle.items()):
+            del idle[address]
+            if _usable(peer) and now - last_used < IDLE_PEER_TIMEOUT:
+                return peer
+            peer.close()
+
+        last_error = None
+        for ip, port in (await self._peers(torrent)).peers:
+            peer = PeerConnection(torrent, ip, port)
+            try:
+                await peer.connect()
+                await peer.send_interested()
+                return peer
+            except Exception as e:
+                peer.close()
+                last_error = e
+        raise last_error or ConnectionError("The tracker returned no peers")
+
+    def _release_peer(self, torrent, peer):
+        idle = self._idle_peers.setdefault(torrent.info_hash, {})
+        if len(idle) >= MAX_IDLE_PEERS:
+            peer.close()
+            return
+        idle[(peer.ip, peer.port)] = (peer, time.monotonic())
+
+
+def _usable(peer):
+    # Still connected, as far as we know without sending anything
+    return (peer.wire is not None and peer.wire.error is None
+            and not peer.transport.is_closing())
+
+
+def _display(path, cwd):
+    # Relative to the client's directory when inside it
+    relative = os.path.relpath(path, cwd)
+    return path if relative.startswith(os.pardir) else relative
+
+
+def _response(status=0, output='', error=''):
+    return {'status': status, 'output': output, 'error': error}
@@ -1,71 +1,626 @@
 
 import asyncio
+import logging
+import time
 from collections import deque
-from .protocol_new import PeerConnection
+from functools import partial
+from .protocol_new import BLOCK_SIZE, DEFAULT_PIPELINE_DEPTH, PeerConnection, SNUB_TIMEOUT
+from .piece_picker import PiecePicker
+from .storage import Storage
+from .hasher import PieceVerifier
+from .peers import PeerList, address_key
+from .bitfield import Bitfield
+from .bandwidth import Bandwidth
+from .resume import ResumeJournal, resume_path
+from .metrics import REGISTRY, Counter, Gauge, counter, histogram
+
+logger = logging.getLogger(__name__)
+
+# Connection attempts allowed to be in flight at the same time
+DEFAULT_MAX_CONNECTING = 25
+
+# Connected peers we keep download sessions running with
+DEFAULT_MAX_PEERS = 50
+
+# Seconds between syncing the pieces written and checkpointing the resume
+# journal; after a crash, pieces written since are re-hashed
+CHECKPOINT_INTERVAL = 10
+
+# Pieces read back and re-hashed at once when resuming
+RESUME_VERIFY_BATCH = 16
+
+# Endgame starts once every missing block has been requested and fewer
+# than this many are still outstanding across all peers (two pipelines'
+# worth). Earlier, duplicate requests would race whole pieces and waste
+# bandwidth, which on small torrents means from the very first pick.
+ENDGAME_BLOCKS = 2 * DEFAULT_PIPELINE_DEPTH
+
+# Peers joining or leaving between two picks from which availability is
+# recounted in one pass over every bitfield (PiecePicker.rebuild) rather
+# than updated piece by piece for each of them
+REBUILD_AVAILABILITY_CHANGES = 2
+
+# Instrumentation, exported by app.metrics
+PEER_CONNECTS = counter('bittorrent_peer_connects_total',
+                        'Outbound peer connection attempts by result', ('result',))
+_CONNECTED = PEER_CONNECTS.labels('connected')
+_CONNECT_FAILED = PEER_CONNECTS.labels('failed')
+PICK_SECONDS = histogram('bittorrent_pick_seconds',
+                         'Time spent choosing the next piece for a peer')
+PIECES_FAILED = counter('bittorrent_pieces_failed_total',
+                        'Downloaded pieces that failed hash verification')
+ENDGAME_TRANSITIONS = counter('bittorrent_endgame_transitions_total',
+                              'Times a download entered or left endgame mode',
+                              ('event',))
+_ENDGAME_ENTERED = ENDGAME_TRANSITIONS.labels('entered')
+_ENDGAME_LEFT = ENDGAME_TRANSITIONS.labels('left')
+PEER_SNUBS = counter('bittorrent_peer_snubs_total',
+                     'Times a peer answered none of our requests for SNUB_TIMEOUT')
 
 class DownloadManager:
-    def __init__(self, torrent):
+    """
+    Downloads one torrent from many peers at once.
+
+    On its own a manager owns its hashing and disk writer pools. A Session
+    running many torrents passes in its shared `verifier` and `disk_executor`
+    instead, which the manager then leaves open on `close`.
+
+    With `resume`, the pieces written are kept in a journal next to the
+    output (see app.resume), so a restarted download picks up where the
+    last one stopped without re-hashing what is on disk. Blocks of
+    unfinished pieces are saved too when the download is closed.
+    """
+    def __init__(self, torrent, output_path=None,
+                 max_connecting=DEFAULT_MAX_CONNECTING,
+                 max_peers=DEFAULT_MAX_PEERS, bandwidth=None,
+                 verifier=None, disk_executor=None, resume=True):
         self.torrent = torrent
         self.peers = deque()
-        self.pieces = [False] * len(self.torrent.pieces)
+        # (ip, port) pairs waiting for a connection slot
+        self.candidates = deque()
+        self.max_connecting = max_connecting
+        self.max_peers = max_peers
+        # Compact keys (see app.peers) of every peer ever queued
+        self._known = set()
+        self._connecting = set()
+        self._sessions = set()
+        self._changed = asyncio.Event()
+        # Peers whose pieces the picker has yet to add, and bitfields of
+        # counted peers it has yet to remove; see _sync_availability
+        self._peers_joined = []
+        self._peers_left = []
+        # Peers currently downloading each piece, used to cancel duplicates
+        self._downloading = {}
+        self.in_endgame = False
+        self.endgame_started = None
+        self.endgame_seconds = 0.0
+        self.endgame_requests = 0
+        self.endgame_cancelled = 0
+        # Pieces we have verified and that are on disk, so they can be served;
+        # the picker also knows those still being written
+        self.pieces = Bitfield(self.torrent.num_pieces)
         self.downloaded_pieces = 0
+        # Verified payload bytes, reported to trackers
+        self.downloaded = 0
+        # Payload bytes found on disk from a previous run
+        self.resumed = 0
+        self.uploaded = 0
+        # Called with the piece index whenever a piece is verified and stored
+        self.on_piece = None
+        # Limits for this torrent, below the global ones when `bandwidth` is
+        # given; every peer gets its own level below this one
+        self.bandwidth = bandwidth.child() if bandwidth else Bandwidth()
+        self.picker = PiecePicker(len(self.pieces))
+        self._owns_verifier = verifier is None
+        self.verifier = verifier or PieceVerifier()
+        self.storage = None
+        if output_path:
+            self.storage = Storage.for_torrent(torrent, output_path,
+                                               executor=disk_executor)
+            self.storage.open()
+        self.journal = None
+        if self.storage and resume:
+            self.journal = ResumeJournal(resume_path(torrent, output_path), torrent,
+                                         self.storage.layout, self.storage.paths)
+        self._resumed = False
+        # Blocks of unfinished pieces, from released peers or a previous run:
+        # index -> (piece buffer, offsets of the blocks in it)
+        self._partial = {}
+        # Offsets of the blocks of unfinished pieces written to disk
+        self._saved_blocks = {}
+        REGISTRY.add_collector(self._collect_metrics)
+
+    @property
+    def left(self) -> int:
+        # Payload bytes still to download
+        return self.torrent.file_size - self.downloaded - self.resumed
+
+    @property
+    def needs_peers(self) -> bool:
+        # Nothing left to connect to and fewer peers than we could use
+        return (not self.candidates and self.left > 0
+                and len(self.peers) < self.max_peers // 2)
+
+    def add_candidates(self, peers):
+        """
+        Queues (ip, port) pairs to connect to once start_download runs.
+        Peers seen before are skipped; a PeerList is filtered on its compact
+        keys before any address is formatted.
+        """
+        if not isinstance(peers, PeerList):
+            peers = PeerList(address_key(ip, port) for ip, port in peers)
+        new = peers.difference(self._known)
+        self._known.update(new.keys())
+        self.candidates.extend(new)
+        self._changed.set()
+
+    def set_connection_limits(self, max_peers, max_connecting):
+        """
+        Changes how many peers this torrent may use, e.g. when a Session
+        rebalances its connection budget. Raising the limits opens slots
+        right away; lowering them only holds back new connections.
+        """
+        self.max_peers = max_peers
+        self.max_connecting = max_connecting
+        self._changed.set()
 
     async def add_peer(self, ip, port):
-        peer = PeerConnection(self.torrent, ip, port)
+        peer = await self._connect_peer(ip, port)
+        if peer is None:
+            return False
+        self._register_peer(peer)
+        return True
+
+    async def resume(self):
+        """
+        Takes over the pieces a previous run left on disk, as far as the
+        resume journal vouches for them, and starts a fresh journal. Pieces
+        written after the journal's last checkpoint are re-hashed first.
+        start_download calls this unless it already ran, e.g. to announce
+        the right number of bytes left.
+        """
+        if self._resumed or not self.journal:
+            return
+        self._resumed = True
+        started = time.monotonic()
+        state = self.journal.load()
+        for index in state.have:
+            self._mark_resumed(index)
+        verified = 0
+        for start in range(0, len(state.verify), RESUME_VERIFY_BATCH):
+            batch = state.verify[start:start + RESUME_VERIFY_BATCH]
+            for index, valid in zip(batch, await asyncio.gather(
+                    *(self._verify_on_disk(index) for index in batch))):
+                if valid:
+                    self._mark_resumed(index)
+                    verified += 1
+        for index, begins in state.partial.items():
+            if not self.pieces[index]:
+                data = await self.storage.read(index, 0, self.torrent.piece_size(index))
+                self._partial[index] = (data, frozenset(begins))
+                self._saved_blocks[index] = begins
+        self.journal.open(self.pieces.indices(), self._saved_blocks)
+        if self.downloaded_pieces or self._partial:
+            logger.info("Resumed %d pieces (%d re-hashed) and %d partial pieces of %s "
+                        "in %.2f s", self.downloaded_pieces, verified, len(self._partial),
+                        self.torrent.name, time.monotonic() - started)
+
+    async def start_download(self):
+        await self.resume()
+        logger.info("Starting download of %s", self.torrent.name)
+        # Peers added with add_peer are already connected
+        for peer in self.peers:
+            self._start_session(peer)
+        checkpoints = None
+        if self.journal:
+            checkpoints = asyncio.create_task(self._checkpoint_periodically())
+
+        # Connect to candidates concurrently, starting each peer's session as
+        # soon as its handshake completes, and refill slots as peers drop
+        try:
+            while self.downloaded_pieces < len(self.pieces):
+                self._fill_connection_slots()
+                if not self._connecting and not self._sessions:
+                    logger.warning("No more peers to download from.")
+                    break
+                self._changed.clear()
+                await self._changed.wait()
+        finally:
+            if checkpoints:
+                checkpoints.cancel()
+                await asyncio.gather(checkpoints, return_exceptions=True)
+        await self._stop_sessions()
+
+        if self.storage:
+            await self.storage.flush()
+            if self.journal:
+                self.journal.checkpoint(self._saved_blocks)
+            logger.info("Wrote %d bytes at %.1f MB/s disk throughput",
+                        self.storage.bytes_written, self.storage.write_rate / 2**20)
+        if self._owns_verifier:
+            # A shared verifier reports for the whole session instead
+            logger.info("Verified %d pieces, %.2f ms hash time and %.2f ms latency per piece",
+                        self.verifier.pieces_hashed,
+                        self.verifier.average_hash_time * 1000,
+                        self.verifier.average_latency * 1000)
+
+    async def close(self):
+        REGISTRY.remove_collector(self._collect_metrics)
+        # Sessions outlive a cancelled start_download; stopping them keeps
+        # the blocks of their unfinished pieces
+        await self._stop_sessions()
+        for peer in list(self.peers):
+            self._remove_peer(peer)
+        try:
+            if self.journal and self._resumed:
+                await self._save_partial_pieces()
+        except OSError as e:
+            logger.warning("Could not save unfinished pieces of %s: %s",
+                           self.torrent.name, e)
+        finally:
+            if self.journal:
+                self.journal.close()
+            if self._owns_verifier:
+                self.verifier.close()
+            if self.storage:
+                await self.storage.close()
+
+    async def _stop_sessions(self):
+        for task in list(self._connecting | self._sessions):
+            task.cancel()
+        await asyncio.gather(*self._connecting, *self._sessions,
+                             return_exceptions=True)
+
+    def _mark_resumed(self, index):
+        self.pieces[index] = True
+        self.picker.complete(index)
+        self.downloaded_pieces += 1
+        self.resumed += self.torrent.piece_size(index)
+
+    async def _verify_on_disk(self, index):
+        data = await self.storage.read(index, 0, self.torrent.piece_size(index))
+        return await self.verifier.verify(data, self.torrent.piece_hash(index))
+
+    async def _checkpoint_periodically(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            if not self.journal.dirty:
+                continue
+            try:
+                await self.storage.flush()
+                self.journal.checkpoint(self._saved_blocks)
+            except OSError as e:
+                logger.warning("Could not checkpoint the resume journal: %s", e)
+
+    async def _save_partial_pieces(self):
+        """
+        Writes the blocks of unfinished pieces that are not on disk yet and
+        records them, so the next run only requests the rest.
+        """
+        saved = []
+        for index, (data, begins) in self._partial.items():
+            on_disk = set(self._saved_blocks.get(index, ()))
+            new = sorted(begins - on_disk)
+            if self.pieces[index] or not new:
+                continue
+            view = memoryview(data)
+            for begin in new:
+                await self.storage.write_block(index, begin, view[begin:begin + BLOCK_SIZE])
+            self._saved_blocks[index] = sorted(begins)
+            saved.append(index)
+        await self.storage.flush()
+        for index in saved:
+            self.journal.record_blocks(index, self._saved_blocks[index])
+        self.journal.checkpoint(self._saved_blocks)
+        if saved:
+            logger.info("Saved blocks of %d unfinished pieces", len(saved))
+
+    def _collect_metrics(self):
+        """
+        Builds this torrent's metrics at scrape time from the counters the
+        connections keep anyway.
+        """
+        torrent = (self.torrent.name,)
+        downloaded = Counter('bittorrent_downloaded_bytes_total',
+                             'Verified payload bytes downloaded', ('torrent',))
+        downloaded.labels(*torrent).value = self.downloaded
+        uploaded = Counter('bittorrent_uploaded_bytes_total',
+                           'Payload bytes uploaded', ('torrent',))
+        uploaded.labels(*torrent).value = self.uploaded
+        pieces = Gauge('bittorrent_pieces', 'Pieces we have', ('torrent',))
+        pieces.labels(*torrent).set(self.downloaded_pieces)
+        peers = Gauge('bittorrent_peers', 'Connected download peers', ('torrent',))
+        peers.labels(*torrent).set(len(self.peers))
+        endgame_requests = Counter('bittorrent_endgame_requests_total',
+                                   'Duplicate piece requests made in endgame mode',
+                                   ('torrent',))
+        endgame_requests.labels(*torrent).value = self.endgame_requests
+        endgame_cancelled = Counter('bittorrent_endgame_cancelled_total',
+                                    'Duplicate piece downloads cancelled in endgame mode',
+                                    ('torrent',))
+        endgame_cancelled.labels(*torrent).value = self.endgame_cancelled
+
+        labels = ('torrent', 'peer')
+        received = Counter('bittorrent_peer_received_bytes_total',
+                           'Bytes received from each peer', labels)
+        sent = Counter('bittorrent_peer_sent_bytes_total',
+                       'Bytes sent to each peer', labels)
+        rate = Gauge('bittorrent_peer_download_rate_bytes',
+                     'Measured delivery rate of each peer in bytes per second', labels)
+        depth = Gauge('bittorrent_peer_pipeline_depth',
+                      'Requests kept in flight to each peer', labels)
+        for peer in self.peers:
+            if peer.wire is None:
+                continue
+            key = torrent + (f"{peer.ip}:{peer.port}",)
+            received.labels(*key).value = peer.wire.bytes_received
+            sent.labels(*key).value = peer.wire.bytes_sent
+            rate.labels(*key).set(peer.download_rate)
+            depth.labels(*key).set(peer.pipeline_depth)
+        return [downloaded, uploaded, pieces, peers, endgame_requests, endgame_cancelled,
+                received, sent, rate, depth]
+
+    def _fill_connection_slots(self):
+        while (self.candidates
+               and len(self._connecting) < self.max_connecting
+               and len(self._connecting) + len(self.peers) < self.max_peers):
+            ip, port = self.candidates.popleft()
+            task = asyncio.create_task(self._connect_candidate(ip, port))
+            self._connecting.add(task)
+            task.add_done_callback(self._connect_done)
+
+    async def _connect_candidate(self, ip, port):
+        peer = await self._connect_peer(ip, port)
+        if peer is not None:
+            self._register_peer(peer)
+            self._start_session(peer)
+
+    def _connect_done(self, task):
+        self._connecting.discard(task)
+        self._changed.set()
+
+    async def _connect_peer(self, ip, port):
+        peer = PeerConnection(self.torrent, ip, port, verifier=self.verifier,
+                              bandwidth=self.bandwidth.child())
         try:
             await peer.connect()
-            self.peers.append(peer)
-            return True
+            _CONNECTED.inc()
+            return peer
         except Exception as e:
-            print(f"Failed to connect to peer {ip}:{port}: {e}")
-            return False
+            _CONNECT_FAILED.inc()
+            logger.info("Failed to connect to peer %s:%d: %s", ip, port, e)
+            peer.close()
+            return None
 
-    async def start_download(self):
-        print("Starting download...")
-        # Get peers from tracker
-        # For now, we'll assume peers are added manually
+    def _register_peer(self, peer):
+        self.peers.append(peer)
+        self._peers_joined.append(peer)
 
-        # Create a task for each peer to download pieces
-        tasks = [self._start_peer_session(peer) for peer in self.peers]
-        await asyncio.gather(*tasks)
+    def _start_session(self, peer):
+        task = asyncio.create_task(self._run_peer_session(peer))
+        self._sessions.add(task)
+        task.add_done_callback(self._session_done)
+
+    def _session_done(self, task):
+        self._sessions.discard(task)
+        self._changed.set()
+
+    async def _run_peer_session(self, peer):
+        try:
+            await self._start_peer_session(peer)
+        except Exception as e:
+            logger.info("Lost connection to peer %s: %s", peer.ip, e)
+        finally:
+            self._remove_peer(peer)
 
     async def _start_peer_session(self, peer):
         await peer.send_interested()
 
-        while self.downloaded_pieces < len(self.pieces):
-            if peer.peer_choking:
-                # If the peer is choking us, wait for an unchoke message
-                msg_id, _ = await peer._receive_message()
-                if msg_id == 1: # Unchoke
-                    peer.peer_choking = False
-                else:
-                    # Handle other messages if necessary
+        try:
+            while self.downloaded_pieces < len(self.pieces):
+                if peer.peer_choking and not peer.active_pieces:
+                    # If the peer is choking us, wait for an unchoke message
+                    msg_id, payload = await peer._receive_message()
+                    peer._handle_message(msg_id, payload)
+                    continue
+
+                # Keep enough pieces in flight to fill the peer's pipeline
+                self._request_pieces(peer)
+                if not peer.active_pieces:
+                    # No available pieces to download from this peer for now
+                    # In a real client, we might wait or try another peer
+                    await asyncio.sleep(1) # a small delay
                     continue
 
-            # Find a piece to download
+                timeouts = peer.timeouts
+                for piece_index, piece_data in await peer.transfer():
+                    self._forget_download(piece_index, peer)
+                    if piece_data is None:
+                        PIECES_FAILED.inc()
+                        self._forget_blocks(piece_index)
+                        logger.warning("Error downloading piece %d from peer %s: "
+                                       "failed verification", piece_index, peer.ip)
+                        # Release the piece so another peer can try
+                        self.picker.abort(piece_index)
+                        # It might be good to disconnect from this peer if it consistently fails
+                        return
+                    await self._store_piece(peer, piece_index, piece_data)
+                if peer.timeouts != timeouts:
+                    # Snubbed; let faster peers have its pieces
+                    PEER_SNUBS.inc()
+                    logger.info("Peer %s sent nothing for %d s; re-issuing %d pieces.",
+                                peer.ip, SNUB_TIMEOUT, len(peer.active_pieces))
+                    self._release_pieces(peer)
+                elif peer.peer_choking and peer.active_pieces:
+                    # Choked mid-piece, maybe for good; other peers carry on
+                    # from the blocks that arrived
+                    logger.info("Peer %s choked us; re-issuing %d pieces.",
+                                peer.ip, len(peer.active_pieces))
+                    self._release_pieces(peer)
+                self._update_endgame()
+        finally:
+            self._release_pieces(peer)
+            self._update_endgame()
+
+    def _request_pieces(self, peer):
+        while not peer.peer_choking and peer.has_room:
             piece_index = self._find_piece_to_download(peer)
             if piece_index is None:
-                # No available pieces to download from this peer for now
-                # In a real client, we might wait or try another peer
-                await asyncio.sleep(1) # a small delay
-                continue
-
-            try:
-                piece_data = await peer.download_piece(piece_index)
-                if piece_data:
-                    self.pieces[piece_index] = True
-                    self.downloaded_pieces += 1
-                    print(f"Downloaded piece {piece_index}. Total downloaded: {self.downloaded_pieces}/{len(self.pieces)}")
-                    # Here you would save the piece to a file
-            except Exception as e:
-                print(f"Error downloading piece {piece_index} from peer {peer.ip}: {e}")
-                # Mark the piece as not downloaded so another peer can try
-                self.pieces[piece_index] = False
-                # It might be good to disconnect from this peer if it consistently fails
                 break
+            self._downloading.setdefault(piece_index, set()).add(peer)
+            # Blocks a released peer or a previous run left are not requested again
+            peer.start_piece(piece_index, *self._partial.get(piece_index, ()))
+
+    async def _store_piece(self, peer, piece_index, piece_data):
+        if piece_index in self.picker.have:
+            return  # Another peer delivered it first
+        self._cancel_duplicates(piece_index, peer)
+        self._partial.pop(piece_index, None)
+        self._saved_blocks.pop(piece_index, None)
+        self.picker.complete(piece_index)
+        self.downloaded_pieces += 1
+        self.downloaded += len(piece_data)
+        logger.debug("Downloaded piece %d. Total downloaded: %d/%d",
+                     piece_index, self.downloaded_pieces, len(self.pieces))
+        if self.storage:
+            written = await self.storage.write_piece(piece_index, piece_data)
+            written.add_done_callback(partial(self._piece_written, piece_index))
+        else:
+            self._piece_available(piece_index)
+
+    def _piece_written(self, piece_index, future):
+        # Served, announced and journaled only once on disk: uploads are
+        # sent from the file, and a crash must never vouch for a lost write
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self.journal:
+            self.journal.record_piece(piece_index)
+        self._piece_available(piece_index)
+
+    def _piece_available(self, piece_index):
+        self.pieces[piece_index] = True
+        if self.on_piece:
+            self.on_piece(piece_index)
+
+    def _release_pieces(self, peer):
+        # Returns the peer's unfinished pieces to the picker, keeping the
+        # blocks that arrived for whoever downloads them next
+        for piece_index in peer.active_pieces:
+            data, begins = peer.received_blocks(piece_index)
+            kept = self._partial.get(piece_index)
+            if begins and (kept is None or len(begins) > len(kept[1])):
+                self._partial[piece_index] = (data, frozenset(begins))
+        for piece_index in peer.release_pieces():
+            self._forget_download(piece_index, peer)
+            self.picker.abort(piece_index)
+
+    def _forget_blocks(self, piece_index):
+        # Kept blocks of a piece that failed verification may be the bad ones
+        self._partial.pop(piece_index, None)
+        if self._saved_blocks.pop(piece_index, None) and self.journal:
+            self.journal.record_blocks(piece_index, [])
+
+    def _forget_download(self, piece_index, peer):
+        downloaders = self._downloading.get(piece_index)
+        if downloaders is not None:
+            downloaders.discard(peer)
+            if not downloaders:
+                del self._downloading[piece_index]
+
+    def _cancel_duplicates(self, piece_index, winner):
+        for peer in self._downloading.pop(piece_index, ()):
+            if peer is not winner:
+                peer.cancel_piece(piece_index)
+                self.endgame_cancelled += 1
+
+    def _endgame_ready(self) -> bool:
+        """
+        True once every wanted piece is in progress, all of their blocks
+        have been requested and fewer than ENDGAME_BLOCKS are outstanding.
+        Endgame lasts until no piece is left to download, however many
+        duplicate requests it adds.
+        """
+        if not self.picker.endgame:
+            return False
+        if self.in_endgame:
+            return True
+        outstanding = 0
+        for peer in self.peers:
+            # A choked peer's queue waits on it, not on us
+            if peer.queued_blocks and not peer.peer_choking:
+                return False
+            outstanding += len(peer.outstanding)
+        return outstanding < ENDGAME_BLOCKS
+
+    def _update_endgame(self):
+        ready = self._endgame_ready()
+        if ready and not self.in_endgame:
+            self.in_endgame = True
+            self.endgame_started = time.monotonic()
+            _ENDGAME_ENTERED.inc()
+            logger.info("Entering endgame mode with %d pieces left.",
+                        len(self.picker.in_progress))
+        elif self.in_endgame and not ready:
+            self.in_endgame = False
+            self.endgame_seconds += time.monotonic() - self.endgame_started
+            _ENDGAME_LEFT.inc()
+            logger.info("Leaving endgame mode after %.2f s: %d duplicate piece "
+                        "requests, %d cancelled.", self.endgame_seconds,
+                        self.endgame_requests, self.endgame_cancelled)
+
+    def _remove_peer(self, peer):
+        if peer in self.peers:
+            self.peers.remove(peer)
+            if peer in self._peers_joined:
+                self._peers_joined.remove(peer)
+            elif peer.bitfield is not None:
+                self._peers_left.append(peer.bitfield)
+            peer.on_have = None
+            peer.close()
+
+    def _sync_availability(self):
+        """
+        Brings the picker's availability up to date with the peers that
+        joined or left since the last pick. Connections come and go in
+        bursts, at start-up and whenever peers churn, so after several
+        changes every count is rebuilt from all bitfields at once.
+        """
+        changes = len(self._peers_joined) + len(self._peers_left)
+        if not changes:
+            return
+        if changes >= REBUILD_AVAILABILITY_CHANGES:
+            self.picker.rebuild([peer.bitfield for peer in self.peers
+                                 if peer.bitfield is not None])
+        else:
+            for bitfield in self._peers_left:
+                self.picker.remove_peer(bitfield.indices())
+            for peer in self._peers_joined:
+                self.picker.add_peer(peer.have_pieces())
+        # HAVEs are counted from here on; earlier ones are in the bitfields
+        for peer in self._peers_joined:
+            peer.on_have = self.picker.increment
+        self._peers_joined.clear()
+        self._peers_left.clear()
 
     def _find_piece_to_download(self, peer):
-        for i, piece in enumerate(self.pieces):
-            if not piece and peer.bitfield and i < len(peer.bitfield) and peer.bitfield[i]:
-                return i
-        return None
+        started = time.perf_counter()
+        try:
+            self._sync_availability()
+            return self._pick_piece(peer)
+        finally:
+            PICK_SECONDS.observe(time.perf_counter() - started)
+
+    def _pick_piece(self, peer):
+        if not peer.bitfield or not peer.bitfield.andnot(self.pieces).any():
+            # The peer has nothing we still need
+            return None
+        # Snubbed peers get the common pieces, which others can deliver too
+        piece_index = self.picker.pick(peer.bitfield, rarest_first=not peer.snubbed)
+        if piece_index is None and self._endgame_ready():
+            # The last blocks are being downloaded; race the slow peers
+            self._update_endgame()
+            piece_index = self.picker.pick_endgame(peer.bitfield,
+                                                   exclude=peer.active_pieces)
+            if piece_index is not None:
+                self.endgame_requests += 1
+        return piece_index
@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import gauge, histogram
+
+# Pieces smaller than this are hashed inline; the thread hop costs more
+INLINE_HASH_LIMIT = 64 * 1024  # 64 KB
+
+# Instrumentation, exported by app.metrics
+HASH_SECONDS = histogram('bittorrent_hash_seconds',
+                         'Time to SHA-1 one piece, excluding time queued')
+HASH_QUEUE_DEPTH = gauge('bittorrent_hash_queue_depth',
+                         'Pieces queued or being hashed on the hasher threads')
+
+
+class PieceVerifier:
+    """
+    Verifies piece SHA-1 hashes on a thread pool.
+
+    hashlib releases the GIL while hashing large buffers, so one thread per
+    core hashes pieces in parallel while the event loop keeps serving peer
+    sockets.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.pieces_hashed = 0
+        self.bytes_hashed = 0
+        self.hash_seconds = 0.0
+        self.latency_seconds = 0.0
+        self.queue_depth = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='hasher')
+        self._lock = threading.Lock()
+
+    async def verify(self, piece_data, expected_hash) -> bool:
+        """
+        Returns True if the SHA-1 of `piece_data` equals `expected_hash`.
+        """
+        submitted = time.perf_counter()
+        if len(piece_data) < INLINE_HASH_LIMIT:
+            digest = self._hash(piece_data)
+        else:
+            self.queue_depth += 1
+            HASH_QUEUE_DEPTH.inc()
+            try:
+                digest = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._hash, piece_data)
+            finally:
+                self.queue_depth -= 1
+                HASH_QUEUE_DEPTH.dec()
+        self.latency_seconds += time.perf_counter() - submitted
+        return digest == expected_hash
+
+    @property
+    def average_hash_time(self) -> float:
+        # Mean seconds spent hashing one piece
+        if not self.pieces_hashed:
+            return 0.0
+        return self.hash_seconds / self.pieces_hashed
+
+    @property
+    def average_latency(self) -> float:
+        # Mean seconds from submission to result, including time queued
+        if not self.pieces_hashed:
+            return 0.0
+        return self.latency_seconds / self.pieces_hashed
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _hash(self, piece_data):
+        start = time.perf_counter()
+        digest = hashlib.sha1(piece_data).digest()
+        elapsed = time.perf_counter() - start
+        HASH_SECONDS.observe(elapsed)
+        with self._lock:
+            self.hash_seconds += elapsed
+            self.pieces_hashed += 1
+            self.bytes_hashed += len(piece_data)
+        return digest
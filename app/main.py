@@ -1,12 +1,30 @@
-import json
+import os
 import sys
-import bencodepy
-import app.torrent
-import app.tracker
-import app.protocol_new
-import app.download_manager
-import asyncio
+from app import control
 
+# Subsystems are imported by the commands that use them, so `decode` and
+# `info` load only the bencode and torrent code and a command forwarded to
+# the daemon loads nothing else at all
+
+
+def configure_logging():
+    import logging
+
+    # Progress and diagnostics go to stderr; BITTORRENT_LOG_LEVEL=DEBUG
+    # shows every piece, WARNING only problems
+    logging.basicConfig(
+        level=os.environ.get('BITTORRENT_LOG_LEVEL', 'INFO').upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+def bandwidth_limits():
+    # Global download and upload limits in bytes per second from
+    # BITTORRENT_DOWNLOAD_LIMIT and BITTORRENT_UPLOAD_LIMIT; unset or 0 is
+    # unlimited
+    return {
+        'download_limit': int(os.environ.get('BITTORRENT_DOWNLOAD_LIMIT') or 0) or None,
+        'upload_limit': int(os.environ.get('BITTORRENT_UPLOAD_LIMIT') or 0) or None,
+    }
 
 
 def main():
@@ -14,7 +32,22 @@ def main():
 
     print("Logs from your program will appear here!", file=sys.stderr)
 
+    # A running daemon answers from its warm state; BITTORRENT_NO_DAEMON=1
+    # always runs the command here
+    if (command in control.FORWARDED_COMMANDS
+            and not os.environ.get('BITTORRENT_NO_DAEMON')):
+        response = control.request(command, sys.argv[2:])
+        if response is not None:
+            sys.stdout.write(response['output'])
+            if response['error']:
+                print(response['error'], file=sys.stderr)
+            sys.exit(response['status'])
+
     if command == "decode":
+        import json
+        import app.bencoding
+        import app.torrent
+
         bencoded_value = sys.argv[2].encode()
 
         def bytes_to_str(data):
@@ -22,22 +55,41 @@ def main():
                 return data.decode(errors="replace")
             raise TypeError(f"Type not serializable: {type(data)}")
 
-        result = bencodepy.decode(bencoded_value)
+        result = app.bencoding.decode(bencoded_value)
         print(json.dumps(app.torrent.bdecode_to_str(result)))
 
     elif command == "info":
+        import app.torrent
+
         torrent_path = sys.argv[2]
         tor = app.torrent.Torrent(torrent_path)
         print(tor)
 
     elif command == "peers":
+        import asyncio
+        import app.torrent
+        import app.tracker
+
+        configure_logging()
         torrent_path = sys.argv[2]
         tor = app.torrent.Torrent(torrent_path)
-        tor_tracker = app.tracker.Tracker(tor)
-        response = asyncio.run(tor_tracker.connect())
+
+        async def get_peers():
+            tor_tracker = app.tracker.Tracker(tor)
+            try:
+                return await tor_tracker.connect()
+            finally:
+                await tor_tracker.close()
+
+        response = asyncio.run(get_peers())
         print(response)
 
     elif command == "handshake":
+        import asyncio
+        import app.torrent
+        import app.protocol_new
+
+        configure_logging()
         torrent_path = sys.argv[2]
         peer_address = sys.argv[3]
         peer_ip, peer_port = peer_address.split(":")
@@ -51,6 +103,12 @@ def main():
         asyncio.run(perform_handshake())
     
     elif command == "download_piece":
+        import asyncio
+        import app.torrent
+        import app.tracker
+        import app.protocol_new
+
+        configure_logging()
         output_path = sys.argv[3]
         torrent_path = sys.argv[4]
         piece_index = int(sys.argv[5])
@@ -58,7 +116,10 @@ def main():
         async def download_piece_and_save():
             tor = app.torrent.Torrent(torrent_path)
             tor_tracker = app.tracker.Tracker(tor)
-            peers = await tor_tracker.connect()
+            try:
+                peers = await tor_tracker.connect()
+            finally:
+                await tor_tracker.close()
 
             peer_ip, peer_port = peers.peers[0]
             peer_connection = app.protocol_new.PeerConnection(tor, peer_ip, peer_port)
@@ -80,27 +141,141 @@ def main():
         asyncio.run(download_piece_and_save())
 
     elif command == "download":
-        output_path = sys.argv[2]
-        torrent_path = sys.argv[3]
+        import asyncio
+        import logging
+        import app.metrics
+        import app.session
 
-        async def download_torrent():
-            tor = app.torrent.Torrent(torrent_path)
-            tor_tracker = app.tracker.Tracker(tor)
-            peers_info = await tor_tracker.connect()
+        configure_logging()
+        output_path = sys.argv[3]
+        # One .torrent saves to output_path; several, or a directory of
+        # them, save below output_path and share one Session
+        plan, single = app.session.plan_downloads(sys.argv[4:], output_path)
+
+        async def download_torrents():
+            session = app.session.Session(**bandwidth_limits())
+
+            # Prometheus metrics on localhost when BITTORRENT_METRICS_PORT is set
+            metrics_server = None
+            if os.environ.get('BITTORRENT_METRICS_PORT'):
+                metrics_server = app.metrics.MetricsServer(
+                    port=int(os.environ['BITTORRENT_METRICS_PORT']))
+
+            try:
+                for _, tor, target in plan:
+                    session.add_torrent(tor, target)
+                await session.start()
+                if metrics_server:
+                    await metrics_server.start()
+                return await session.run()
+            finally:
+                if metrics_server:
+                    await metrics_server.close()
+                await session.close()
+
+        entries = asyncio.run(download_torrents())
+        failed = False
+        for (torrent_path, _, _), entry in zip(plan, entries):
+            if entry.error:
+                if single:
+                    raise entry.error
+                failed = True
+            elif entry.complete:
+                print(f"Downloaded {torrent_path} to {entry.output_path}.")
+            else:
+                logging.getLogger(__name__).error(
+                    "Download of %s is incomplete", torrent_path)
+                failed = True
+        if failed:
+            sys.exit(1)
+
+    elif command == "recheck":
+        import argparse
+        import logging
+        import app.recheck
+        import app.resume
+        import app.torrent
+
+        configure_logging()
+        parser = argparse.ArgumentParser(prog='recheck')
+        parser.add_argument('torrent')
+        parser.add_argument('path')
+        parser.add_argument('--workers', type=int)
+        parser.add_argument('--processes', action='store_true')
+        parser.add_argument('--max-failures', type=int)
+        parser.add_argument('--write-resume', action='store_true')
+        args = parser.parse_args(sys.argv[2:])
+        tor = app.torrent.Torrent(args.torrent)
+
+        result = app.recheck.recheck(tor, args.path, workers=args.workers,
+                                     processes=args.processes,
+                                     max_failures=args.max_failures)
+        print(f"{result.have.count()} of {tor.num_pieces} pieces OK, "
+              f"{len(result.failed)} failed; checked {result.bytes_checked / 2**30:.2f} GB "
+              f"in {result.seconds:.2f} s ({result.rate / 2**30:.2f} GB/s).")
+        if result.failed:
+            shown = ', '.join(map(str, result.failed[:20]))
+            print(f"Failed pieces: {shown}{', ...' if len(result.failed) > 20 else ''}")
+        if result.stopped:
+            print(f"Stopped after {args.max_failures} failures.")
+        if args.write_resume:
+            # A full check is as good as a resume journal; let download trust
+            # it, but never leave a journal next to data that is not there
+            if result.stopped or not result.have.count() or not os.path.exists(args.path):
+                print("Resume journal not written: no complete check of existing data.")
+            else:
+                try:
+                    app.resume.write_journal(tor, args.path, result.have)
+                except (OSError, ValueError) as e:
+                    logging.getLogger(__name__).warning("Could not write resume journal: %s", e)
+        if result.failed or result.stopped:
+            sys.exit(1)
 
-            download_manager = app.download_manager.DownloadManager(tor)
+    elif command == "create":
+        import argparse
+        import app.creator
+        import app.torrent
 
-            # Add peers to the download manager
-            for peer_ip, peer_port in peers_info.peers:
-                await download_manager.add_peer(peer_ip, peer_port)
+        configure_logging()
+        parser = argparse.ArgumentParser(prog='create')
+        parser.add_argument('-o', '--output', required=True)
+        parser.add_argument('path')
+        # Repeat for more tiers; comma-separated URLs share a tier (BEP 12)
+        parser.add_argument('-a', '--announce', action='append', default=[])
+        parser.add_argument('--piece-length', type=int)
+        parser.add_argument('--comment')
+        parser.add_argument('--private', action='store_true')
+        parser.add_argument('--workers', type=int)
+        args = parser.parse_args(sys.argv[2:])
 
-            # Start the download
-            await download_manager.start_download()
+        tiers = [[url for url in tier.split(',') if url] for tier in args.announce]
+        try:
+            metainfo = app.creator.create_torrent(
+                args.path, announce=tiers, piece_length=args.piece_length,
+                comment=args.comment, private=args.private, workers=args.workers)
+        except ValueError as e:
+            parser.error(str(e))
+        app.creator.write_torrent(metainfo, args.output)
+        tor = app.torrent.Torrent(args.output)
+        print(f"Created {args.output}: {tor.num_pieces} pieces of {tor.pieces_length} "
+              f"bytes, info hash {tor.info_hash.hex()}")
 
-            # After download is complete, you would assemble the pieces into a file
-            print("Download complete!")
+    elif command == "daemon":
+        action = sys.argv[2] if len(sys.argv) > 2 else "run"
+        if action == "run":
+            import asyncio
+            import app.daemon
 
-        asyncio.run(download_torrent())
+            configure_logging()
+            asyncio.run(app.daemon.Daemon(**bandwidth_limits()).run())
+        elif action in ("status", "stop"):
+            response = control.request(action, [])
+            if response is None:
+                print("No daemon is running.", file=sys.stderr)
+                sys.exit(1)
+            sys.stdout.write(response['output'])
+        else:
+            raise NotImplementedError(f"Unknown daemon action {action}")
 
     else:
         raise NotImplementedError(f"Unknown command {command}")
@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histograms: 100 µs to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds, in seconds, of state durations such as choke periods
+DURATION_BUCKETS = (0.1, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# Port of the optional Prometheus endpoint
+DEFAULT_METRICS_PORT = 9469
+
+
+class Metric:
+    """
+    A named metric, optionally with labels.
+
+    A metric with `labelnames` is a family: `labels(*values)` returns the
+    child for one combination of label values, created on first use. Keep
+    the child of a hot path in a variable; updating it is then one
+    attribute update, with no lookup. Counters and gauges are only updated
+    on the event loop and take no lock; a histogram, which disk writer and
+    hasher threads observe too, holds a lock of its own.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            child = self._children[values] = self._child()
+        return child
+
+    def remove(self, *values):
+        self._children.pop(values, None)
+
+    def samples(self):
+        """
+        Yields (suffix, labels, value) for every exported sample.
+        """
+        if self.labelnames:
+            for values, child in self._children.items():
+                yield from child._samples(dict(zip(self.labelnames, values)))
+        else:
+            yield from self._samples({})
+
+    def _child(self):
+        return type(self)(self.name, self.documentation)
+
+
+class Counter(Metric):
+    # Only ever increases, e.g. bytes or connection attempts
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _samples(self, labels):
+        yield '', labels, self.value
+
+
+class Gauge(Metric):
+    # A value that goes up and down, e.g. connected peers
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def _samples(self, labels):
+        yield '', labels, self.value
+
+
+class Histogram(Metric):
+    # Distribution of observed values in fixed buckets, e.g. latencies
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # counts[i] holds the observations in (buckets[i-1], buckets[i]];
+        # the last one those above every bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def _child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def _samples(self, labels):
+        # A consistent snapshot: _count equals the +Inf bucket
+        with self._lock:
+            counts, total, observed = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield '_bucket', dict(labels, le=_format_value(bound)), cumulative
+        yield '_sum', labels, total
+        yield '_count', labels, observed
+
+
+class Registry:
+    """
+    Holds the metrics of the process and renders them for Prometheus.
+
+    Besides registered metrics, collectors are called on every scrape and
+    return metrics built from state kept elsewhere (e.g. the byte counters
+    of each peer connection), so that state costs nothing between scrapes.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def collect(self):
+        """
+        Returns every metric, merging collected families with the same name.
+        """
+        families = {}
+        for metric in self._metrics.values():
+            families[metric.name] = [metric]
+        for collector in list(self._collectors):
+            for metric in collector():
+                families.setdefault(metric.name, []).append(metric)
+        return families
+
+    def expose(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, metrics in sorted(self.collect().items()):
+            first = metrics[0]
+            lines.append(f"# HELP {name} {_escape_help(first.documentation)}")
+            lines.append(f"# TYPE {name} {first.kind}")
+            for metric in metrics:
+                for suffix, labels, value in metric.samples():
+                    if labels:
+                        rendered = ','.join(f'{key}="{_escape(str(label))}"'
+                                            for key, label in labels.items())
+                        lines.append(f"{name}{suffix}{{{rendered}}} {_format_value(value)}")
+                    else:
+                        lines.append(f"{name}{suffix} {_format_value(value)}")
+        lines.append('')
+        return '\n'.join(lines)
+
+
+# Registry every module of the client reports to
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+class MetricsServer:
+    """
+    Minimal HTTP endpoint serving a registry in Prometheus text format at
+    /metrics. It listens on localhost unless told otherwise.
+    """
+    def __init__(self, registry=REGISTRY, host='127.0.0.1',
+                 port=DEFAULT_METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # The actual port when 0 asked for any free one
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=10)
+            # Skip the headers; nothing in them matters here
+            while (await asyncio.wait_for(reader.readline(), timeout=10)).strip():
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.registry.expose().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(
+                f"HTTP/1.0 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('ascii') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def _escape_help(text):
+    # HELP text escapes only backslash and newline
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape(text):
+    # Label values also escape double quotes
+    return _escape_help(text).replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return str(value)
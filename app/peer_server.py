@@ -0,0 +1,383 @@
+import asyncio
+import logging
+import random
+import struct
+import time
+from collections import deque
+from .protocol_new import (
+    WireProtocol, build_handshake, PROTOCOL_NAME, BLOCK_SIZE, MAX_PIPELINE_DEPTH,
+    CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD, REQUEST, PIECE, CANCEL)
+from .bitfield import Bitfield
+from .metrics import REGISTRY, Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# Peers unchoked for their upload rate at every rechoke
+DEFAULT_UPLOAD_SLOTS = 4
+
+# Seconds between rechokes; every OPTIMISTIC_ROUNDS-th one also rotates
+# the optimistic unchoke (i.e. every 30 s)
+RECHOKE_INTERVAL = 10
+OPTIMISTIC_ROUNDS = 3
+
+# Inbound connections accepted at once across all torrents
+DEFAULT_MAX_UPLOAD_PEERS = 50
+
+# Seconds an inbound peer has to send its handshake
+HANDSHAKE_TIMEOUT = 10
+
+# Larger block requests are ignored; every client asks for 16 KB blocks
+MAX_REQUEST_LENGTH = 8 * BLOCK_SIZE  # 128 KB
+
+# Requests queued per peer; further requests are dropped until it catches up
+MAX_QUEUED_REQUESTS = MAX_PIPELINE_DEPTH
+
+# Payload lengths of the fixed-size messages we unpack; a peer sending any
+# other length is disconnected
+PAYLOAD_LENGTHS = {HAVE: 4, REQUEST: 12, CANCEL: 12}
+
+
+class UploadPeer:
+    """
+    An inbound peer we serve blocks to.
+
+    Only `run` writes to the transport. The choker and HAVE broadcasts queue
+    their messages on the wire and interrupt it, so they are flushed between
+    blocks and never interleave with a sendfile in progress.
+    """
+    def __init__(self, server, manager, wire, ip, port, peer_id):
+        self.server = server
+        self.manager = manager
+        self.wire = wire
+        self.ip = ip
+        self.port = port
+        self.peer_id = peer_id
+        self.bitfield = Bitfield(manager.torrent.num_pieces)
+        self.am_choking = True
+        self.peer_interested = False
+        # Block requests to serve, as (index, begin, length)
+        self.requests = deque()
+        self.uploaded = 0
+        # This peer's level below the torrent's bandwidth limits
+        self.bandwidth = manager.bandwidth.child()
+        self._throttle_timer = None
+        # Upload rate in bytes per second over the last rechoke interval
+        self.rate = 0.0
+        self._rate_mark = 0
+        self._rate_time = time.monotonic()
+
+    async def run(self):
+        """
+        Completes the handshake, sends our bitfield and serves requests until
+        the connection closes.
+        """
+        self.wire.write(build_handshake(self.manager.torrent.info_hash))
+        if self.manager.pieces.any():
+            self.wire.write_message(BITFIELD, self.manager.pieces.tobytes())
+        await self.wire.drain()
+
+        while True:
+            for msg_id, payload in self.wire.pop_messages():
+                if msg_id is not None:
+                    self._handle_message(msg_id, payload)
+            if self.requests and not self.am_choking and self._throttle_timer is None:
+                index, begin, length = self.requests[0]
+                if self.bandwidth.upload.try_consume(length):
+                    self.requests.popleft()
+                    await self._send_block(index, begin, length)
+                    continue
+                # Over the upload limit; wait for tokens without blocking
+                # CANCEL and choke handling
+                self._throttle_timer = asyncio.get_running_loop().call_later(
+                    self.bandwidth.upload.delay(), self._throttle_done)
+            await self.wire.drain()
+            await self.wire.wait()
+
+    def choke(self):
+        if not self.am_choking:
+            self.am_choking = True
+            # The peer drops its queued requests when choked, so do we
+            self.requests.clear()
+            self._queue_message(CHOKE)
+
+    def unchoke(self):
+        if self.am_choking:
+            self.am_choking = False
+            self._queue_message(UNCHOKE)
+
+    def send_have(self, index):
+        if not self.bitfield[index]:
+            self._queue_message(HAVE, struct.pack('>I', index))
+
+    def update_rate(self):
+        """
+        Recomputes `rate` from the bytes uploaded since the last call.
+        """
+        now = time.monotonic()
+        elapsed = now - self._rate_time
+        if elapsed > 0:
+            self.rate = (self.uploaded - self._rate_mark) / elapsed
+        self._rate_mark = self.uploaded
+        self._rate_time = now
+
+    def close(self):
+        if self._throttle_timer:
+            self._throttle_timer.cancel()
+        self.wire.transport.close()
+
+    def _throttle_done(self):
+        self._throttle_timer = None
+        self.wire.interrupt()
+
+    def _queue_message(self, msg_id, payload=b''):
+        # Flushed by `run` at its next wakeup
+        self.wire.write_message(msg_id, payload)
+        self.wire.interrupt()
+
+    def _handle_message(self, msg_id, payload):
+        expected = PAYLOAD_LENGTHS.get(msg_id)
+        if expected is not None and len(payload) != expected:
+            raise ValueError(f"Message {msg_id} with {len(payload)} byte payload")
+        if msg_id == INTERESTED:
+            self.peer_interested = True
+            self.server.peer_interested(self)
+        elif msg_id == NOT_INTERESTED:
+            self.peer_interested = False
+        elif msg_id == HAVE:
+            index, = struct.unpack('>I', payload)
+            if index < len(self.bitfield):
+                self.bitfield[index] = True
+        elif msg_id == BITFIELD:
+            self.bitfield = Bitfield(len(self.bitfield), payload)
+        elif msg_id == REQUEST:
+            request = struct.unpack('>III', payload)
+            if (not self.am_choking and len(self.requests) < MAX_QUEUED_REQUESTS
+                    and self._valid_request(*request)):
+                self.requests.append(request)
+        elif msg_id == CANCEL:
+            try:
+                self.requests.remove(struct.unpack('>III', payload))
+            except ValueError:
+                pass  # Already sent
+        # CHOKE, UNCHOKE and PIECE do not matter: we never request from them
+
+    def _valid_request(self, index, begin, length):
+        torrent = self.manager.torrent
+        return (0 < length <= MAX_REQUEST_LENGTH
+                and index < torrent.num_pieces
+                and self.manager.pieces[index]
+                and begin + length <= torrent.piece_size(index))
+
+    async def _send_block(self, index, begin, length):
+        """
+        Sends one PIECE message, with the block sent straight from the file
+        when the transport supports sendfile.
+        """
+        storage = self.manager.storage
+        self.wire.write(struct.pack('>IBII', 9 + length, PIECE, index, begin))
+        self.wire.flush()
+        if self.server.zero_copy:
+            try:
+                await storage.send(self.wire.transport, index, begin, length)
+            except (asyncio.SendfileNotAvailableError, NotImplementedError):
+                # Nothing was sent; fall back to copying for every peer
+                self.server.zero_copy = False
+            else:
+                self.wire.bytes_sent += length
+        if not self.server.zero_copy:
+            self.wire.write(await storage.read(index, begin, length))
+            await self.wire.drain()
+        self.uploaded += length
+        self.manager.uploaded += length
+        self.server.uploaded += length
+
+
+class Choker:
+    """
+    Decides which interested peers are unchoked.
+
+    The `slots` peers we upload to fastest keep their slots, so bandwidth
+    goes to peers that can take it, and one more interested peer is picked
+    at random every OPTIMISTIC_ROUNDS rechokes (the optimistic unchoke),
+    which gives new peers a chance to show their rate.
+    """
+    def __init__(self, slots=DEFAULT_UPLOAD_SLOTS):
+        self.slots = slots
+        self.optimistic = None
+        self._round = 0
+
+    def rechoke(self, peers):
+        for peer in peers:
+            peer.update_rate()
+        interested = sorted((peer for peer in peers if peer.peer_interested),
+                            key=lambda peer: peer.rate, reverse=True)
+
+        if self._round % OPTIMISTIC_ROUNDS == 0 or self.optimistic not in peers:
+            others = interested[self.slots:]
+            self.optimistic = random.choice(others) if others else None
+        self._round += 1
+
+        # The optimistic peer keeps its own slot even once it ranks high
+        unchoked = set([peer for peer in interested
+                        if peer is not self.optimistic][:self.slots])
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for peer in peers:
+            if peer in unchoked:
+                peer.unchoke()
+            else:
+                peer.choke()
+
+    def has_free_slot(self, peers):
+        unchoked = sum(1 for peer in peers
+                       if not peer.am_choking and peer is not self.optimistic)
+        return unchoked < self.slots
+
+
+class PeerServer:
+    """
+    Accepts inbound peer connections and uploads pieces we have.
+
+    Connections are matched to a loaded torrent by the info hash in their
+    handshake. Blocks are read from each torrent's Storage and sent with
+    sendfile, so uploading costs no Python-level copy per byte.
+    """
+    def __init__(self, port, host=None,
+                 max_peers=DEFAULT_MAX_UPLOAD_PEERS,
+                 upload_slots=DEFAULT_UPLOAD_SLOTS):
+        self.port = port
+        self.host = host
+        self.max_peers = max_peers
+        # DownloadManager of every torrent we serve, by info hash
+        self.torrents = {}
+        self.peers = set()
+        self.choker = Choker(upload_slots)
+        self.uploaded = 0
+        # Cleared once a transport turns out not to support sendfile
+        self.zero_copy = True
+        self._server = None
+        self._choker_task = None
+        self._tasks = set()
+
+    def add_torrent(self, manager):
+        """
+        Serves the pieces of a DownloadManager, announcing new ones with HAVE.
+        """
+        if manager.storage is None:
+            raise ValueError("Only torrents with storage can be served")
+        self.torrents[manager.torrent.info_hash] = manager
+        manager.on_piece = lambda index: self._broadcast_have(manager, index)
+
+    def remove_torrent(self, manager):
+        self.torrents.pop(manager.torrent.info_hash, None)
+        manager.on_piece = None
+        for peer in list(self.peers):
+            if peer.manager is manager:
+                peer.close()
+
+    async def start(self):
+        """
+        Starts listening; raises OSError if the port is unavailable.
+        """
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: _InboundProtocol(self), self.host, self.port)
+        # The actual port when 0 asked for any free one
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._choker_task = asyncio.create_task(self._run_choker())
+        REGISTRY.add_collector(self._collect_metrics)
+        logger.info("Accepting peers on port %d", self.port)
+
+    async def close(self):
+        REGISTRY.remove_collector(self._collect_metrics)
+        if self._server:
+            self._server.close()
+        if self._choker_task:
+            self._choker_task.cancel()
+        for peer in list(self.peers):
+            peer.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks,
+                             *([self._choker_task] if self._choker_task else []),
+                             return_exceptions=True)
+        if self._server:
+            await self._server.wait_closed()
+
+    def _collect_metrics(self):
+        """
+        Builds upload metrics at scrape time from the wire byte counters.
+        """
+        labels = ('torrent', 'peer')
+        sent = Counter('bittorrent_peer_sent_bytes_total',
+                       'Bytes sent to each peer', labels)
+        received = Counter('bittorrent_peer_received_bytes_total',
+                           'Bytes received from each peer', labels)
+        unchoked = Gauge('bittorrent_upload_unchoked_peers',
+                         'Inbound peers we are uploading to')
+        for peer in self.peers:
+            key = (peer.manager.torrent.name, f"{peer.ip}:{peer.port}")
+            sent.labels(*key).value = peer.wire.bytes_sent
+            received.labels(*key).value = peer.wire.bytes_received
+            if not peer.am_choking:
+                unchoked.inc()
+        return [sent, received, unchoked]
+
+    def peer_interested(self, peer):
+        # Unchoke right away while a regular slot is free instead of waiting
+        # for the next rechoke
+        if peer.am_choking and self.choker.has_free_slot(self.peers):
+            peer.unchoke()
+
+    def _accept(self, wire):
+        if len(self._tasks) >= self.max_peers:
+            wire.transport.close()
+            return
+        task = asyncio.create_task(self._serve(wire))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _serve(self, wire):
+        peer = None
+        try:
+            handshake = await asyncio.wait_for(wire.receive_handshake(),
+                                               HANDSHAKE_TIMEOUT)
+            manager = self.torrents.get(handshake[28:48])
+            if handshake[1:20] != PROTOCOL_NAME or manager is None:
+                return  # Not BitTorrent, or a torrent we do not serve
+            ip, port = wire.transport.get_extra_info('peername')[:2]
+            peer = UploadPeer(self, manager, wire, ip, port, handshake[48:])
+            self.peers.add(peer)
+            await peer.run()
+        except (ConnectionError, OSError, ValueError, asyncio.TimeoutError) as e:
+            if peer:
+                logger.info("Upload connection to %s:%d closed: %s", peer.ip, peer.port, e)
+        finally:
+            self.peers.discard(peer)
+            if peer:
+                peer.close()
+            else:
+                wire.transport.close()
+
+    async def _run_choker(self):
+        while True:
+            self.choker.rechoke(self.peers)
+            await asyncio.sleep(RECHOKE_INTERVAL)
+
+    def _broadcast_have(self, manager, index):
+        for peer in self.peers:
+            if peer.manager is manager:
+                peer.send_have(index)
+
+
+class _InboundProtocol(WireProtocol):
+    # Hands every accepted connection to the server once it is made
+
+    def __init__(self, server):
+        super().__init__()
+        self._server = server
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self._server._accept(self)
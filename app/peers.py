@@ -0,0 +1,105 @@
+import socket
+import struct
+
+# Sizes of one compact peer entry (BEP 23 and BEP 7)
+COMPACT_PEER_LENGTH = 6
+COMPACT_PEER6_LENGTH = 18
+
+
+class PeerList:
+    """
+    An ordered set of peer addresses kept in compact form.
+
+    IPv4 peers are stored as one int (ip << 16 | port), IPv6 peers as
+    (16-byte address, port) and anything else (e.g. host names from a
+    non-compact response) as (host, port). Compact strings are decoded with
+    struct.iter_unpack, and dotted/colon notation is only produced when the
+    list is iterated, so merging and deduplicating thousands of peers never
+    formats an address.
+    """
+    __slots__ = ('_keys',)
+
+    def __init__(self, keys=()):
+        # dict keys double as an insertion-ordered set
+        self._keys = dict.fromkeys(keys)
+
+    @classmethod
+    def from_compact(cls, data):
+        usable = len(data) - len(data) % COMPACT_PEER_LENGTH
+        return cls(ip << 16 | port
+                   for ip, port in struct.iter_unpack('>IH', data[:usable]))
+
+    @classmethod
+    def from_compact6(cls, data):
+        usable = len(data) - len(data) % COMPACT_PEER6_LENGTH
+        return cls(struct.iter_unpack('>16sH', data[:usable]))
+
+    @classmethod
+    def from_dicts(cls, peers):
+        # Non-compact tracker format: a list of {'ip': ..., 'port': ...}
+        return cls(address_key(peer[b'ip'].decode('utf-8'), peer[b'port'])
+                   for peer in peers)
+
+    def update(self, other):
+        """
+        Adds the peers of another PeerList that are not in this one yet.
+        """
+        self._keys.update(other._keys)
+
+    def difference(self, known):
+        """
+        Returns the peers whose keys are not in the set `known`.
+        """
+        return PeerList(key for key in self._keys if key not in known)
+
+    def keys(self):
+        return self._keys.keys()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, address):
+        return address_key(*address) in self._keys
+
+    def __iter__(self):
+        for key in self._keys:
+            yield key_address(key)
+
+    def __repr__(self):
+        return f"PeerList({list(self)!r})"
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._keys)
+        for position, key in enumerate(self._keys):
+            if position == index:
+                return key_address(key)
+        raise IndexError('peer index out of range')
+
+
+def address_key(ip, port):
+    """
+    Returns the compact PeerList key for an (ip, port) address.
+    """
+    try:
+        return struct.unpack('>I', socket.inet_aton(ip))[0] << 16 | port
+    except OSError:
+        pass
+    try:
+        return (socket.inet_pton(socket.AF_INET6, ip), port)
+    except OSError:
+        return (ip, port)
+
+
+def key_address(key):
+    """
+    Returns the (ip, port) address for a compact PeerList key.
+    """
+    if type(key) is int:
+        ip = key >> 16
+        return ('%d.%d.%d.%d' % (ip >> 24, ip >> 16 & 0xff, ip >> 8 & 0xff, ip & 0xff),
+                key & 0xffff)
+    host, port = key
+    if type(host) is bytes:
+        return socket.inet_ntop(socket.AF_INET6, host), port
+    return key
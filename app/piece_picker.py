@@ -0,0 +1,182 @@
+import random
+from .bitfield import availability
+
+# Peers allowed to download the same piece at once in endgame mode, which
+# bounds the bandwidth spent on duplicate blocks
+MAX_ENDGAME_DOWNLOADERS = 3
+
+
+class PiecePicker:
+    """
+    Chooses which piece to request next, rarest first.
+
+    Every piece we still want lives in exactly one availability bucket (the
+    list of pieces seen on that many peers). Buckets are unordered lists with
+    swap-remove, and each piece remembers its position, so moving a piece
+    when a peer announces or drops it is O(1). Picking walks the buckets from
+    the rarest upwards and starts at a random offset inside a bucket, which
+    spreads peers over different pieces of equal rarity.
+
+    Pieces handed out by `pick` are in progress and leave the buckets until
+    they are completed or aborted, so two peers never download the same
+    piece. Once every wanted piece is in progress `endgame` is true and
+    `pick_endgame` may hand in-progress pieces to additional peers; the
+    caller decides whether few enough blocks are left for that to pay off.
+    """
+    def __init__(self, num_pieces):
+        self.num_pieces = num_pieces
+        self.availability = [0] * num_pieces
+        self.in_progress = set()
+        # Number of peers downloading each in-progress piece
+        self.downloaders = {}
+        self.have = set()
+        self._buckets = [list(range(num_pieces))]
+        self._position = list(range(num_pieces))
+
+    def add_peer(self, pieces):
+        """
+        Counts every piece index in `pieces` as available on one more peer.
+        """
+        for index in pieces:
+            self.increment(index)
+
+    def remove_peer(self, pieces):
+        """
+        Forgets the pieces of a peer that disconnected.
+        """
+        for index in pieces:
+            self.decrement(index)
+
+    def rebuild(self, bitfields):
+        """
+        Recomputes every availability count from the bitfields of all
+        connected peers in one vectorized pass.
+        """
+        self.availability = availability(bitfields, self.num_pieces)
+        self._buckets = [[]]
+        queued = [i for i in range(self.num_pieces) if self._position[i] >= 0]
+        for index in queued:
+            self._insert(index)
+
+    def increment(self, index):
+        """
+        Records that one more peer has piece `index` (BITFIELD or HAVE).
+        """
+        if not 0 <= index < self.num_pieces:
+            return
+        queued = self._position[index] >= 0
+        if queued:
+            self._remove(index)
+        self.availability[index] += 1
+        if queued:
+            self._insert(index)
+
+    def decrement(self, index):
+        """
+        Records that one less peer has piece `index`.
+        """
+        if not 0 <= index < self.num_pieces or self.availability[index] == 0:
+            return
+        queued = self._position[index] >= 0
+        if queued:
+            self._remove(index)
+        self.availability[index] -= 1
+        if queued:
+            self._insert(index)
+
+    def pick(self, bitfield, rarest_first=True):
+        """
+        Returns the rarest wanted piece the peer has and marks it in progress,
+        or None if the peer has nothing we still need. With `rarest_first`
+        False the most common piece is returned instead, which keeps peers
+        we do not trust (e.g. snubbed ones) off the pieces that are hard to
+        get elsewhere.
+        """
+        size = len(bitfield)
+        # Bucket 0 holds pieces nobody has, so the peer cannot have them either
+        buckets = self._buckets[1:]
+        for bucket in (buckets if rarest_first else reversed(buckets)):
+            count = len(bucket)
+            if not count:
+                continue
+            start = random.randrange(count)
+            for offset in range(count):
+                index = bucket[(start + offset) % count]
+                if index < size and bitfield[index]:
+                    self._remove(index)
+                    self.in_progress.add(index)
+                    self.downloaders[index] = 1
+                    return index
+        return None
+
+    @property
+    def endgame(self) -> bool:
+        # Every piece we still need is being downloaded by some peer; only
+        # a precondition of endgame, see DownloadManager._endgame_ready
+        return self.remaining == 0 and bool(self.in_progress)
+
+    def pick_endgame(self, bitfield, exclude=()):
+        """
+        In endgame mode, returns the in-progress piece with the fewest
+        downloaders that the peer has, skipping pieces in `exclude` and
+        pieces already at MAX_ENDGAME_DOWNLOADERS. Returns None otherwise.
+        """
+        if not self.endgame:
+            return None
+        size = len(bitfield)
+        best = None
+        for index in self.in_progress:
+            count = self.downloaders[index]
+            if (count < MAX_ENDGAME_DOWNLOADERS and index not in exclude
+                    and index < size and bitfield[index]
+                    and (best is None or count < self.downloaders[best])):
+                best = index
+        if best is not None:
+            self.downloaders[best] += 1
+        return best
+
+    def abort(self, index):
+        """
+        Gives up one download of an in-progress piece, e.g. after a failure.
+        The piece returns to the pool when nobody else is downloading it.
+        """
+        if index in self.in_progress:
+            self.downloaders[index] -= 1
+            if self.downloaders[index] <= 0:
+                del self.downloaders[index]
+                self.in_progress.discard(index)
+                self._insert(index)
+
+    def complete(self, index):
+        """
+        Marks a piece as downloaded and verified; it is never picked again.
+        """
+        self.in_progress.discard(index)
+        self.downloaders.pop(index, None)
+        if self._position[index] >= 0:
+            self._remove(index)
+        self.have.add(index)
+
+    @property
+    def remaining(self):
+        """
+        Number of pieces that are neither downloaded nor in progress.
+        """
+        return self.num_pieces - len(self.have) - len(self.in_progress)
+
+    def _insert(self, index):
+        availability = self.availability[index]
+        while len(self._buckets) <= availability:
+            self._buckets.append([])
+        bucket = self._buckets[availability]
+        self._position[index] = len(bucket)
+        bucket.append(index)
+
+    def _remove(self, index):
+        bucket = self._buckets[self.availability[index]]
+        position = self._position[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self._position[last] = position
+        self._position[index] = -1
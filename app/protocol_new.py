@@ -1,8 +1,15 @@
 
 import asyncio
+import logging
+import math
 import struct
 import hashlib
-import bitstring
+import time
+from collections import deque
+from .bitfield import Bitfield
+from .metrics import histogram, DURATION_BUCKETS
+
+logger = logging.getLogger(__name__)
 
 # Message IDs (as per BitTorrent protocol)
 CHOKE = 0
@@ -19,80 +26,427 @@ PORT = 9
 # The default block size for piece requests
 BLOCK_SIZE = 2**14  # 16 KB
 
+# Number of block requests kept in flight per peer. Bounded on both ends:
+# one outstanding request degenerates to stop-and-wait, and most clients
+# drop connections that queue more than a few hundred requests.
+DEFAULT_PIPELINE_DEPTH = 16
+MIN_PIPELINE_DEPTH = 1
+MAX_PIPELINE_DEPTH = 250
+
+# Adaptive pipelines hold DEPTH_GAIN times the peer's bandwidth-delay
+# product, re-estimated every RATE_INTERVAL seconds from the delivery rate
+# and the lowest block round trip of the last RTT_WINDOWS intervals (10 s).
+# The gain lets a pipeline that limits the rate grow until the link does.
+DEPTH_GAIN = 2
+RATE_INTERVAL = 0.5
+RTT_WINDOWS = 20
+
+# A peer that delivers none of our outstanding requests for this long is
+# snubbed: its pieces are handed to other peers and it gets one request
+SNUB_TIMEOUT = 30
+
+# Length of the handshake that precedes the length-prefixed messages
+HANDSHAKE_LENGTH = 68
+
+# Protocol string and peer id sent in our handshakes
+PROTOCOL_NAME = b'BitTorrent protocol'
+PEER_ID = b'-PC0001-123456789012'  # A common peer ID format
+
+# Receive buffer sizing: start size and the free space offered per read
+RECEIVE_BUFFER_SIZE = 256 * 1024  # 256 KB
+MIN_READ_SIZE = 64 * 1024  # 64 KB
+
+# Larger messages are treated as a protocol violation (a bitfield for
+# 16 million pieces still fits)
+MAX_MESSAGE_LENGTH = 2 * 2**20  # 2 MB
+
+# Stop reading from the socket while this many messages wait to be handled
+MAX_QUEUED_MESSAGES = 1024
+
+
+# Instrumentation, exported by app.metrics
+BLOCK_LATENCY = histogram(
+    'bittorrent_block_latency_seconds',
+    'Time from sending a block REQUEST to receiving the block')
+CHOKE_STATE = histogram(
+    'bittorrent_peer_choke_state_seconds',
+    'How long peers kept us choked or unchoked before switching',
+    ('state',), DURATION_BUCKETS)
+_CHOKED = CHOKE_STATE.labels('choked')
+_UNCHOKED = CHOKE_STATE.labels('unchoked')
+
+
+def build_handshake(info_hash):
+    """
+    Returns the 68-byte handshake announcing `info_hash` and our peer id.
+    """
+    return struct.pack(
+        '>B19s8x20s20s',
+        len(PROTOCOL_NAME),
+        PROTOCOL_NAME,
+        info_hash,
+        PEER_ID
+    )
+
+
+class PieceCancelled(Exception):
+    """
+    Raised by download_piece when the piece was cancelled with cancel_piece.
+    """
+
+
+class WireProtocol(asyncio.BufferedProtocol):
+    """
+    Frames peer-wire messages straight out of one receive buffer.
+
+    The transport reads into `get_buffer`, and every wakeup parses all complete
+    messages available. When `block_sink` is set, PIECE payloads are handed to
+    it as a memoryview into the receive buffer, so a block is copied once,
+    into its piece buffer. Other messages are queued as (msg_id, payload)
+    pairs; keep-alives are queued as (None, None).
+
+    Outgoing messages are appended to one buffer and written with a single
+    transport.write per `flush`.
+    """
+    def __init__(self):
+        self.transport = None
+        # Called as block_sink(index, begin, block_view) for each PIECE message
+        self.block_sink = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._start = 0  # First unparsed byte
+        self._end = 0  # End of received data
+        self._handshake = None
+        self._expect_handshake = True
+        self._messages = deque()
+        self._progress = False
+        self._waiter = None
+        self._exc = None
+        self._out = bytearray()
+        self._write_paused = False
+        self._drain_waiter = None
+        self._reading_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    @property
+    def error(self):
+        # Why the connection failed or closed, or None while it is usable
+        return self._exc
+
+    def connection_lost(self, exc):
+        self._exc = exc or ConnectionResetError('Connection closed by peer')
+        self._wakeup()
+        if self._drain_waiter and not self._drain_waiter.done():
+            self._drain_waiter.set_exception(self._exc)
+
+    def get_buffer(self, sizehint):
+        buf = self._buffer
+        if len(buf) - self._end < MIN_READ_SIZE:
+            # Move the unparsed tail to the front, growing only when a single
+            # message does not fit
+            unparsed = self._end - self._start
+            if unparsed + MIN_READ_SIZE > len(buf):
+                grown = bytearray(max(2 * len(buf), unparsed + MIN_READ_SIZE))
+                grown[:unparsed] = memoryview(buf)[self._start:self._end]
+                self._buffer = buf = grown
+            else:
+                buf[:unparsed] = memoryview(buf)[self._start:self._end]
+            self._start, self._end = 0, unparsed
+        return memoryview(buf)[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        self.bytes_received += nbytes
+        try:
+            self._parse()
+        except ValueError as e:
+            self._exc = e
+            self.transport.close()
+        self._wakeup()
+
+    def eof_received(self):
+        return False
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        if self._drain_waiter and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def _parse(self):
+        start, end = self._start, self._end
+        with memoryview(self._buffer) as view:
+            if self._expect_handshake:
+                if end - start < HANDSHAKE_LENGTH:
+                    return
+                self._handshake = view[start:start + HANDSHAKE_LENGTH].tobytes()
+                self._expect_handshake = False
+                start += HANDSHAKE_LENGTH
+
+            while end - start >= 4:
+                length, = struct.unpack_from('>I', view, start)
+                if length == 0:
+                    self._messages.append((None, None))  # Keep-alive
+                    start += 4
+                    continue
+                if length > MAX_MESSAGE_LENGTH:
+                    raise ValueError(f"Message of {length} bytes exceeds limit")
+                if end - start - 4 < length:
+                    break
+                msg_id = view[start + 4]
+                if msg_id == PIECE and self.block_sink and length >= 9:
+                    index, begin = struct.unpack_from('>II', view, start + 5)
+                    self.block_sink(index, begin, view[start + 13:start + 4 + length])
+                    self._progress = True
+                else:
+                    self._messages.append(
+                        (msg_id, view[start + 5:start + 4 + length].tobytes()))
+                start += 4 + length
+
+        if start == end:
+            start = end = 0  # Everything parsed; reuse the buffer from the top
+        self._start, self._end = start, end
+        if len(self._messages) >= MAX_QUEUED_MESSAGES and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    def interrupt(self):
+        """
+        Wakes a pending `wait` without any new data.
+        """
+        self._progress = True
+        self._wakeup()
+
+    def _wakeup(self):
+        waiter = self._waiter
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    async def wait(self):
+        """
+        Waits until messages are queued or the block sink consumed a block.
+        """
+        if not self._messages and not self._progress:
+            if self._exc:
+                raise self._exc
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        self._progress = False
+
+    def pop_messages(self):
+        """
+        Returns and clears every queued message.
+        """
+        messages, self._messages = self._messages, deque()
+        self._resume_reading()
+        return messages
+
+    async def receive(self):
+        """
+        Returns the next queued (msg_id, payload) pair.
+        """
+        while not self._messages:
+            await self.wait()
+        message = self._messages.popleft()
+        self._resume_reading()
+        return message
+
+    async def receive_handshake(self):
+        while self._handshake is None:
+            await self.wait()
+        return self._handshake
+
+    def _resume_reading(self):
+        if self._reading_paused and len(self._messages) < MAX_QUEUED_MESSAGES // 2:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    def write(self, data):
+        self._out += data
+
+    def write_message(self, msg_id, payload=b''):
+        self._out += struct.pack('>IB', 1 + len(payload), msg_id)
+        self._out += payload
+
+    def flush(self):
+        """
+        Hands everything written since the last flush to the transport at once.
+        """
+        if self._out and not self.transport.is_closing():
+            self.bytes_sent += len(self._out)
+            self.transport.write(self._out)
+            self._out = bytearray()
+
+    async def drain(self):
+        """
+        Flushes and waits while the transport's write buffer is full.
+        """
+        self.flush()
+        if self._exc:
+            raise self._exc
+        if self._write_paused:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._drain_waiter
+            finally:
+                self._drain_waiter = None
+
+
 class PeerConnection:
     """
     Manages the connection and communication with a single peer.
     """
-    def __init__(self, torrent, ip, port):
+    def __init__(self, torrent, ip, port, pipeline_depth=DEFAULT_PIPELINE_DEPTH,
+                 verifier=None, bandwidth=None, adaptive=True):
         self.torrent = torrent
         self.ip = ip
         self.port = port
-        self.reader = None
-        self.writer = None
+        self.transport = None
+        self.wire = None
         self.bitfield = None  # Peer's bitfield of available pieces
         self.am_choking = True
         self.am_interested = False
         self.peer_choking = True
+        self._choke_changed = time.monotonic()
         self.peer_interested = False
         self.peer_id = None
+        # Requests kept in flight; the starting value when `adaptive`
+        self.pipeline_depth = max(MIN_PIPELINE_DEPTH,
+                                  min(MAX_PIPELINE_DEPTH, pipeline_depth))
+        self.adaptive = adaptive
+        # Outstanding requests keyed by (index, begin, length), with the
+        # time each was sent
+        self.outstanding = {}
+        self.outstanding_bytes = 0
+        # Called with the piece index whenever the peer announces a new piece
+        self.on_have = None
+        # Shared PieceVerifier; without one pieces are hashed inline
+        self.verifier = verifier
+        # Bandwidth limits (app.bandwidth) for this peer; None is unlimited
+        self.bandwidth = bandwidth
+        self._throttle_timer = None
+        # Pieces being downloaded: buffers and bytes still missing, by index
+        self._pieces = {}
+        self._missing = {}
+        self._completed = []
+        # Block requests not sent yet, in piece order
+        self._pending = deque()
+        # Rolling measurements: delivery rate in bytes/s, smoothed and
+        # minimum block round trip in seconds
+        self.download_rate = 0.0
+        self.rtt = None
+        self._rtt_minimums = deque(maxlen=RTT_WINDOWS)
+        self._window_rtt = None
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_busy = False
+        # Snubbing: set when no block arrives for SNUB_TIMEOUT; `timeouts`
+        # counts every expiry so callers can release pieces each time
+        self.snubbed = False
+        self.timeouts = 0
+        self._last_progress = time.monotonic()
+        self._snub_timer = None
 
     async def connect(self, handshake_only=False):
         """
         Establishes a TCP connection with the peer and performs the handshake.
         """
         try:
-            self.reader, self.writer = await asyncio.wait_for(
-                asyncio.open_connection(self.ip, self.port), timeout=10)
+            loop = asyncio.get_running_loop()
+            self.transport, self.wire = await asyncio.wait_for(
+                loop.create_connection(WireProtocol, self.ip, self.port), timeout=10)
             await self._perform_handshake()
+            # Blocks are copied into their piece by the wire parser as they arrive
+            self.wire.block_sink = self._store_block
             if not handshake_only:
                 self.bitfield = await self._receive_bitfield()
         except (asyncio.TimeoutError, ConnectionRefusedError, OSError) as e:
-            print(f"Failed to connect to {self.ip}:{self.port}: {e}")
+            logger.debug("Failed to connect to %s:%d: %s", self.ip, self.port, e)
             raise
 
     async def _perform_handshake(self):
         """
         Sends and receives the initial BitTorrent handshake.
         """
-        pstr = b'BitTorrent protocol'
-        handshake = struct.pack(
-            '>B19s8x20s20s',
-            19,  # Length of protocol string
-            pstr,
-            self.torrent.info_hash,
-            b'-PC0001-123456789012'  # A common peer ID format
-        )
-        self.writer.write(handshake)
-        await self.writer.drain()
+        self.wire.write(build_handshake(self.torrent.info_hash))
+        await self.wire.drain()
 
-        response = await self.reader.readexactly(68)
+        response = await self.wire.receive_handshake()
 
         self.peer_id = response[48:]
         # Note: A more robust client would validate the info_hash from the peer
-        if response[1:20] != pstr:
+        if response[1:20] != PROTOCOL_NAME:
             raise ValueError("Invalid protocol in handshake response.")
 
     async def _receive_message(self):
         """
         Receives a message from the peer and returns its ID and payload.
         """
-        header = await self.reader.readexactly(4)
-        length = struct.unpack(">I", header)[0]
-        if length == 0:
-            return None, None  # Keep-alive message
+        return await self.wire.receive()
 
-        msg_id = (await self.reader.readexactly(1))[0]
-        payload = await self.reader.readexactly(length - 1)
-        return msg_id, payload
+    def _queue_message(self, msg_id, payload=b''):
+        """
+        Adds a message to the outgoing batch without sending it yet.
+        """
+        self.wire.write_message(msg_id, payload)
 
     async def _send_message(self, msg_id, payload=b''):
         """
         Constructs and sends a message to the peer.
         """
-        length = 1 + len(payload)
-        message = struct.pack(">I", length) + bytes([msg_id]) + payload
-        self.writer.write(message)
-        await self.writer.drain()
+        self._queue_message(msg_id, payload)
+        await self.wire.drain()
+
+    def _handle_message(self, msg_id, payload):
+        """
+        Applies a state-changing message (choke, have, ...) to the connection.
+        """
+        if msg_id == CHOKE:
+            self._set_peer_choking(True)
+        elif msg_id == UNCHOKE:
+            self._set_peer_choking(False)
+        elif msg_id == INTERESTED:
+            self.peer_interested = True
+        elif msg_id == NOT_INTERESTED:
+            self.peer_interested = False
+        elif msg_id == HAVE:
+            index = struct.unpack(">I", payload)[0]
+            if self.bitfield is None:
+                self.bitfield = Bitfield(self.torrent.num_pieces)
+            if index < len(self.bitfield) and not self.bitfield[index]:
+                self.bitfield[index] = True
+                if self.on_have:
+                    self.on_have(index)
+        elif msg_id == BITFIELD:
+            old = self.bitfield
+            self.bitfield = Bitfield(self.torrent.num_pieces, payload)
+            if self.on_have:
+                added = self.bitfield.andnot(old) if old is not None else self.bitfield
+                for index in added.indices():
+                    self.on_have(index)
+
+    def _set_peer_choking(self, choking):
+        if choking != self.peer_choking:
+            now = time.monotonic()
+            (_CHOKED if self.peer_choking else _UNCHOKED).observe(now - self._choke_changed)
+            self._choke_changed = now
+            self.peer_choking = choking
+
+    def have_pieces(self):
+        """
+        Returns the indexes of all pieces the peer has announced.
+        """
+        if self.bitfield is None:
+            return []
+        return self.bitfield.indices()
 
     async def _receive_bitfield(self):
         """
@@ -101,9 +455,10 @@ class PeerConnection:
         msg_id, payload = await self._receive_message()
         if msg_id != BITFIELD:
             # Some clients might send HAVE messages instead of a bitfield initially
-            print("Warning: First message was not BITFIELD. Peer may not have any pieces yet.")
+            logger.debug("First message from %s was not BITFIELD; "
+                         "the peer may not have any pieces yet.", self.ip)
             return None
-        return bitstring.BitArray(payload)
+        return Bitfield(self.torrent.num_pieces, payload)
 
     async def send_interested(self):
         """
@@ -112,59 +467,282 @@ class PeerConnection:
         await self._send_message(INTERESTED)
         self.am_interested = True
 
-    async def download_piece(self, piece_index):
+    @property
+    def active_pieces(self):
+        # Indexes of the pieces being downloaded from this peer
+        return self._pieces.keys()
+
+    @property
+    def min_rtt(self):
+        # Lowest block round trip over the last RTT_WINDOWS intervals
+        samples = list(self._rtt_minimums)
+        if self._window_rtt is not None:
+            samples.append(self._window_rtt)
+        return min(samples, default=None)
+
+    @property
+    def queued_blocks(self) -> int:
+        # Block requests of active pieces not sent yet
+        return len(self._pending)
+
+    @property
+    def has_room(self) -> bool:
+        # Requests queued or in flight do not fill the pipeline; another
+        # piece should be started
+        return len(self.outstanding) + len(self._pending) < self.pipeline_depth
+
+    def start_piece(self, piece_index, data=None, present=()):
         """
-        Downloads a complete piece from the peer by requesting its blocks.
+        Starts downloading a piece; its blocks are requested by `transfer`.
+        `data` may hold blocks we already have, e.g. from another peer or a
+        previous run, at the offsets in `present`; only the others are
+        requested.
         """
         if not self.bitfield or not self.bitfield[piece_index]:
             raise ValueError(f"Peer does not have piece {piece_index}")
+        piece_size = self.torrent.piece_size(piece_index)
+        self._pieces[piece_index] = bytearray(data) if data is not None else bytearray(piece_size)
+        blocks = [(piece_index, begin, min(BLOCK_SIZE, piece_size - begin))
+                  for begin in range(0, piece_size, BLOCK_SIZE) if begin not in present]
+        self._missing[piece_index] = sum(length for _, _, length in blocks)
+        self._pending.extend(blocks)
+        if not blocks:
+            self._completed.append(piece_index)
 
-        # Wait for the peer to unchoke us
-        while self.peer_choking:
-            msg_id, _ = await self._receive_message()
-            if msg_id == UNCHOKE:
-                self.peer_choking = False
-            # A real client would handle other messages here too (HAVE, etc.)
+    def received_blocks(self, piece_index):
+        """
+        Returns the buffer of unfinished piece `piece_index` and the offsets
+        of the blocks that have arrived in it.
+        """
+        waiting = {begin for index, begin, _ in self.outstanding if index == piece_index}
+        waiting.update(begin for index, begin, _ in self._pending if index == piece_index)
+        piece_size = self.torrent.piece_size(piece_index)
+        return self._pieces[piece_index], [begin for begin in range(0, piece_size, BLOCK_SIZE)
+                                           if begin not in waiting]
 
-        piece_size = self.torrent.pieces_length
-        piece_data = bytearray(piece_size)
-        offset = 0
+    async def transfer(self):
+        """
+        Sends block requests up to `pipeline_depth`, waits for traffic and
+        returns the pieces completed meanwhile as (index, data) pairs, data
+        None for a piece that failed verification.
 
-        while offset < piece_size:
-            block_size = min(BLOCK_SIZE, piece_size - offset)
-            await self._send_message(REQUEST, struct.pack(">III", piece_index, offset, block_size))
+        Several pieces may be in flight, so the pipeline is not limited to
+        the blocks of one piece. Replies may arrive in any order; a CHOKE
+        discards every outstanding request and they are re-sent after the
+        next UNCHOKE.
+        """
+        if not self.peer_choking and self._pending:
+            self._fill_pipeline()
+        await self.wire.drain()
+        if self.outstanding:
+            self._window_busy = True
+            self._arm_snub_timer()
 
-            msg_id, payload = await self._receive_message()
+        await self.wire.wait()
+        for msg_id, payload in self.wire.pop_messages():
+            if msg_id is None:
+                continue  # Keep-alive
             if msg_id == PIECE:
+                # Queued before the sink was installed
                 p_index, p_begin, block_data = self._parse_piece_message(payload)
-                if p_index == piece_index:
-                    piece_data[p_begin:p_begin + len(block_data)] = block_data
-                    offset += len(block_data)
-            else:
-                # Handle other messages or errors
-                print(f"Received unexpected message ID {msg_id} while downloading piece.")
+                self._store_block(p_index, p_begin, block_data)
                 continue
+            was_choking = self.peer_choking
+            self._handle_message(msg_id, payload)
+            if self.peer_choking and not was_choking:
+                # The peer discards our queue when it chokes us
+                self._pending.extendleft(sorted(self.outstanding, reverse=True))
+                self.outstanding.clear()
+                self.outstanding_bytes = 0
+
+        now = time.monotonic()
+        self._check_snubbed(now)
+        self._update_rate(now)
+
+        # Take the pieces out before verifying; cancel_piece may run meanwhile
+        completed = [(index, self._pieces.pop(index)) for index in self._completed]
+        for index in self._completed:
+            del self._missing[index]
+        self._completed = []
+        results = []
+        for index, piece_data in completed:
+            if await self._verify_piece(index, piece_data):
+                logger.debug("Piece %d downloaded and verified successfully.", index)
+                results.append((index, piece_data))
+            else:
+                results.append((index, None))
+        return results
+
+    async def download_piece(self, piece_index):
+        """
+        Downloads a complete piece from the peer by requesting its blocks.
+        """
+        self.start_piece(piece_index)
+        try:
+            while True:
+                for index, piece_data in await self.transfer():
+                    if index != piece_index:
+                        continue
+                    if piece_data is None:
+                        raise ValueError(f"Piece {piece_index} failed verification.")
+                    return piece_data
+                if piece_index not in self._pieces:
+                    raise PieceCancelled(f"Piece {piece_index} was cancelled")
+        finally:
+            self.cancel_piece(piece_index)
+
+    def _store_block(self, index, begin, block):
+        """
+        Copies a requested block into its piece and updates the rate and
+        round-trip measurements. Unrequested, duplicate and cancelled blocks
+        are dropped.
+        """
+        length = len(block)
+        sent = self.outstanding.pop((index, begin, length), None)
+        if sent is None:
+            return
+        now = time.monotonic()
+        sample = now - sent
+        BLOCK_LATENCY.observe(sample)
+        self.rtt = sample if self.rtt is None else self.rtt + (sample - self.rtt) / 8
+        if self._window_rtt is None or sample < self._window_rtt:
+            self._window_rtt = sample
+        self._window_bytes += length
+        self._last_progress = now
+        self.snubbed = False
+        self.outstanding_bytes -= length
+
+        self._pieces[index][begin:begin + length] = block
+        self._missing[index] -= length
+        if not self._missing[index]:
+            self._completed.append(index)
+
+    def cancel_piece(self, piece_index):
+        """
+        Stops downloading `piece_index`: sends CANCEL for its outstanding
+        blocks and forgets the piece. A running download_piece for it raises
+        PieceCancelled.
+        """
+        if piece_index not in self._pieces:
+            return
+        for key in [key for key in self.outstanding if key[0] == piece_index]:
+            self._queue_message(CANCEL, struct.pack(">III", *key))
+            del self.outstanding[key]
+            self.outstanding_bytes -= key[2]
+        self._pending = deque(
+            request for request in self._pending if request[0] != piece_index)
+        del self._pieces[piece_index]
+        del self._missing[piece_index]
+        if piece_index in self._completed:
+            self._completed.remove(piece_index)
+        if self.wire:
+            self.wire.flush()
+            self.wire.interrupt()
+
+    def release_pieces(self):
+        """
+        Cancels every piece in flight and returns their indexes, e.g. to hand
+        them to other peers.
+        """
+        indexes = list(self._pieces)
+        for index in indexes:
+            self.cancel_piece(index)
+        return indexes
+
+    def _fill_pipeline(self):
+        """
+        Queues block requests until `pipeline_depth` requests are outstanding.
+
+        Download limits are applied here: a block is only requested once its
+        bytes fit the token buckets, so a throttled peer gets fewer requests
+        instead of filling kernel buffers we then read slowly.
+        """
+        now = time.monotonic()
+        if not self.outstanding:
+            # Only time spent waiting on requests counts towards snubbing
+            self._last_progress = now
+        while self._pending and len(self.outstanding) < self.pipeline_depth:
+            index, begin, length = self._pending[0]
+            if self.bandwidth and not self.bandwidth.download.try_consume(length):
+                self._throttle(self.bandwidth.download.delay())
+                break
+            self._pending.popleft()
+            self.outstanding[(index, begin, length)] = now
+            self.outstanding_bytes += length
+            self._queue_message(REQUEST, struct.pack(">III", index, begin, length))
+
+    def _update_rate(self, now):
+        """
+        Closes a measurement interval: updates `download_rate` and, when
+        adaptive, sizes the pipeline from the bandwidth-delay product.
+        """
+        elapsed = now - self._window_start
+        if elapsed < RATE_INTERVAL:
+            return
+        if self._window_busy:
+            # Intervals without requests in flight say nothing about the peer
+            sample = self._window_bytes / elapsed
+            if sample > self.download_rate:
+                # Follow increases at once so a growing pipeline compounds
+                self.download_rate = sample
+            else:
+                self.download_rate += (sample - self.download_rate) / 2
+            if self._window_rtt is not None:
+                self._rtt_minimums.append(self._window_rtt)
+            min_rtt = self.min_rtt
+            if self.adaptive and not self.snubbed and min_rtt is not None:
+                depth = math.ceil(DEPTH_GAIN * self.download_rate * min_rtt / BLOCK_SIZE)
+                self.pipeline_depth = max(MIN_PIPELINE_DEPTH,
+                                          min(MAX_PIPELINE_DEPTH, depth))
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_rtt = None
+        self._window_busy = bool(self.outstanding)
+
+    def _arm_snub_timer(self):
+        if self._snub_timer is None:
+            delay = max(0.0, self._last_progress + SNUB_TIMEOUT - time.monotonic())
+            self._snub_timer = asyncio.get_running_loop().call_later(
+                delay, self._snub_timer_done)
+
+    def _snub_timer_done(self):
+        self._snub_timer = None
+        self.wire.interrupt()
+
+    def _check_snubbed(self, now):
+        if self.outstanding and now - self._last_progress >= SNUB_TIMEOUT:
+            self.snubbed = True
+            self.timeouts += 1
+            self.pipeline_depth = MIN_PIPELINE_DEPTH
+            self._last_progress = now
+
+    def _throttle(self, delay):
+        """
+        Wakes `transfer` to refill the pipeline once tokens are back.
+        """
+        if self._throttle_timer is None:
+            self._throttle_timer = asyncio.get_running_loop().call_later(
+                delay, self._throttle_done)
 
-        if self._verify_piece(piece_index, piece_data):
-            print(f"Piece {piece_index} downloaded and verified successfully.")
-            return piece_data
-        else:
-            raise ValueError(f"Piece {piece_index} failed verification.")
+    def _throttle_done(self):
+        self._throttle_timer = None
+        self.wire.interrupt()
 
     def _parse_piece_message(self, payload):
         """
         Parses a PIECE message payload.
         """
-        index = struct.unpack(">I", payload[:4])[0]
-        begin = struct.unpack(">I", payload[4:8])[0]
-        block_data = payload[8:]
+        index, begin = struct.unpack_from(">II", payload)
+        block_data = memoryview(payload)[8:]
         return index, begin, block_data
 
-    def _verify_piece(self, piece_index, piece_data):
+    async def _verify_piece(self, piece_index, piece_data):
         """
         Verifies the hash of a downloaded piece.
         """
-        expected_hash = self.torrent.pieces[piece_index]
+        expected_hash = self.torrent.piece_hash(piece_index)
+        if self.verifier:
+            return await self.verifier.verify(piece_data, expected_hash)
         actual_hash = hashlib.sha1(piece_data).digest()
         return actual_hash == expected_hash
 
@@ -172,6 +750,9 @@ class PeerConnection:
         """
         Closes the connection with the peer.
         """
-        if self.writer:
-            self.writer.close()
+        for timer in (self._throttle_timer, self._snub_timer):
+            if timer:
+                timer.cancel()
+        if self.transport:
+            self.transport.close()
 
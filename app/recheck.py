@@ -0,0 +1,200 @@
+import hashlib
+import logging
+import mmap
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from .bitfield import Bitfield
+from .storage import FileLayout, torrent_files
+from .torrent import HASH_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# Bytes of pieces hashed per task: enough to amortise handing a task to a
+# worker, few enough to spread the work evenly and report progress often
+DEFAULT_CHUNK_BYTES = 64 * 2**20  # 64 MB
+
+# Tasks in flight per worker, so no worker waits for its next task while
+# memory use and the time to stop early stay bounded
+TASKS_PER_WORKER = 2
+
+# Seconds between progress log lines
+PROGRESS_INTERVAL = 2.0
+
+
+class RecheckResult:
+    """
+    Outcome of a recheck: `have` marks the pieces whose data matched their
+    hash and `failed` lists the other pieces checked, including those on
+    missing or short files. `stopped` is set when the check ended early at
+    `max_failures`, leaving pieces unchecked.
+    """
+    def __init__(self, num_pieces, total_bytes):
+        self.have = Bitfield(num_pieces)
+        self.failed = []
+        self.checked = 0
+        self.bytes_checked = 0
+        self.total_bytes = total_bytes
+        self.seconds = 0.0
+        self.stopped = False
+
+    @property
+    def rate(self) -> float:
+        # Bytes hashed per second
+        if not self.seconds:
+            return 0.0
+        return self.bytes_checked / self.seconds
+
+
+class PieceChecker:
+    """
+    Hashes ranges of pieces straight from memory-mapped files.
+
+    Pages are hashed where the kernel put them, with no copy into Python
+    buffers, and the range is announced with MADV_WILLNEED first so the
+    kernel reads ahead while earlier pieces are hashed. A piece spanning
+    files is hashed from both mappings in turn. It holds no open files
+    between calls, so one instance can be shipped to worker processes.
+    """
+    def __init__(self, files, piece_length):
+        # files is a list of (path, length) in torrent order
+        self.paths = [path for path, _ in files]
+        self.layout = FileLayout(length for _, length in files)
+        self.piece_length = piece_length
+
+    def check(self, start, hashes):
+        """
+        Returns one byte per piece from `start`, 1 where the piece matches
+        its entry in `hashes` (concatenated SHA-1 hashes), else 0.
+        """
+        count = len(hashes) // HASH_LENGTH
+        offset = start * self.piece_length
+        end = min(self.layout.total_length, offset + count * self.piece_length)
+        views, maps = {}, []
+        try:
+            for file_index, file_offset, length in self.layout.spans(offset, end - offset):
+                views[file_index] = self._map(file_index, file_offset, length, maps)
+            results = bytearray(count)
+            for i in range(count):
+                piece_offset = offset + i * self.piece_length
+                size = min(self.piece_length, end - piece_offset)
+                sha1 = hashlib.sha1()
+                for file_index, file_offset, length in self.layout.spans(piece_offset, size):
+                    view = views[file_index]
+                    if view is None or len(view) < file_offset + length:
+                        break  # Missing or short file
+                    sha1.update(view[file_offset:file_offset + length])
+                else:
+                    expected = hashes[i * HASH_LENGTH:(i + 1) * HASH_LENGTH]
+                    results[i] = sha1.digest() == expected
+            return bytes(results)
+        finally:
+            for view in views.values():
+                if view is not None:
+                    view.release()
+            for mapping in maps:
+                mapping.close()
+
+    def _map(self, file_index, file_offset, length, maps):
+        # Read-only view of the whole file, or None if it is missing or empty
+        try:
+            with open(self.paths[file_index], 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None  # mmap raises ValueError for an empty file
+        maps.append(mapping)
+        if hasattr(mapping, 'madvise'):
+            page = file_offset - file_offset % mmap.PAGESIZE
+            available = len(mapping) - page
+            if available > 0:
+                mapping.madvise(mmap.MADV_WILLNEED, page,
+                                min(available, file_offset + length - page))
+        return memoryview(mapping)
+
+
+def recheck(torrent, output_path, workers=None, processes=False,
+            max_failures=None, progress=None,
+            chunk_bytes=DEFAULT_CHUNK_BYTES) -> RecheckResult:
+    """
+    Hashes the data saved at `output_path`, laid out as by
+    Storage.for_torrent, against the torrent's piece hashes.
+
+    Ranges of pieces are spread over `workers` (default one per core)
+    threads, or processes with `processes`. hashlib releases the GIL while
+    hashing, page faults on the mappings included, so threads scale across
+    cores without pickling anything. `progress` is called with the
+    RecheckResult after every range. With `max_failures`, the check stops
+    once that many pieces failed.
+    """
+    workers = workers or os.cpu_count() or 1
+    checker = PieceChecker(torrent_files(torrent, output_path), torrent.pieces_length)
+    chunk = max(1, chunk_bytes // torrent.pieces_length)
+    ranges = iter(range(0, torrent.num_pieces, chunk))
+    result = RecheckResult(torrent.num_pieces, torrent.file_size)
+
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(checker,))
+        check = _check_in_worker
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='recheck')
+        check = checker.check
+
+    started = time.perf_counter()
+    reported = started
+    pending = {}
+    try:
+        while True:
+            while len(pending) < workers * TASKS_PER_WORKER and not result.stopped:
+                start = next(ranges, None)
+                if start is None:
+                    break
+                stop = min(start + chunk, torrent.num_pieces)
+                pending[executor.submit(check, start, torrent.pieces.span(start, stop))] = start
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                _record(result, torrent, pending.pop(future), future.result())
+            if max_failures and len(result.failed) >= max_failures and not result.stopped:
+                result.stopped = True
+                for future in [future for future in pending if future.cancel()]:
+                    del pending[future]
+            now = time.perf_counter()
+            result.seconds = now - started
+            if progress:
+                progress(result)
+            if now - reported >= PROGRESS_INTERVAL:
+                reported = now
+                logger.info("Checked %.1f of %.1f GB (%.0f%%) at %.2f GB/s",
+                            result.bytes_checked / 2**30, result.total_bytes / 2**30,
+                            100 * result.bytes_checked / max(1, result.total_bytes),
+                            result.rate / 2**30)
+    finally:
+        executor.shutdown(cancel_futures=True)
+    result.seconds = time.perf_counter() - started
+    result.failed.sort()
+    return result
+
+
+def _record(result, torrent, start, matches):
+    for index, match in enumerate(matches, start):
+        if match:
+            result.have[index] = True
+        else:
+            result.failed.append(index)
+        result.bytes_checked += torrent.piece_size(index)
+    result.checked += len(matches)
+
+
+# The PieceChecker of a worker process, sent once by the pool initializer
+_worker_checker = None
+
+
+def _init_worker(checker):
+    global _worker_checker
+    _worker_checker = checker
+
+
+def _check_in_worker(start, hashes):
+    return _worker_checker.check(start, hashes)
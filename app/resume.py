@@ -0,0 +1,389 @@
+import logging
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from .bitfield import Bitfield
+from .storage import FileLayout, torrent_files
+from .torrent import is_safe_component
+
+logger = logging.getLogger(__name__)
+
+# First bytes of every resume journal
+MAGIC = b'BTRESUME'
+VERSION = 1
+
+# Compact once the journal grows past COMPACT_RATIO times its last snapshot,
+# and past COMPACT_MIN_BYTES, so appends stay cheap and replays short
+COMPACT_RATIO = 4
+COMPACT_MIN_BYTES = 2**20  # 1 MB
+
+# Record types
+_SNAPSHOT = 1  # Full state: have bitfield, file stats, partial pieces
+_PIECE = 2  # A verified piece was written
+_BLOCKS = 3  # Blocks of an unfinished piece were written
+_STATS = 4  # Size and mtime of files once their writes were synced
+
+# magic, version, info hash, number of pieces, piece length
+_HEADER = struct.Struct('>8sB20sII')
+# Every record: type and payload length, then the payload and a CRC32 of both
+_RECORD = struct.Struct('>BI')
+_CRC = struct.Struct('>I')
+_UINT = struct.Struct('>I')
+# file index, size, mtime in ns
+_STAT = struct.Struct('>IQQ')
+
+
+def resume_path(torrent, output_path):
+    """
+    Where the journal of a download to `output_path` lives: next to a
+    single file, and next to the <name>/ directory of a multi-file torrent.
+    Raises ValueError for a name that would leave `output_path`.
+    """
+    if torrent.multi_file:
+        if not is_safe_component(torrent.name):
+            raise ValueError(f"Unsafe name in torrent: {torrent.name!r}")
+        return os.path.join(output_path, f"{torrent.name}.resume")
+    return f"{output_path}.resume"
+
+
+def write_journal(torrent, output_path, have):
+    """
+    Writes a fresh journal for a download to `output_path` that vouches for
+    the pieces set in the Bitfield `have`, e.g. after a full recheck.
+    """
+    files = torrent_files(torrent, output_path)
+    journal = ResumeJournal(resume_path(torrent, output_path), torrent,
+                            FileLayout(length for _, length in files),
+                            [path for path, _ in files])
+    try:
+        journal.open(have.indices())
+    finally:
+        journal.close()
+
+
+class ResumeState:
+    """
+    What a journal says about the data on disk: `have` lists pieces to trust
+    without hashing, `verify` pieces to re-hash first, and `partial` maps
+    unfinished pieces to the offsets of their blocks on disk.
+    """
+    def __init__(self):
+        self.have = []
+        self.verify = []
+        self.partial = {}
+
+
+class ResumeJournal:
+    """
+    Append-only fast-resume file of one torrent.
+
+    A record of a few bytes is appended whenever a piece has been written,
+    and the size and mtime of the files written since are appended at every
+    `checkpoint`, once those writes are synced. Replaying the journal tells
+    which pieces are on disk without reading them:
+
+    - pieces recorded before the last checkpoint of their files are trusted
+      when the files still have the recorded size and mtime, or when only
+      our own later writes (recorded after the checkpoint) changed them;
+    - pieces recorded after it, i.e. shortly before a crash, are re-hashed;
+    - a file with another size, or changed by anyone but us, is not trusted
+      and its pieces are dropped or re-hashed respectively.
+
+    Once the journal outgrows its last snapshot it is compacted: a single
+    snapshot record goes to a new file, which atomically replaces the old
+    one, so a large download never rewrites much at a time and a crash
+    mid-compaction leaves the old journal intact. A torn or corrupt record,
+    e.g. from a crash mid-append, ends the replay.
+    """
+    def __init__(self, path, torrent, layout, paths):
+        self.path = path
+        self.torrent = torrent
+        self.layout = layout
+        self.paths = paths
+        # Pieces recorded as written
+        self.have = Bitfield(torrent.num_pieces)
+        self.dirty = False
+        self._file = None
+        self._size = 0
+        self._compact_at = COMPACT_MIN_BYTES
+        # Files written since the last checkpoint
+        self._touched = set()
+
+    def load(self) -> ResumeState:
+        """
+        Replays the journal against the files as they are now.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return ResumeState()
+        if not self._valid_header(data):
+            logger.warning("Ignoring resume journal %s of another torrent or version",
+                           self.path)
+            return ResumeState()
+
+        # The pieces of the last snapshot, the sequence number of the record
+        # of every piece written and partial piece since, and the last
+        # recorded (size, mtime, sequence) of every file
+        snapshot, snapshot_sequence = Bitfield(self.torrent.num_pieces), -1
+        later, partial, stats = {}, {}, {}
+        for sequence, (kind, payload) in enumerate(_records(data, _HEADER.size)):
+            if kind == _SNAPSHOT:
+                snapshot, partial, stats = self._parse_snapshot(payload, sequence)
+                snapshot_sequence, later = sequence, {}
+            elif kind == _PIECE:
+                index, = _UINT.unpack(payload)
+                later[index] = sequence
+                partial.pop(index, None)
+            elif kind == _BLOCKS:
+                index, = _UINT.unpack_from(payload)
+                begins = [begin for begin, in _UINT.iter_unpack(payload[_UINT.size:])]
+                partial[index] = (begins, sequence)
+            elif kind == _STATS:
+                for file_index, size, mtime in _STAT.iter_unpack(payload):
+                    stats[file_index] = (size, mtime, sequence)
+
+        # Files we wrote to after their last checkpoint, which explains a
+        # changed mtime
+        written = set()
+        records = list(later.items())
+        records.extend((index, sequence) for index, (_, sequence) in partial.items())
+        for index, sequence in records:
+            for file_index in self._files_of(index):
+                recorded = stats.get(file_index)
+                if recorded is None or sequence > recorded[2]:
+                    written.add(file_index)
+
+        # Records up to this sequence number are trusted, per file; None
+        # marks a file whose data is gone
+        trusted_until = []
+        for file_index, path in enumerate(self.paths):
+            length = self.layout.lengths[file_index]
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            recorded = stats.get(file_index)
+            if stat is None or stat.st_size != length:
+                trusted_until.append(None)
+            elif recorded is None or recorded[0] != length:
+                trusted_until.append(-1)
+            elif recorded[1] == stat.st_mtime_ns or file_index in written:
+                trusted_until.append(recorded[2])
+            else:
+                logger.info("%s changed since it was last synced; re-checking its pieces",
+                            path)
+                trusted_until.append(-1)
+
+        # Snapshot pieces need a closer look only where a file is not
+        # trusted as of the snapshot, so a clean restart is one pass over
+        # the bitfield however many pieces there are
+        suspect = set()
+        for file_index, until in enumerate(trusted_until):
+            if (until is None or until < snapshot_sequence) and self.layout.lengths[file_index]:
+                suspect.update(self._pieces_of(file_index))
+        state = ResumeState()
+        for index in snapshot.indices():
+            if index in later:
+                continue
+            if index in suspect:
+                self._classify(state, index, snapshot_sequence, trusted_until)
+            else:
+                state.have.append(index)
+        for index, sequence in later.items():
+            self._classify(state, index, sequence, trusted_until)
+        state.have.sort()
+        state.verify.sort()
+        for index, (begins, sequence) in partial.items():
+            if begins and self._trust(index, sequence, trusted_until):
+                state.partial[index] = begins
+        return state
+
+    def open(self, have, partial=None):
+        """
+        Starts a fresh journal holding `have` (indexes of the pieces on
+        disk) and `partial`, and keeps it open for appending.
+        """
+        self.have = Bitfield(self.torrent.num_pieces)
+        for index in have:
+            self.have[index] = True
+        self.compact(partial)
+
+    def record_piece(self, index):
+        """
+        Notes that piece `index` was verified and written.
+        """
+        self.have[index] = True
+        self._touched.update(self._files_of(index))
+        self._append(_PIECE, _UINT.pack(index))
+
+    def record_blocks(self, index, begins):
+        """
+        Notes the offsets of all blocks written so far of unfinished piece
+        `index`; an empty list forgets them.
+        """
+        self._touched.update(self._files_of(index))
+        self._append(_BLOCKS, _UINT.pack(index) + b''.join(map(_UINT.pack, begins)))
+
+    def checkpoint(self, partial=None):
+        """
+        Records the stats of every file written since the last checkpoint
+        and syncs the journal. Call it only once those writes are synced.
+        Compacts the journal, keeping `partial`, when it has grown enough.
+        """
+        if self._file is None:
+            return
+        if self._touched:
+            self._append(_STATS, self._stats(sorted(self._touched)))
+            self._touched.clear()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.dirty = False
+        if self._size >= self._compact_at:
+            self.compact(partial)
+
+    def compact(self, partial=None):
+        """
+        Replaces the journal with one snapshot of the pieces written, the
+        current file stats and `partial` ({index: block offsets}).
+        """
+        partial = partial or {}
+        stats = self._stats(range(len(self.paths)))
+        payload = bytearray(self.have.tobytes())
+        payload += _UINT.pack(len(stats) // _STAT.size) + stats
+        payload += _UINT.pack(len(partial))
+        for index, begins in partial.items():
+            payload += _UINT.pack(index) + _UINT.pack(len(begins))
+            payload += b''.join(map(_UINT.pack, begins))
+
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, self.torrent.info_hash,
+                                 self.torrent.num_pieces, self.torrent.pieces_length))
+            f.write(_frame(_SNAPSHOT, payload))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        if self._file:
+            self._file.close()
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        self._compact_at = max(COMPACT_MIN_BYTES, COMPACT_RATIO * self._size)
+        self._touched.clear()
+        self.dirty = False
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _append(self, kind, payload):
+        if self._file is None:
+            return
+        record = _frame(kind, payload)
+        # Handed to the kernel right away, so a killed process loses
+        # nothing; only checkpoints wait for the disk
+        self._file.write(record)
+        self._file.flush()
+        self._size += len(record)
+        self.dirty = True
+
+    def _files_of(self, index):
+        # Indexes of the non-empty files piece `index` overlaps
+        start = index * self.torrent.pieces_length
+        end = start + self.torrent.piece_size(index)
+        offsets = self.layout.offsets
+        first = bisect_right(offsets, start) - 1
+        last = bisect_right(offsets, end - 1) - 1
+        return [file_index for file_index in range(first, last + 1)
+                if self.layout.lengths[file_index]]
+
+    def _pieces_of(self, file_index):
+        # Indexes of the pieces overlapping file `file_index`
+        start = self.layout.offsets[file_index]
+        end = start + self.layout.lengths[file_index]
+        return range(start // self.torrent.pieces_length,
+                     (end - 1) // self.torrent.pieces_length + 1)
+
+    def _stats(self, file_indexes):
+        stats = bytearray()
+        for file_index in file_indexes:
+            try:
+                stat = os.stat(self.paths[file_index])
+            except FileNotFoundError:
+                continue
+            stats += _STAT.pack(file_index, stat.st_size, stat.st_mtime_ns)
+        return bytes(stats)
+
+    def _classify(self, state, index, sequence, trusted_until):
+        trust = self._trust(index, sequence, trusted_until)
+        if trust:
+            state.have.append(index)
+        elif trust is not None:
+            state.verify.append(index)
+
+    def _trust(self, index, sequence, trusted_until):
+        # True to trust a record, False to re-hash its piece, None to drop it
+        trusted = True
+        for file_index in self._files_of(index):
+            until = trusted_until[file_index]
+            if until is None:
+                return None
+            if sequence > until:
+                trusted = False
+        return trusted
+
+    def _valid_header(self, data):
+        if len(data) < _HEADER.size:
+            return False
+        magic, version, info_hash, num_pieces, piece_length = _HEADER.unpack_from(data)
+        return (magic == MAGIC and version == VERSION
+                and info_hash == self.torrent.info_hash
+                and num_pieces == self.torrent.num_pieces
+                and piece_length == self.torrent.pieces_length)
+
+    def _parse_snapshot(self, payload, sequence):
+        size = (self.torrent.num_pieces + 7) // 8
+        have = Bitfield(self.torrent.num_pieces, payload[:size])
+        offset = size
+        count, = _UINT.unpack_from(payload, offset)
+        offset += _UINT.size
+        stats = {}
+        for file_index, file_size, mtime in _STAT.iter_unpack(
+                payload[offset:offset + count * _STAT.size]):
+            stats[file_index] = (file_size, mtime, sequence)
+        offset += count * _STAT.size
+        count, = _UINT.unpack_from(payload, offset)
+        offset += _UINT.size
+        partial = {}
+        for _ in range(count):
+            index, blocks = struct.unpack_from('>II', payload, offset)
+            offset += 8
+            end = offset + blocks * _UINT.size
+            partial[index] = ([begin for begin, in _UINT.iter_unpack(payload[offset:end])],
+                              sequence)
+            offset = end
+        return have, partial, stats
+
+
+def _frame(kind, payload):
+    header = _RECORD.pack(kind, len(payload))
+    return header + payload + _CRC.pack(zlib.crc32(payload, zlib.crc32(header)))
+
+
+def _records(data, offset):
+    # Yields (type, payload) up to the first torn or corrupt record
+    while offset + _RECORD.size + _CRC.size <= len(data):
+        kind, length = _RECORD.unpack_from(data, offset)
+        end = offset + _RECORD.size + length
+        if end + _CRC.size > len(data):
+            return
+        header = data[offset:offset + _RECORD.size]
+        payload = data[offset + _RECORD.size:end]
+        crc, = _CRC.unpack_from(data, end)
+        if crc != zlib.crc32(payload, zlib.crc32(header)):
+            return
+        yield kind, payload
+        offset = end + _CRC.size
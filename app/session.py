@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .bandwidth import Bandwidth
+from .download_manager import DownloadManager
+from .hasher import PieceVerifier
+from .peer_server import PeerServer
+from .storage import DEFAULT_WRITERS
+from .torrent import Torrent, is_safe_component
+from .tracker import LISTEN_PORT, Tracker, create_http_session
+from .udp_tracker import UDPTrackerClient
+
+logger = logging.getLogger(__name__)
+
+# Outbound peer connections across all torrents of a session
+DEFAULT_MAX_SESSION_PEERS = 500
+
+# Connection attempts in flight at once across all torrents
+DEFAULT_MAX_SESSION_CONNECTING = 100
+
+# Every downloading torrent may use at least this many peers, however low
+# its share of the budget
+MIN_TORRENT_PEERS = 2
+
+
+class SessionTorrent:
+    """
+    One torrent of a Session: its DownloadManager, where it is saved and its
+    priority. `error` holds the exception that ended its download, if any.
+    """
+    def __init__(self, manager, output_path, priority):
+        self.manager = manager
+        self.output_path = output_path
+        self.priority = priority
+        self.tracker = None
+        self.error = None
+        self._task = None
+
+    @property
+    def torrent(self):
+        return self.manager.torrent
+
+    @property
+    def complete(self) -> bool:
+        return self.manager.downloaded_pieces == self.manager.torrent.num_pieces
+
+    @property
+    def downloading(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+
+class Session:
+    """
+    Runs many torrents on one event loop.
+
+    The torrents share one HTTP connection pool and one UDP tracker client,
+    one listening port, one hashing pool, one disk writer pool and the
+    global bandwidth limits, so a torrent costs its peer connections and
+    piece state rather than a process. Outbound connections come from one
+    budget, split between the downloading torrents in proportion to their
+    priority and rebalanced whenever a torrent is added, finishes or changes
+    priority. Hashing and disk writes are served first come, first served.
+    """
+    def __init__(self, port=LISTEN_PORT,
+                 max_peers=DEFAULT_MAX_SESSION_PEERS,
+                 max_connecting=DEFAULT_MAX_SESSION_CONNECTING,
+                 hash_workers=None, disk_writers=DEFAULT_WRITERS,
+                 download_limit=None, upload_limit=None):
+        self.max_peers = max_peers
+        self.max_connecting = max_connecting
+        self.bandwidth = Bandwidth(download_limit, upload_limit)
+        self.verifier = PieceVerifier(hash_workers)
+        self.disk_executor = ThreadPoolExecutor(max_workers=disk_writers,
+                                                thread_name_prefix='storage')
+        self.server = PeerServer(port)
+        # SessionTorrent of every torrent, by info hash
+        self.torrents = {}
+        self.http_client = None
+        self.udp_client = UDPTrackerClient()
+
+    async def start(self):
+        """
+        Opens the shared tracker connection pool and starts accepting peers.
+        """
+        self.http_client = create_http_session()
+        try:
+            await self.server.start()
+        except OSError as e:
+            logger.warning("Not accepting peers on port %d: %s", self.server.port, e)
+
+    def add_torrent(self, torrent, output_path, priority=1):
+        """
+        Adds a torrent to be saved at `output_path` and returns its
+        SessionTorrent. `priority` is a positive weight for its share of
+        the connection budget. The download starts with `download` or `run`.
+        """
+        if torrent.info_hash in self.torrents:
+            raise ValueError(f"Torrent {torrent.name} is already in the session")
+        if priority <= 0:
+            raise ValueError("Priority must be positive")
+        manager = DownloadManager(torrent, output_path, bandwidth=self.bandwidth,
+                                  verifier=self.verifier,
+                                  disk_executor=self.disk_executor)
+        entry = SessionTorrent(manager, output_path, priority)
+        self.torrents[torrent.info_hash] = entry
+        self.server.add_torrent(manager)
+        self._rebalance()
+        return entry
+
+    async def remove_torrent(self, entry):
+        """
+        Stops a torrent's download and upload and closes its files.
+        """
+        self.torrents.pop(entry.torrent.info_hash, None)
+        if entry._task:
+            entry._task.cancel()
+            await asyncio.gather(entry._task, return_exceptions=True)
+        self.server.remove_torrent(entry.manager)
+        await entry.manager.close()
+        self._rebalance()
+
+    def set_priority(self, entry, priority):
+        if priority <= 0:
+            raise ValueError("Priority must be positive")
+        entry.priority = priority
+        self._rebalance()
+
+    async def download(self, entry):
+        """
+        Announces a torrent and downloads it, re-announcing on the tracker's
+        interval until it is complete.
+        """
+        entry._task = asyncio.current_task()
+        manager = entry.manager
+        entry.tracker = Tracker(entry.torrent, http_client=self.http_client,
+                                port=self.server.port, udp_client=self.udp_client)
+        announcer = None
+        try:
+            # Pieces left on disk by an earlier run count as done when announcing
+            await manager.resume()
+            peers_info = await entry.tracker.connect(first=True, left=manager.left,
+                                                     on_peers=manager.add_candidates)
+            # Peers are connected concurrently once the download starts
+            manager.add_candidates(peers_info.peers)
+            # Keep re-announcing on the tracker's interval for more peers
+            announcer = asyncio.create_task(
+                entry.tracker.run(manager, manager.add_candidates))
+            await manager.start_download()
+        finally:
+            if announcer:
+                announcer.cancel()
+                await asyncio.gather(announcer, return_exceptions=True)
+            await entry.tracker.close()
+            entry._task = None
+            self._rebalance()
+
+    async def run(self, entries=None):
+        """
+        Downloads `entries`, by default every torrent in the session,
+        concurrently and returns them once all have finished or failed; see
+        SessionTorrent.error.
+        """
+        if entries is None:
+            entries = list(self.torrents.values())
+        results = await asyncio.gather(*(self.download(entry) for entry in entries),
+                                       return_exceptions=True)
+        for entry, result in zip(entries, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, BaseException):
+                entry.error = result
+                logger.error("Download of %s failed: %s", entry.torrent.name, result)
+        logger.info("Verified %d pieces, %.2f ms hash time and %.2f ms latency per piece",
+                    self.verifier.pieces_hashed,
+                    self.verifier.average_hash_time * 1000,
+                    self.verifier.average_latency * 1000)
+        return entries
+
+    async def close(self):
+        for entry in list(self.torrents.values()):
+            await self.remove_torrent(entry)
+        await self.server.close()
+        if self.http_client is not None:
+            await self.http_client.close()
+        self.udp_client.close()
+        self.verifier.close()
+        self.disk_executor.shutdown(wait=False)
+
+    def _rebalance(self):
+        # Split the connection budget over the torrents still downloading,
+        # by priority; the others keep the minimum for requests in flight
+        active = [entry for entry in self.torrents.values() if not entry.complete]
+        total = sum(entry.priority for entry in active)
+        for entry in self.torrents.values():
+            if entry in active:
+                share = entry.priority / total
+                entry.manager.set_connection_limits(
+                    max(MIN_TORRENT_PEERS, int(self.max_peers * share)),
+                    max(1, int(self.max_connecting * share)))
+            else:
+                entry.manager.set_connection_limits(MIN_TORRENT_PEERS, 1)
+
+
+def find_torrents(paths):
+    """
+    Expands .torrent files and directories of them into a sorted list of
+    .torrent paths.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith('.torrent')))
+        else:
+            found.append(path)
+    return found
+
+
+def plan_downloads(paths, output_path):
+    """
+    Returns (torrent_path, Torrent, target) for every torrent in `paths`,
+    and whether `paths` named a single .torrent file. That one is saved to
+    `output_path`; otherwise single-file torrents are saved below it as
+    <name> and multi-file torrents create their own <name>/ directory there.
+    Raises ValueError for a name that would leave `output_path`.
+    """
+    single = len(paths) == 1 and not os.path.isdir(paths[0])
+    plan = []
+    for torrent_path in find_torrents(paths):
+        torrent = Torrent(torrent_path)
+        if single or torrent.multi_file:
+            target = output_path
+        elif is_safe_component(torrent.name):
+            target = os.path.join(output_path, torrent.name)
+        else:
+            raise ValueError(f"Unsafe name in {torrent_path}: {torrent.name!r}")
+        plan.append((torrent_path, torrent, target))
+    return plan, single
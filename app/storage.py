@@ -0,0 +1,371 @@
+import asyncio
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import histogram
+
+# Number of threads issuing positional writes
+DEFAULT_WRITERS = 4
+
+# Maximum number of pieces queued for writing before write_piece waits
+DEFAULT_MAX_PENDING = 64
+
+# fsync once this many bytes have been written since the last sync
+DEFAULT_FSYNC_BYTES = 64 * 2**20  # 64 MB
+
+# File descriptors kept open at once across all files of a torrent
+DEFAULT_MAX_OPEN_FILES = 128
+
+# Instrumentation, exported by app.metrics
+DISK_WRITE_SECONDS = histogram('bittorrent_disk_write_seconds',
+                               'Time to write one piece, excluding time queued')
+
+
+def torrent_files(torrent, output_path):
+    """
+    Returns (path, length) of every file of `torrent` saved at
+    `output_path`, in torrent order; see Storage.for_torrent.
+    """
+    if torrent.multi_file:
+        return [(os.path.join(output_path, f.name), f.length) for f in torrent.files]
+    return [(output_path, torrent.file_size)]
+
+
+class FileLayout:
+    """
+    Maps byte ranges of the torrent's concatenated payload onto its files.
+
+    `offsets[i]` is where file i starts, so the file holding any byte is
+    found with one bisect, O(log files), however many files there are.
+    """
+    __slots__ = ('lengths', 'offsets', 'total_length')
+
+    def __init__(self, lengths):
+        self.lengths = list(lengths)
+        self.offsets = []
+        total = 0
+        for length in self.lengths:
+            self.offsets.append(total)
+            total += length
+        self.total_length = total
+
+    def spans(self, offset, length):
+        """
+        Returns (file_index, file_offset, length) segments covering `length`
+        bytes from `offset`, skipping empty files.
+        """
+        spans = []
+        index = bisect_right(self.offsets, offset) - 1
+        while length > 0:
+            file_offset = offset - self.offsets[index]
+            part = min(length, self.lengths[index] - file_offset)
+            if part > 0:
+                spans.append((index, file_offset, part))
+                offset += part
+                length -= part
+            index += 1
+        return spans
+
+
+class FilePool:
+    """
+    LRU-bounded pool of open file descriptors, safe to use from threads.
+    Descriptors handed out by `acquire` stay open until `release`. Files
+    acquired for writing are remembered until `sync`, which fsyncs them
+    even if they were evicted meanwhile.
+    """
+    def __init__(self, paths, max_open=DEFAULT_MAX_OPEN_FILES):
+        self.paths = paths
+        self.max_open = max_open
+        self._open = OrderedDict()  # file index -> fd, least recent first
+        self._in_use = {}
+        # Indexes of the files written since the last sync, open or not
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, index, write=False):
+        with self._lock:
+            if write:
+                self._dirty.add(index)
+            fd = self._open.get(index)
+            if fd is None:
+                fd = os.open(self.paths[index], os.O_RDWR | os.O_CREAT, 0o644)
+                self._open[index] = fd
+                self._evict()
+            else:
+                self._open.move_to_end(index)
+            self._in_use[index] = self._in_use.get(index, 0) + 1
+            return fd
+
+    def release(self, index):
+        with self._lock:
+            self._in_use[index] -= 1
+            if not self._in_use[index]:
+                del self._in_use[index]
+            self._evict()
+
+    def sync(self):
+        # Evicted files are closed without an fsync and reopened here; fsync
+        # flushes the file, whichever descriptor it is called on
+        with self._lock:
+            pending, self._dirty = sorted(self._dirty), set()
+        try:
+            while pending:
+                fd = self.acquire(pending[0])
+                try:
+                    os.fsync(fd)
+                finally:
+                    self.release(pending[0])
+                pending.pop(0)
+        finally:
+            if pending:
+                # Not durable yet; the next sync tries again
+                with self._lock:
+                    self._dirty.update(pending)
+
+    def close(self):
+        with self._lock:
+            for fd in self._open.values():
+                os.close(fd)
+            self._open.clear()
+
+    def _evict(self):
+        if len(self._open) <= self.max_open:
+            return
+        for index in list(self._open):
+            if index not in self._in_use:
+                os.close(self._open.pop(index))
+                if len(self._open) <= self.max_open:
+                    return
+
+
+class Storage:
+    """
+    Writes verified pieces into preallocated files.
+
+    Every piece lands at `index * piece_length` of the concatenated payload,
+    split across file boundaries by a FileLayout and written with
+    `os.pwrite` from slices of the piece buffer, so writes need no shared
+    file position and can run concurrently on a small thread pool.
+    `write_piece` only waits while the pending queue is full, which keeps
+    disk latency away from the peer sockets on the event loop.
+
+    Pass an `executor` to share one writer pool between the storages of
+    many torrents; it is left running by `close`.
+    """
+    def __init__(self, files, piece_length,
+                 writers=DEFAULT_WRITERS,
+                 max_pending=DEFAULT_MAX_PENDING,
+                 fsync_bytes=DEFAULT_FSYNC_BYTES,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES,
+                 executor=None):
+        # files is a list of (path, length) in torrent order
+        self.paths = [path for path, _ in files]
+        self.layout = FileLayout(length for _, length in files)
+        self.total_length = self.layout.total_length
+        self.piece_length = piece_length
+        self.fsync_bytes = fsync_bytes
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        self._files = FilePool(self.paths, max_open_files)
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=writers,
+                                                        thread_name_prefix='storage')
+        self._slots = asyncio.Semaphore(max_pending)
+        self._pending = set()
+        self._unsynced = 0
+        self._error = None
+        self._stats_lock = threading.Lock()
+        self._active = 0
+        self._busy_since = 0.0
+
+    @classmethod
+    def for_torrent(cls, torrent, output_path, **kwargs):
+        """
+        Single-file torrents are written to `output_path`; multi-file
+        torrents below it, as output_path/<name>/<path>.
+        """
+        return cls(torrent_files(torrent, output_path), torrent.pieces_length, **kwargs)
+
+    def open(self):
+        """
+        Creates the target files and directories and preallocates them.
+        """
+        for path, length in zip(self.paths, self.layout.lengths):
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            try:
+                if os.stat(path).st_size == length:
+                    continue
+            except FileNotFoundError:
+                pass
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(fd, length)
+                if hasattr(os, 'posix_fallocate') and length:
+                    try:
+                        os.posix_fallocate(fd, 0, length)
+                    except OSError:
+                        pass  # Not supported by every filesystem; sparse is fine
+            finally:
+                os.close(fd)
+
+    async def write_piece(self, index, data):
+        """
+        Queues a verified piece for writing and returns once it is queued,
+        with a future that completes when the piece has been written.
+        """
+        return await self.write_block(index, 0, data)
+
+    async def write_block(self, index, begin, data):
+        """
+        Queues `data` for writing at `begin` within piece `index`, like
+        write_piece, e.g. to keep the blocks of an unfinished piece.
+        """
+        self._raise_pending_error()
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._executor, self._write, index * self.piece_length + begin, data)
+        self._pending.add(future)
+        future.add_done_callback(self._write_done)
+        return future
+
+    async def read(self, index, begin, length):
+        """
+        Reads `length` bytes at `begin` within piece `index`.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._read,
+            index * self.piece_length + begin, length)
+
+    async def send(self, transport, index, begin, length):
+        """
+        Sends `length` bytes at `begin` within piece `index` to `transport`
+        with loop.sendfile, so the kernel moves file pages straight to the
+        socket and the block is never copied through Python.
+
+        Raises asyncio.SendfileNotAvailableError, before anything is sent,
+        where the transport cannot do that (e.g. TLS); use `read` instead.
+        """
+        loop = asyncio.get_running_loop()
+        offset = index * self.piece_length + begin
+        for file_index, file_offset, part in self.layout.spans(offset, length):
+            fd = self._files.acquire(file_index)
+            try:
+                # sendfile only uses the descriptor; the pool keeps it open
+                with open(fd, 'rb', buffering=0, closefd=False) as file:
+                    await loop.sendfile(transport, file, file_offset, part,
+                                        fallback=False)
+            finally:
+                self._files.release(file_index)
+
+    async def flush(self):
+        """
+        Waits for every queued write and syncs the file to disk.
+        """
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        self._raise_pending_error()
+        if self._unsynced:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._files.sync)
+            self._unsynced = 0
+
+    async def close(self):
+        """
+        Flushes outstanding writes and releases the files and the writer pool.
+        """
+        try:
+            await self.flush()
+        finally:
+            self._files.close()
+            if self._owns_executor:
+                self._executor.shutdown(wait=False)
+
+    @property
+    def pending(self) -> int:
+        # Pieces queued or being written
+        return len(self._pending)
+
+    @property
+    def write_rate(self) -> float:
+        # Bytes per second while the writers were busy, i.e. what the disk sustains
+        if not self.write_seconds:
+            return 0.0
+        return self.bytes_written / self.write_seconds
+
+    def _write(self, offset, data):
+        # Runs on a writer thread
+        started = time.perf_counter()
+        with self._stats_lock:
+            if not self._active:
+                self._busy_since = started
+            self._active += 1
+        view = memoryview(data)
+        position = 0
+        try:
+            for file_index, file_offset, length in self.layout.spans(offset, len(data)):
+                fd = self._files.acquire(file_index, write=True)
+                try:
+                    part = view[position:position + length]
+                    while part:
+                        written = os.pwrite(fd, part, file_offset)
+                        part = part[written:]
+                        file_offset += written
+                finally:
+                    self._files.release(file_index)
+                position += length
+        finally:
+            # Observed outside _stats_lock: the histogram is shared by every
+            # Storage and has its own lock
+            DISK_WRITE_SECONDS.observe(time.perf_counter() - started)
+            # Also after a failed pwrite (ENOSPC, EIO), so _active gets back
+            # to 0; only the spans written in full count as written
+            with self._stats_lock:
+                # write_seconds counts wall time with at least one write in flight
+                self._active -= 1
+                if not self._active:
+                    self.write_seconds += time.perf_counter() - self._busy_since
+                self.bytes_written += position
+                self._unsynced += position
+                sync = self._unsynced >= self.fsync_bytes
+                if sync:
+                    self._unsynced = 0
+        if sync:
+            self._files.sync()
+
+    def _read(self, offset, length):
+        # Runs on a worker thread; reads each file segment straight into place
+        data = bytearray(length)
+        view = memoryview(data)
+        position = 0
+        for file_index, file_offset, part_length in self.layout.spans(offset, length):
+            fd = self._files.acquire(file_index)
+            try:
+                part = view[position:position + part_length]
+                while part:
+                    read = os.preadv(fd, [part], file_offset)
+                    if not read:
+                        raise EOFError(f"Unexpected end of {self.paths[file_index]}")
+                    part = part[read:]
+                    file_offset += read
+            finally:
+                self._files.release(file_index)
+            position += part_length
+        return data
+
+    def _write_done(self, future):
+        self._pending.discard(future)
+        self._slots.release()
+        if not future.cancelled() and future.exception() and not self._error:
+            self._error = future.exception()
+
+    def _raise_pending_error(self):
+        if self._error:
+            error, self._error = self._error, None
+            raise error
@@ -1,14 +1,65 @@
 import hashlib
+import os
 from collections import namedtuple
-import bencodepy
-# from bencodepy import Decoder
+from app.bencoding import Decoder
 
 TorrentFile = namedtuple('TorrentFile', ['name', 'length'])
 
+# Length of one SHA-1 piece hash in info.pieces
+HASH_LENGTH = 20
+
+
+def is_safe_component(part) -> bool:
+    """
+    True if `part` names an entry of a directory: not empty, '.' or '..',
+    and free of path separators, so joining it cannot leave the directory
+    or make the path absolute.
+    """
+    separators = (os.sep, os.altsep or os.sep, '/')
+    return (part not in ('', '.', '..') and '\0' not in part
+            and not any(separator in part for separator in separators))
+
+
+class PieceHashes:
+
+    # Read-only sequence of piece hashes, sliced on demand from the raw
+    # info.pieces buffer instead of being materialised as a list
+
+    __slots__ = ('_view', '_count')
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._count = len(data) // HASH_LENGTH
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('piece index out of range')
+        start = index * HASH_LENGTH
+        return self._view[start:start + HASH_LENGTH]
+
+    def span(self, start, stop) -> bytes:
+        # Hashes of pieces start..stop-1 back to back, e.g. to hand to a worker
+        return self._view[start * HASH_LENGTH:stop * HASH_LENGTH].tobytes()
+
+    def __iter__(self):
+        view = self._view
+        for start in range(0, self._count * HASH_LENGTH, HASH_LENGTH):
+            yield view[start:start + HASH_LENGTH]
+
+
 class Torrent:
 
     # Represent Torrent meta-data
 
+    __slots__ = ('filename', 'files', 'meta_info', 'name', 'announce',
+                 'announce_list', 'pieces_length', 'file_size', 'info_hash',
+                 'pieces')
+
     def __init__(self, filename):
 
         self.filename = filename
@@ -16,15 +67,20 @@ class Torrent:
 
         with open(self.filename, 'rb') as f:
             meta_info = f.read()
-            # self.meta_info = bencodepy.Decoder().decode(meta_info)
-            self.meta_info = bencodepy.decode(meta_info)
-            info = bencodepy.encode(self.meta_info[b'info'])
+            decoder = Decoder(meta_info, span_keys=(b'info',))
+            self.meta_info = decoder.decode()
+            # Hash the info dict exactly as it appears in the file
+            info_start, info_end = decoder.spans[b'info']
+            info = memoryview(meta_info)[info_start:info_end]
             self.name = self.meta_info[b'info'][b'name'].decode('utf-8')
-            self.announce = self.meta_info[b'announce'].decode('utf-8')
+            self.announce = self.meta_info.get(b'announce', b'').decode('utf-8')
+            self.announce_list = self._announce_tiers()
             self.pieces_length = self.meta_info[b'info'][b'piece length']
-            self.file_size = self.meta_info[b'info'][b'length']
             self.info_hash = hashlib.sha1(info).digest()
+            self.pieces = PieceHashes(self.meta_info[b'info'][b'pieces'])
             self._identify_files()
+            # Total payload length; for multi-file torrents the sum of all files
+            self.file_size = sum(f.length for f in self.files)
         
     @property
     def multi_file(self) -> bool:
@@ -39,23 +95,42 @@ class Torrent:
                 f"Piece Length: {self.pieces_length}\n" \
                 f"Piece Hashes: \n{piece_hashes}"
     
+    def _announce_tiers(self):
+        # BEP 12 announce-list tiers, falling back to the single announce URL
+        tiers = []
+        for tier in self.meta_info.get(b'announce-list', []):
+            urls = [url.decode('utf-8') for url in tier if url]
+            if urls:
+                tiers.append(urls)
+        if not tiers and self.announce:
+            tiers.append([self.announce])
+        return tiers
+
     def _identify_files(self):
         if self.multi_file:
-            raise RuntimeError('Multi-file torrents aren\'t supported yet')
+            # Multi-file paths live below a directory named after the torrent,
+            # so neither may climb out of the output directory
+            if not is_safe_component(self.name):
+                raise ValueError(f"Unsafe name in torrent: {self.name!r}")
+            for entry in self.meta_info[b'info'][b'files']:
+                parts = [p.decode('utf-8') for p in entry[b'path']]
+                if not parts or not all(map(is_safe_component, parts)):
+                    raise ValueError(f"Unsafe file path in torrent: {parts}")
+                self.files.append(TorrentFile(os.path.join(self.name, *parts), entry[b'length']))
+            return
         self.files.append(TorrentFile(self.meta_info[b'info'][b'name'].decode('utf-8'), self.meta_info[b'info'][b'length']))
 
     @property
-    def pieces(self):
-        # The info pieces is a string representing all pieces SHA1 hashes (each 20 bytes long). Read that data and slice it up into the actual pieces
-        data = self.meta_info[b'info'][b'pieces']
-        pieces = []
-        offset = 0
-        length = len(data)
-
-        while offset < length:
-            pieces.append(data[offset:offset + 20])
-            offset += 20
-        return pieces
+    def num_pieces(self) -> int:
+        return len(self.pieces)
+
+    def piece_hash(self, index):
+        # 20-byte SHA-1 of piece `index` as a memoryview into info.pieces
+        return self.pieces[index]
+
+    def piece_size(self, index) -> int:
+        # Every piece is pieces_length long except (usually) the last one
+        return min(self.pieces_length, self.file_size - index * self.pieces_length)
     
 
     # def extract_info_section(raw_data):
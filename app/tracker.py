@@ -1,27 +1,89 @@
 import app.torrent
+import asyncio
+import functools
+import logging
 import random
-import bencodepy
-import socket
-from struct import unpack
+import app.bencoding
 import aiohttp
 from urllib.parse import urlencode
+from app.udp_tracker import UDPTrackerClient
+from app.peers import PeerList
+from app.metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Port we advertise to trackers
+LISTEN_PORT = 6889
+
+# Used when a tracker does not send an interval
+DEFAULT_INTERVAL = 1800
+
+# Upper bound on one HTTP announce, including connection setup
+ANNOUNCE_TIMEOUT = 30
+
+# Once one tier has answered an announce, seconds to wait for the others
+# before returning; slower tiers hand their peers to `on_peers` later
+TIER_GRACE = 2
+
+# Instrumentation, exported by app.metrics
+ANNOUNCES = counter('bittorrent_tracker_announces_total',
+                    'Announces to single tracker URLs by result', ('result',))
+_ANNOUNCE_OK = ANNOUNCES.labels('ok')
+_ANNOUNCE_FAILED = ANNOUNCES.labels('failed')
+
+
+def create_http_session(limit=100):
+    """
+    Creates a pooled aiohttp session that can be shared by the trackers of
+    every torrent, so connections, TLS sessions and DNS lookups are reused
+    between announces.
+    """
+    connector = aiohttp.TCPConnector(limit=limit, ttl_dns_cache=300)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=ANNOUNCE_TIMEOUT))
 
 class TrackerResponse:
 
-    def __init__(self, response: dict):
+    def __init__(self, response: dict, peers=None):
         self.response = response
+        # Decoded on first access of `peers` and cached
+        self._peers = peers
 
     
+    @classmethod
+    def merge(cls, responses):
+        """
+        Combines the responses of several trackers into one, keeping each
+        peer once and the shortest announce intervals.
+        """
+        peers = PeerList()
+        for response in responses:
+            peers.update(response.peers)
+        merged = {}
+        for key in (b'interval', b'min interval'):
+            values = [r.response[key] for r in responses if key in r.response]
+            if values:
+                merged[key] = min(values)
+        for key in (b'complete', b'incomplete'):
+            merged[key] = max((r.response.get(key, 0) for r in responses), default=0)
+        return cls(merged, peers)
+
     @property
     def failure(self):
         if(b'failure reason' in self.response):
-            return self.response[b'failure response'].decode('utf-8')
+            return self.response[b'failure reason'].decode('utf-8', errors='replace')
         return None
     
     @property
     def interval(self) -> int:
         #interval to wait before sending requests to tracker
         return self.response.get(b'interval', 0)
+
+    @property
+    def min_interval(self) -> int:
+        #minimum interval a client may re-announce at
+        return self.response.get(b'min interval', 0)
     
     @property
     def complete(self) -> int:
@@ -34,72 +96,226 @@ class TrackerResponse:
         return self.response.get(b'incomplete', 0)
     
     @property
-    def peers(self):
-        peers = self.response[b'peers']
-        peers_ = []
-        if(type(peers) == list):
-            for peer in peers:
-                ip = peer[b'ip'].decode('utf-8')
-                port = peer[b'port']
-                peers_.append((ip, port))
-            return peers_
-        else:
-            peers_ = [peers[i:i+6] for i in range(0, len(peers), 6)]
-
-            return [(socket.inet_ntoa(p[:4]), _decode_port(p[4:])) for p in peers_]
+    def peers(self) -> PeerList:
+        # IPv4 and IPv6 (peers6) peers, compact or in the dict format
+        if self._peers is None:
+            peers = self.response.get(b'peers', b'')
+            if type(peers) == list:
+                self._peers = PeerList.from_dicts(peers)
+            else:
+                self._peers = PeerList.from_compact(peers)
+            if b'peers6' in self.response:
+                self._peers.update(PeerList.from_compact6(self.response[b'peers6']))
+        return self._peers
         
     def __str__(self):
-        res = ""
-        for p in self.peers:
-            res += (p[0] + ':' + str(p[1]) + '\n')
-        return res
+        return "".join(f"[{ip}]:{port}\n" if ':' in ip else f"{ip}:{port}\n"
+                       for ip, port in self.peers)
         
 class Tracker:
+    """
+    Announces one torrent to its trackers.
 
-    def __init__(self, torrent):
+    Every BEP 12 tier of the announce-list is queried concurrently and the
+    peers of the tiers that answer within TIER_GRACE of the first are
+    merged; within a tier the URLs are tried in order and the one
+    that answers is moved to the front. `udp://` URLs go through a BEP 15
+    UDP client, everything else over HTTP.
+
+    A shared `http_client` (see `create_http_session`) and `udp_client` let
+    many torrents reuse one connection pool and one set of UDP sockets;
+    otherwise the tracker creates its own and closes them in `close`.
+    """
+    def __init__(self, torrent, http_client=None, port=LISTEN_PORT, udp_client=None):
         self.torrent = torrent
         self.peer_id = _calculate_peer_id()
-        # self.http_client = aiohttp.ClientSession()
+        self.port = port
+        self.http_client = http_client
+        self._owns_http_client = http_client is None
+        self.udp_client = udp_client
+        self._owns_udp_client = udp_client is None
+        # Lets a UDP tracker recognise us if our IP address changes
+        self.key = random.getrandbits(32)
+        # BEP 12: shuffle each tier once, then keep working trackers first
+        self.tiers = [random.sample(tier, len(tier)) for tier in torrent.announce_list]
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = 0
+        self._tracker_ids = {}
+        # Announces to slow tiers still running after `connect` returned
+        self._late_announces = set()
 
     async def connect(self, 
                       first: bool = None,
                       uploaded: int = 0,
-                      downloaded: int = 0):
+                      downloaded: int = 0,
+                      left: int = None,
+                      event: str = None,
+                      on_peers=None):
+        """
+        Announces to every tier and returns the merged TrackerResponse as
+        soon as one tier has answered and the rest had TIER_GRACE seconds
+        to. Tiers still pending then pass their peers to `on_peers` when
+        they answer, or are cancelled if it is None.
+        """
         params = {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6889,
+            'port': self.port,
             'uploaded': uploaded,
             'downloaded': downloaded,
-            'left': self.torrent.file_size - downloaded,
+            'left': self.torrent.file_size - downloaded if left is None else left,
             'compact': 1
         }
         if(first):
-            params['event'] = 'started'
-
-        url = self.torrent.announce + '?' + urlencode(params)
-        print('Establishing connection to: ' + url)
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if not response.status == 200:
-                    raise ConnectionError(f'Unable to connect. Status: {response.status}')
-                data = await response.read()
-                self.check_for_failure(data) #tries to decode data and find 'failure'
-                return TrackerResponse(bencodepy.decode(data))
-        
-    def close(self):
-        self.http_client.close()
+            event = 'started'
+        if event:
+            params['event'] = event
 
-    def check_for_failure(self, tracker_response):
-        #tracker message in case of error contains utf-8 message
+        loop = asyncio.get_running_loop()
+        pending = {loop.create_task(self._announce_tier(tier, params)) for tier in self.tiers}
+        done = set()
         try:
-            message = tracker_response.decode("utf-8")
-            if "failure" in message:
-                raise ConnectionError("Unable to connect: {message}")
-        #unicodedecode error signals no utf-8 message hence no error
-        except UnicodeDecodeError:
-            pass
+            while pending and not any(_answered(task) for task in done):
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                done |= finished
+            if pending:
+                finished, pending = await asyncio.wait(pending, timeout=TIER_GRACE)
+                done |= finished
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+        for task in pending:
+            if on_peers is None:
+                task.cancel()
+            self._late_announces.add(task)
+            task.add_done_callback(functools.partial(self._late_announce_done, on_peers))
+
+        responses = [task.result() for task in done if _answered(task)]
+        if not responses:
+            errors = [task.exception() for task in done if not task.cancelled()]
+            raise errors[0] if errors else ConnectionError('No trackers to announce to')
+
+        response = responses[0] if len(responses) == 1 else TrackerResponse.merge(responses)
+        self.interval = response.interval or DEFAULT_INTERVAL
+        self.min_interval = response.min_interval
+        return response
+
+    def _late_announce_done(self, on_peers, task):
+        self._late_announces.discard(task)
+        if on_peers is not None and _answered(task):
+            on_peers(task.result().peers)
+
+    async def _announce_tier(self, tier, params):
+        last_error = None
+        for url in list(tier):
+            try:
+                response = await self._announce(url, params)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError,
+                    RuntimeError, EOFError, ValueError) as e:
+                _ANNOUNCE_FAILED.inc()
+                logger.warning('Tracker %s failed: %s', url, e)
+                last_error = e
+                continue
+            _ANNOUNCE_OK.inc()
+            tier.remove(url)
+            tier.insert(0, url)
+            return response
+        raise last_error or ConnectionError('Empty tracker tier')
+
+    async def _announce(self, url, params):
+        if url.startswith('udp://'):
+            return await self._announce_udp(url, params)
+        if self.http_client is None:
+            self.http_client = create_http_session()
+        if url in self._tracker_ids:
+            params = dict(params, trackerid=self._tracker_ids[url])
+        separator = '&' if '?' in url else '?'
+        url = url + separator + urlencode(params)
+        logger.debug('Establishing connection to: %s', url)
+
+        async with self.http_client.get(url) as response:
+            if not response.status == 200:
+                raise ConnectionError(f'Unable to connect. Status: {response.status}')
+            data = await response.read()
+        tracker_response = TrackerResponse(app.bencoding.decode(data))
+        self.check_for_failure(tracker_response)
+        if b'tracker id' in tracker_response.response:
+            self._tracker_ids[url] = tracker_response.response[b'tracker id']
+        return tracker_response
+
+    async def _announce_udp(self, url, params):
+        if self.udp_client is None:
+            self.udp_client = UDPTrackerClient()
+        logger.debug('Establishing connection to: %s', url)
+        response = await self.udp_client.announce(
+            url, self.torrent.info_hash, self.peer_id.encode('utf-8'),
+            downloaded=params['downloaded'], left=params['left'],
+            uploaded=params['uploaded'], event=params.get('event'),
+            port=self.port, key=self.key)
+        return TrackerResponse(response)
+
+    async def run(self, progress, on_peers):
+        """
+        Re-announces until cancelled, after the initial `connect`.
+
+        `progress` provides the `uploaded`, `downloaded` and `left` byte counts
+        that are reported, and `needs_peers`; while that is true the tracker
+        is asked again after its min interval instead of the full interval.
+        New peers are passed to `on_peers`.
+        """
+        completed = progress.left == 0
+        try:
+            while True:
+                delay = self.interval
+                if progress.needs_peers and self.min_interval:
+                    delay = self.min_interval
+                await asyncio.sleep(delay)
+
+                event = None
+                if not completed and progress.left == 0:
+                    event = 'completed'
+                try:
+                    response = await self.connect(uploaded=progress.uploaded,
+                                                  downloaded=progress.downloaded,
+                                                  left=progress.left,
+                                                  event=event,
+                                                  on_peers=on_peers)
+                except Exception as e:
+                    logger.warning('Announce failed: %s', e)
+                    continue
+                completed = completed or event == 'completed'
+                on_peers(response.peers)
+        except asyncio.CancelledError:
+            await self._announce_stopped(progress)
+            raise
+
+    async def _announce_stopped(self, progress):
+        try:
+            await asyncio.wait_for(
+                self.connect(uploaded=progress.uploaded,
+                             downloaded=progress.downloaded,
+                             left=progress.left,
+                             event='stopped'),
+                timeout=5)
+        except Exception:
+            pass  # Best effort; the tracker drops us after its timeout anyway
+
+    async def close(self):
+        for task in self._late_announces:
+            task.cancel()
+        await asyncio.gather(*self._late_announces, return_exceptions=True)
+        if self._owns_http_client and self.http_client is not None:
+            await self.http_client.close()
+        self.http_client = None
+        if self._owns_udp_client and self.udp_client is not None:
+            self.udp_client.close()
+        self.udp_client = None
+
+    def check_for_failure(self, tracker_response):
+        #tracker reports errors in a 'failure reason' key
+        if tracker_response.failure:
+            raise ConnectionError(f"Unable to connect: {tracker_response.failure}")
         
 
 
@@ -112,9 +328,8 @@ def _calculate_peer_id():
 
     return '-PC0001-' + unique
 
-def _decode_port(port):
-    
-    #Converts a 32-bit packed binary port number to int
-    
-    # Convert from C style big-endian encoded as unsigned short
-    return unpack(">H", port)[0]
\ No newline at end of file
+
+def _answered(task):
+    # True if an announce task finished with a TrackerResponse; retrieves
+    # the exception otherwise so asyncio does not log it again
+    return not task.cancelled() and task.exception() is None
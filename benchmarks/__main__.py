@@ -0,0 +1,60 @@
+"""
+Runs every benchmark and writes one JSON report, for comparing runs with
+benchmarks.compare.
+
+    python -m benchmarks -o before.json
+    python -m benchmarks --quick -o after.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from . import bencoding, micro, swarm
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('-o', '--output', help='write the report here instead of stdout')
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the bencoding benchmarks and the slower swarm scenarios')
+    args = parser.parse_args(argv)
+
+    report = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': {},
+    }
+    if not args.quick:
+        report['results']['bencoding'] = bencoding.run()
+    report['results']['micro'] = micro.run()
+    scenarios = swarm.SCENARIOS
+    if args.quick:
+        scenarios = {name: scenarios[name] for name in ('lan', 'choking')}
+    report['results']['swarm'] = swarm.run(scenarios)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
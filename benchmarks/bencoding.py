@@ -0,0 +1,88 @@
+"""
+Compares the app.bencoding decoder and encoder against bencodepy on synthetic torrents and tracker
+responses.
+
+    python -m benchmarks.bencoding
+"""
+import hashlib
+import io
+import json
+import os
+import time
+
+import app.bencoding
+
+try:
+    import bencodepy
+except ImportError:
+    bencodepy = None
+
+
+def _torrent(num_pieces):
+    return {
+        b'announce': b'http://tracker.example/announce',
+        b'info': {
+            b'length': num_pieces * 2**18,
+            b'name': b'payload.bin',
+            b'piece length': 2**18,
+            b'pieces': os.urandom(20 * num_pieces),
+        },
+    }
+
+
+def _tracker_response(num_peers):
+    return {
+        b'interval': 1800,
+        b'peers': [{b'ip': b'10.0.%d.%d' % divmod(i, 256), b'port': 6881 + i % 100,
+                    b'peer id': hashlib.sha1(b'%d' % i).digest()}
+                   for i in range(num_peers)],
+    }
+
+
+def _timeit(func, *args, repeat=5):
+    # Best wall time of `repeat` runs
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _stream_decode(data, chunk_size=64 * 1024):
+    decoder = app.bencoding.StreamDecoder()
+    for start in range(0, len(data), chunk_size):
+        decoder.feed(data[start:start + chunk_size])
+    decoder.close()
+
+
+def _encode_to(obj):
+    app.bencoding.Encoder(obj).encode_to(io.BytesIO())
+
+
+def run():
+    cases = {
+        'torrent-100k-pieces': _torrent(100000),
+        'tracker-5k-peers': _tracker_response(5000),
+    }
+    results = []
+    for name, obj in cases.items():
+        data = app.bencoding.encode(obj)
+        result = {
+            'case': name,
+            'bytes': len(data),
+            'decode_s': _timeit(app.bencoding.decode, data),
+            'decode_memoryview_s': _timeit(app.bencoding.decode, memoryview(data)),
+            'stream_decode_s': _timeit(_stream_decode, data),
+            'encode_s': _timeit(app.bencoding.encode, obj),
+            'encode_to_s': _timeit(_encode_to, obj),
+        }
+        if bencodepy:
+            result['bencodepy_decode_s'] = _timeit(bencodepy.decode, data)
+            result['bencodepy_encode_s'] = _timeit(bencodepy.encode, obj)
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(), indent=2))
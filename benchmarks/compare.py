@@ -0,0 +1,82 @@
+"""
+Compares two reports written by `python -m benchmarks` and lists every
+metric that moved, worst first. Exits with status 1 when a metric got worse
+by more than the threshold, so it can gate a change.
+
+    python -m benchmarks.compare before.json after.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+# Metrics with these suffixes are better when higher; other timings, sizes
+# and ratios are better when lower
+HIGHER_IS_BETTER = ('_per_s',)
+LOWER_IS_BETTER = ('_s', '_mb', '_per_mb', '_ratio')
+
+
+def _direction(metric):
+    # +1 when higher is better, -1 when lower is, 0 for descriptive fields
+    if metric.endswith(HIGHER_IS_BETTER):
+        return 1
+    if metric.endswith(LOWER_IS_BETTER) and metric != 'size_mb':
+        return -1
+    return 0
+
+
+def _cases(report):
+    # (suite, case) -> result dict
+    return {(suite, result['case']): result
+            for suite, results in report['results'].items()
+            for result in results}
+
+
+def compare(before, after):
+    """
+    Returns (suite, case, metric, before, after, change) for every metric
+    present in both reports, where `change` is the relative improvement:
+    positive is better, negative worse.
+    """
+    rows = []
+    old_cases = _cases(before)
+    for key, new in _cases(after).items():
+        old = old_cases.get(key)
+        if old is None:
+            continue
+        for metric, value in new.items():
+            direction = _direction(metric)
+            previous = old.get(metric)
+            if not direction or not isinstance(value, (int, float)) \
+                    or not isinstance(previous, (int, float)) or not previous:
+                continue
+            change = direction * (value - previous) / abs(previous)
+            rows.append((*key, metric, previous, value, change))
+    rows.sort(key=lambda row: row[-1])
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change counted as a regression (default 0.1)')
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    regressions = 0
+    for suite, case, metric, old, new, change in compare(before, after):
+        flag = ''
+        if change < -args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{suite}/{case} {metric}: {old:.4g} -> {new:.4g} ({change:+.1%}){flag}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+Micro-benchmarks of the client's per-piece and per-block hot paths: piece
+picking, peer-wire message framing, piece hashing, and rechecking data on
+disk and creating torrents from it.
+
+    python -m benchmarks.micro
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import struct
+import tempfile
+import time
+
+from app.bitfield import Bitfield
+from app.creator import hash_pieces
+from app.hasher import PieceVerifier
+from app.piece_picker import PiecePicker
+from app.protocol_new import BLOCK_SIZE, PIECE, REQUEST, WireProtocol
+from app.recheck import recheck
+from app.torrent import Torrent
+from .swarm import make_payload, make_torrent
+
+
+def _timeit(func, *args, repeat=5, **kwargs):
+    # Best wall time of `repeat` runs
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _random_bitfields(num_pieces, num_peers, seed=0):
+    # Each peer has a random half of the pieces
+    rng = random.Random(seed)
+    return [Bitfield.from_int(num_pieces, rng.getrandbits(num_pieces))
+            for _ in range(num_peers)]
+
+
+def bench_picker(num_pieces=20000, num_peers=50):
+    bitfields = _random_bitfields(num_pieces, num_peers)
+
+    def add_peers():
+        picker = PiecePicker(num_pieces)
+        for bitfield in bitfields:
+            picker.add_peer(bitfield.indices())
+        return picker
+
+    def pick_all():
+        # Round-robin over the peers until every piece is handed out
+        picker = add_peers()
+        picks = 0
+        while True:
+            progress = False
+            for bitfield in bitfields:
+                index = picker.pick(bitfield)
+                if index is not None:
+                    picker.complete(index)
+                    picks += 1
+                    progress = True
+            if not progress:
+                return picks
+
+    picker = add_peers()
+    picks = pick_all()
+    return {
+        'case': f'picker-{num_pieces}-pieces-{num_peers}-peers',
+        'add_peers_s': _timeit(add_peers),
+        'rebuild_s': _timeit(picker.rebuild, bitfields),
+        'pick_all_s': _timeit(pick_all, repeat=3),
+        'picks': picks,
+    }
+
+
+class _NullTransport:
+    # Just enough of a transport for WireProtocol
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def bench_framing(num_blocks=4096, read_size=64 * 1024):
+    block = os.urandom(BLOCK_SIZE)
+    stream = b'\x00' * 68 + b''.join(
+        struct.pack('>IBII', 9 + BLOCK_SIZE, PIECE, i // 16, i % 16 * BLOCK_SIZE) + block
+        for i in range(num_blocks))
+    piece = bytearray(16 * BLOCK_SIZE)
+
+    def sink(index, begin, view):
+        piece[begin:begin + len(view)] = view
+
+    def parse():
+        # Feed the stream the way the event loop does: into get_buffer
+        wire = WireProtocol()
+        wire.connection_made(_NullTransport())
+        wire.block_sink = sink
+        data = memoryview(stream)
+        for start in range(0, len(data), read_size):
+            chunk = data[start:start + read_size]
+            wire.get_buffer(len(chunk))[:len(chunk)] = chunk
+            wire.buffer_updated(len(chunk))
+
+    def write_requests():
+        wire = WireProtocol()
+        wire.connection_made(_NullTransport())
+        for i in range(num_blocks):
+            wire.write_message(REQUEST, struct.pack('>III', i // 16, i % 16 * BLOCK_SIZE,
+                                                    BLOCK_SIZE))
+        wire.flush()
+
+    parse_s = _timeit(parse)
+    return {
+        'case': f'framing-{num_blocks}-blocks',
+        'parse_s': parse_s,
+        'parse_mb_per_s': len(stream) / 2**20 / parse_s,
+        'write_requests_s': _timeit(write_requests),
+    }
+
+
+def bench_hashing(num_pieces=256, piece_length=2**18):
+    pieces = [os.urandom(piece_length) for _ in range(num_pieces)]
+    digests = [hashlib.sha1(piece).digest() for piece in pieces]
+    megabytes = num_pieces * piece_length / 2**20
+
+    def serial():
+        for piece in pieces:
+            hashlib.sha1(piece).digest()
+
+    def verify_all():
+        async def verify():
+            verifier = PieceVerifier()
+            try:
+                results = await asyncio.gather(*(verifier.verify(piece, digest)
+                                                 for piece, digest in zip(pieces, digests)))
+            finally:
+                verifier.close()
+            assert all(results)
+        asyncio.run(verify())
+
+    serial_s = _timeit(serial, repeat=3)
+    verifier_s = _timeit(verify_all, repeat=3)
+    return {
+        'case': f'hashing-{num_pieces}x{piece_length}',
+        'serial_mb_per_s': megabytes / serial_s,
+        'verifier_mb_per_s': megabytes / verifier_s,
+        'workers': os.cpu_count(),
+    }
+
+
+def bench_recheck(size=256 * 2**20, piece_length=2**18):
+    # From the page cache, so this measures hashing throughput, which is
+    # what keeps a recheck from reaching the disk's bandwidth
+    with tempfile.TemporaryDirectory(prefix='bench-recheck-') as directory:
+        payload = make_payload(size)
+        path = os.path.join(directory, 'payload.bin')
+        with open(path, 'wb') as f:
+            f.write(payload)
+        make_torrent(os.path.join(directory, 'payload.torrent'), payload, piece_length,
+                     'http://127.0.0.1/announce')
+        del payload
+        torrent = Torrent(os.path.join(directory, 'payload.torrent'))
+        megabytes = size / 2**20
+
+        def check(**kwargs):
+            assert recheck(torrent, path, **kwargs).have.all()
+
+        def create(**kwargs):
+            assert hash_pieces([(path, size)], piece_length, **kwargs) \
+                == torrent.pieces.span(0, torrent.num_pieces)
+
+        return {
+            'case': f'recheck-{size // 2**20}mb',
+            'one_thread_mb_per_s': megabytes / _timeit(check, repeat=3, workers=1),
+            'threads_mb_per_s': megabytes / _timeit(check, repeat=3),
+            'processes_mb_per_s': megabytes / _timeit(check, repeat=3, processes=True),
+            'create_one_thread_mb_per_s': megabytes / _timeit(create, repeat=3, workers=1),
+            'create_mb_per_s': megabytes / _timeit(create, repeat=3),
+            'workers': os.cpu_count(),
+        }
+
+
+def run():
+    return [bench_picker(), bench_framing(), bench_hashing(), bench_recheck()]
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(), indent=2))
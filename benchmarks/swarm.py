@@ -0,0 +1,381 @@
+"""
+Downloads a synthetic torrent end to end from a local fake swarm: seeders
+with configurable latency, bandwidth and choking, announced by a local HTTP
+tracker. Reports throughput, time to first piece, CPU per MB and peak RSS of
+the downloading client.
+
+    python -m benchmarks.swarm
+    python -m benchmarks.swarm --size 256 --peers 8 --latency 0.05 --rate 4
+
+The swarm and the downloading client run in separate processes, so the CPU
+and memory figures are the client's alone and the seeders never compete with
+it for the GIL.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+import app.bencoding
+import app.download_manager
+import app.torrent
+import app.tracker
+
+# Scenarios run by default; sizes in MB, rates in MB/s per seeder
+SCENARIOS = {
+    'lan': dict(size=256, piece_length=2**18, peers=4),
+    'wan': dict(size=32, piece_length=2**18, peers=8, latency=0.05, rate=2),
+    'choking': dict(size=32, piece_length=2**18, peers=4, latency=0.02,
+                    choke_interval=0.25, choke_duration=0.1),
+    'small-pieces': dict(size=32, piece_length=2**15, peers=4, latency=0.01),
+}
+
+# Peer-wire message ids the seeders understand
+CHOKE, UNCHOKE, INTERESTED, BITFIELD, REQUEST, PIECE = 0, 1, 2, 5, 6, 7
+
+SEEDER_ID = b'-BS0001-000000000000'
+
+
+def make_payload(size, seed=0):
+    # Deterministic, so a run can be repeated byte for byte; generated in
+    # chunks because randbytes is limited to 256 MB at once
+    rng = random.Random(seed)
+    chunk = 2**24
+    return b''.join(rng.randbytes(min(chunk, size - start))
+                    for start in range(0, size, chunk))
+
+
+def make_torrent(path, payload, piece_length, announce, name='payload.bin'):
+    """
+    Writes a single-file .torrent for `payload` and returns its info hash.
+    """
+    view = memoryview(payload)
+    info = {
+        b'length': len(payload),
+        b'name': name.encode('utf-8'),
+        b'piece length': piece_length,
+        b'pieces': b''.join(hashlib.sha1(view[start:start + piece_length]).digest()
+                            for start in range(0, len(payload), piece_length)),
+    }
+    with open(path, 'wb') as f:
+        f.write(app.bencoding.encode({b'announce': announce.encode('ascii'),
+                                      b'info': info}))
+    return hashlib.sha1(app.bencoding.encode(info)).digest()
+
+
+class FakeTracker:
+    """
+    HTTP tracker stand-in answering every announce with the same compact
+    peer list.
+    """
+    def __init__(self, peers, interval=1800):
+        self.peers = peers
+        self.interval = interval
+        self.announces = 0
+        self.url = None
+        self._server = None
+
+    async def start(self, host='127.0.0.1'):
+        self._server = await asyncio.start_server(self._handle, host, 0)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/announce"
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while (await reader.readline()).strip():
+                pass  # Request line and headers; the reply never varies
+            self.announces += 1
+            body = app.bencoding.encode({
+                b'interval': self.interval,
+                b'peers': b''.join(struct.pack('>4sH', bytes(map(int, ip.split('.'))), port)
+                                   for ip, port in self.peers),
+            })
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n"
+                         b"Content-Length: %d\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class FakeSeeder:
+    """
+    Seeds `payload` to every peer that connects.
+
+    Each block is sent `latency` seconds after its request arrived, paced to
+    `rate` bytes per second per connection (None for unlimited). With
+    `choke_interval` set, the seeder chokes each peer that often for
+    `choke_duration` seconds and, as the protocol allows, drops the
+    requests it had queued. A `choke_duration` of None chokes each peer
+    for good after the first interval.
+    """
+    def __init__(self, payload, piece_length, info_hash, latency=0.0, rate=None,
+                 choke_interval=None, choke_duration=0.0):
+        self.payload = payload
+        self.piece_length = piece_length
+        self.info_hash = info_hash
+        self.latency = latency
+        self.rate = rate
+        self.choke_interval = choke_interval
+        self.choke_duration = choke_duration
+        self.bytes_sent = 0
+        self.chokes = 0
+        self.address = None
+        self._server = None
+
+    async def start(self, host='127.0.0.1'):
+        self._server = await asyncio.start_server(self._handle, host, 0)
+        self.address = (host, self._server.sockets[0].getsockname()[1])
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        requests = asyncio.Queue()
+        state = {'choked': True}
+        tasks = [asyncio.create_task(self._send_blocks(writer, requests, state))]
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != self.info_hash:
+                return  # Another torrent; real peers hang up too
+            writer.write(struct.pack('>B19s8x20s20s', 19, b'BitTorrent protocol',
+                                     self.info_hash, SEEDER_ID))
+            num_pieces = -(-len(self.payload) // self.piece_length)
+            bitfield = bytearray(b'\xff' * (num_pieces // 8))
+            if num_pieces % 8:
+                bitfield.append((0xff << (8 - num_pieces % 8)) & 0xff)
+            writer.write(struct.pack('>IB', 1 + len(bitfield), BITFIELD) + bitfield)
+            while True:
+                length, = struct.unpack('>I', await reader.readexactly(4))
+                if not length:
+                    continue
+                message = await reader.readexactly(length)
+                if message[0] == INTERESTED and state['choked']:
+                    state['choked'] = False
+                    writer.write(struct.pack('>IB', 1, UNCHOKE))
+                    if self.choke_interval:
+                        tasks.append(asyncio.create_task(
+                            self._choke_periodically(writer, requests, state)))
+                elif message[0] == REQUEST and not state['choked']:
+                    requests.put_nowait((time.monotonic() + self.latency,
+                                         *struct.unpack_from('>III', message, 1)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _send_blocks(self, writer, requests, state):
+        next_send = time.monotonic()
+        while True:
+            due, index, begin, length = await requests.get()
+            now = time.monotonic()
+            send_at = max(due, next_send) if self.rate else due
+            if send_at > now:
+                await asyncio.sleep(send_at - now)
+            if state['choked']:
+                continue  # Requested before the choke; dropped
+            start = index * self.piece_length + begin
+            writer.write(struct.pack('>IBII', 9 + length, PIECE, index, begin)
+                         + self.payload[start:start + length])
+            self.bytes_sent += length
+            if self.rate:
+                next_send = max(send_at, time.monotonic()) + length / self.rate
+            await writer.drain()
+
+    async def _choke_periodically(self, writer, requests, state):
+        while True:
+            await asyncio.sleep(self.choke_interval)
+            state['choked'] = True
+            self.chokes += 1
+            while not requests.empty():
+                requests.get_nowait()
+            writer.write(struct.pack('>IB', 1, CHOKE))
+            if self.choke_duration is None:
+                return
+            await asyncio.sleep(self.choke_duration)
+            state['choked'] = False
+            writer.write(struct.pack('>IB', 1, UNCHOKE))
+
+
+def _run_swarm(connection, directory, size, piece_length, peers, latency=0.0,
+               rate=None, choke_interval=None, choke_duration=0.0):
+    # Child process: serve the swarm until the parent sends anything
+    async def serve():
+        payload = make_payload(size)
+        tracker = FakeTracker([])
+        await tracker.start()
+        torrent_path = os.path.join(directory, 'payload.torrent')
+        info_hash = make_torrent(torrent_path, payload, piece_length, tracker.url)
+        seeders = [FakeSeeder(payload, piece_length, info_hash, latency,
+                              rate and rate * 2**20, choke_interval, choke_duration)
+                   for _ in range(peers)]
+        for seeder in seeders:
+            await seeder.start()
+        tracker.peers = [seeder.address for seeder in seeders]
+        connection.send(torrent_path)
+        await asyncio.to_thread(connection.recv)
+        connection.send({'announces': tracker.announces,
+                         'seeder_bytes_sent': sum(s.bytes_sent for s in seeders),
+                         'seeder_chokes': sum(s.chokes for s in seeders)})
+        for seeder in seeders:
+            await seeder.close()
+        await tracker.close()
+
+    asyncio.run(serve())
+
+
+def _run_client(connection, torrent_path, output_path):
+    # Child process: download once and report, with this process's CPU time
+    # and peak RSS being the client's alone
+    cpu = time.process_time()
+    result = asyncio.run(_download(torrent_path, output_path))
+    result['cpu_s'] = time.process_time() - cpu
+    result['peak_rss_mb'] = _peak_rss_mb()
+    connection.send(result)
+
+
+async def _download(torrent_path, output_path):
+    torrent = app.torrent.Torrent(torrent_path)
+    tracker = app.tracker.Tracker(torrent)
+    manager = app.download_manager.DownloadManager(torrent, output_path)
+    first_piece = []
+    manager.on_piece = lambda index: first_piece or first_piece.append(time.perf_counter())
+    started = time.perf_counter()
+    try:
+        response = await tracker.connect(first=True)
+        manager.add_candidates(response.peers)
+        await manager.start_download()
+    finally:
+        await tracker.close()
+        await manager.close()
+    return {
+        'seconds': time.perf_counter() - started,
+        'first_piece_s': first_piece[0] - started if first_piece else None,
+        'complete': manager.downloaded_pieces == torrent.num_pieces,
+        'endgame_requests': manager.endgame_requests,
+    }
+
+
+def run_scenario(name, size, piece_length, peers, **swarm):
+    """
+    Downloads `size` MB from `peers` fake seeders and returns the results.
+    Swarm and client each run in a freshly spawned process.
+    """
+    size *= 2**20
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='bench-swarm-') as directory:
+        swarm_end, swarm_child = context.Pipe()
+        swarm_process = context.Process(
+            name='swarm', target=_run_swarm,
+            args=(swarm_child, directory, size, piece_length, peers), kwargs=swarm)
+        swarm_process.start()
+        client_process = None
+        try:
+            torrent_path = _receive(swarm_end, swarm_process)
+            client_end, client_child = context.Pipe()
+            client_process = context.Process(
+                name='client', target=_run_client,
+                args=(client_child, torrent_path, os.path.join(directory, 'payload.bin')))
+            client_process.start()
+            result = _receive(client_end, client_process)
+            swarm_end.send('stop')
+            swarm_stats = _receive(swarm_end, swarm_process)
+        finally:
+            for process in (client_process, swarm_process):
+                if process is None:
+                    continue
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.kill()
+
+    megabytes = size / 2**20
+    return {
+        'case': name,
+        'size_mb': megabytes,
+        'piece_length': piece_length,
+        'peers': peers,
+        **swarm,
+        'complete': result['complete'],
+        'seconds': result['seconds'],
+        'mb_per_s': megabytes / result['seconds'],
+        'first_piece_s': result['first_piece_s'],
+        'cpu_s_per_mb': result['cpu_s'] / megabytes,
+        'peak_rss_mb': result['peak_rss_mb'],
+        'endgame_requests': result['endgame_requests'],
+        # Bytes the seeders sent beyond the payload, e.g. duplicate blocks
+        'overhead_ratio': swarm_stats['seeder_bytes_sent'] / size - 1,
+        'announces': swarm_stats['announces'],
+        'seeder_chokes': swarm_stats['seeder_chokes'],
+    }
+
+
+def _receive(connection, process):
+    # Fails instead of waiting forever when the swarm process died
+    while not connection.poll(0.5):
+        if not process.is_alive():
+            raise RuntimeError(f"{process.name} exited with code {process.exitcode}")
+    return connection.recv()
+
+
+def _peak_rss_mb():
+    # VmHWM starts over in a new program; Linux carries ru_maxrss across
+    # fork and exec, so there it would include the parent's peak
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def run(scenarios=SCENARIOS):
+    return [run_scenario(name, **config) for name, config in scenarios.items()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append',
+                        help='run only these presets (default: all)')
+    parser.add_argument('--size', type=int, help='payload size in MB')
+    parser.add_argument('--piece-length', type=int, default=2**18)
+    parser.add_argument('--peers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds from request to block')
+    parser.add_argument('--rate', type=float, help='MB/s per seeder connection')
+    parser.add_argument('--choke-interval', type=float,
+                        help='seconds between chokes of each peer')
+    parser.add_argument('--choke-duration', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    if args.size:
+        scenarios = {'custom': dict(
+            size=args.size, piece_length=args.piece_length, peers=args.peers,
+            latency=args.latency, rate=args.rate,
+            choke_interval=args.choke_interval, choke_duration=args.choke_duration)}
+    else:
+        scenarios = {name: SCENARIOS[name] for name in args.scenario or SCENARIOS}
+    print(json.dumps(run(scenarios), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Downloads from local fake seeders (benchmarks.swarm) that misbehave.
+
+    python -m unittest tests.test_swarm
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+import app.download_manager
+import app.torrent
+from benchmarks.swarm import FakeSeeder, make_payload, make_torrent
+
+PIECE_LENGTH = 2**15
+NUM_PIECES = 32
+
+
+class SwarmTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output = os.path.join(directory.name, 'payload.bin')
+        self.payload = make_payload(NUM_PIECES * PIECE_LENGTH)
+        torrent_path = os.path.join(directory.name, 'payload.torrent')
+        self.info_hash = make_torrent(torrent_path, self.payload, PIECE_LENGTH,
+                                      'http://127.0.0.1:1/announce')
+        self.torrent = app.torrent.Torrent(torrent_path)
+
+    async def download(self, seeders):
+        for seeder in seeders:
+            await seeder.start()
+            self.addAsyncCleanup(seeder.close)
+        manager = app.download_manager.DownloadManager(self.torrent, self.output,
+                                                       resume=False)
+        try:
+            manager.add_candidates([seeder.address for seeder in seeders])
+            await asyncio.wait_for(manager.start_download(), timeout=30)
+        finally:
+            await manager.close()
+        return manager
+
+    async def test_peer_choking_for_good_mid_piece(self):
+        # The choking seeder holds pieces when it stops serving; they must
+        # move to the other seeder instead of waiting on it forever
+        rate = 2**19  # 512 KB/s per connection, so the download outlasts the choke
+        choker = FakeSeeder(self.payload, PIECE_LENGTH, self.info_hash, rate=rate,
+                            choke_interval=0.5, choke_duration=None)
+        healthy = FakeSeeder(self.payload, PIECE_LENGTH, self.info_hash, rate=rate)
+        manager = await self.download([choker, healthy])
+        self.assertEqual(choker.chokes, 1)
+        self.assertEqual(manager.downloaded_pieces, NUM_PIECES)
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
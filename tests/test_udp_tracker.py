@@ -0,0 +1,106 @@
+"""
+Tests of the BEP 15 client against a local stand-in UDP tracker.
+
+    python -m unittest tests.test_udp_tracker
+"""
+import asyncio
+import struct
+import unittest
+
+from app.udp_tracker import (
+    ACTION_ANNOUNCE, ACTION_CONNECT, ACTION_SCRAPE, MAX_SCRAPE_HASHES, PROTOCOL_ID,
+    UDPTrackerClient)
+
+CONNECTION_ID = 0x1122334455667788
+PEERS = bytes([10, 0, 0, 1, 0x1a, 0xe1, 10, 0, 0, 2, 0x1a, 0xe2])
+
+
+class FakeUDPTracker(asyncio.DatagramProtocol):
+    """
+    Answers connect, announce and scrape requests, except the requests
+    numbered in `drop` (counting from 0), to force retransmissions.
+    """
+    def __init__(self, drop=()):
+        self.drop = set(drop)
+        self.requests = []
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        connection_id, action, transaction_id = struct.unpack_from('>QII', data)
+        self.requests.append(action)
+        if len(self.requests) - 1 in self.drop:
+            return
+        if action == ACTION_CONNECT:
+            assert connection_id == PROTOCOL_ID
+            reply = struct.pack('>IIQ', ACTION_CONNECT, transaction_id, CONNECTION_ID)
+        elif action == ACTION_ANNOUNCE:
+            assert connection_id == CONNECTION_ID
+            reply = struct.pack('>IIIII', ACTION_ANNOUNCE, transaction_id, 1800, 3, 5) + PEERS
+        else:
+            assert connection_id == CONNECTION_ID
+            hashes = data[16:]
+            reply = struct.pack('>II', ACTION_SCRAPE, transaction_id) + b''.join(
+                struct.pack('>III', hashes[i], i, 7) for i in range(0, len(hashes), 20))
+        self.transport.sendto(reply, addr)
+
+
+class UDPTrackerClientTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tracker = FakeUDPTracker()
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: self.tracker, local_addr=('127.0.0.1', 0))
+        self.addCleanup(transport.close)
+        self.url = f"udp://127.0.0.1:{transport.get_extra_info('sockname')[1]}/announce"
+        self.client = UDPTrackerClient(base_timeout=0.05, timeout=1)
+        self.addCleanup(self.client.close)
+
+    async def announce(self):
+        return await self.client.announce(self.url, b'i' * 20, b'p' * 20,
+                                          downloaded=0, left=100, uploaded=0,
+                                          event='started', port=6881)
+
+    async def test_connect_and_announce(self):
+        response = await self.announce()
+        self.assertEqual(self.tracker.requests, [ACTION_CONNECT, ACTION_ANNOUNCE])
+        self.assertEqual(response[b'interval'], 1800)
+        self.assertEqual((response[b'incomplete'], response[b'complete']), (3, 5))
+        self.assertEqual(response[b'peers'], PEERS)
+
+    async def test_connection_id_is_reused(self):
+        await self.announce()
+        await self.announce()
+        self.assertEqual(self.tracker.requests,
+                         [ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_ANNOUNCE])
+
+    async def test_lost_packets_are_retransmitted(self):
+        self.tracker.drop = {0, 2}  # The first connect and the first announce
+        response = await self.announce()
+        self.assertEqual(self.tracker.requests,
+                         [ACTION_CONNECT, ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_ANNOUNCE])
+        self.assertEqual(response[b'peers'], PEERS)
+
+    async def test_dead_tracker_times_out(self):
+        self.tracker.drop = set(range(1000))
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.announce()
+        self.assertLess(loop.time() - started, 1.5)
+
+    async def test_scrape_is_batched(self):
+        info_hashes = [bytes([i]) * 20 for i in range(MAX_SCRAPE_HASHES + 6)]
+        results = await self.client.scrape(self.url, info_hashes)
+        self.assertEqual(self.tracker.requests,
+                         [ACTION_CONNECT, ACTION_SCRAPE, ACTION_SCRAPE])
+        self.assertEqual(len(results), len(info_hashes))
+        for i, info_hash in enumerate(info_hashes):
+            self.assertEqual(results[info_hash], (i, (i % MAX_SCRAPE_HASHES) * 20, 7))
+
+
+if __name__ == '__main__':
+    unittest.main()